@@ -1,17 +1,125 @@
-from flask import Flask, request, jsonify
+from flask import Flask, has_request_context, request, jsonify
 import requests
+from requests.adapters import HTTPAdapter
+import contextlib
+import contextvars
+import json
 import logging
+import mmap
+import os
+import queue
+import random
 import re
-from datetime import datetime, timedelta
+import sqlite3
+import struct
+import threading
+import time
+import uuid
+from bisect import bisect_left
+from collections import OrderedDict, namedtuple
+from datetime import date, datetime, timedelta, timezone
+from functools import lru_cache
+from urllib.parse import urlencode
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
 
-# Bitrix24 webhook URL
-WEBHOOK_URL = "https://hr-adv.bitrix24.ru/rest/1/rk34vfgy3owygm3k/"
+# Bitrix24 webhook URL (BITRIX_WEBHOOK_URL - например, bitrix_emulator.py для бенчмарков)
+WEBHOOK_URL = os.environ.get('BITRIX_WEBHOOK_URL', "https://hr-adv.bitrix24.ru/rest/1/rk34vfgy3owygm3k/")
 
 app = Flask(__name__)
 
+# ============================================================================
+# LOGGING - JSON-логи с идентификатором запроса
+# ============================================================================
+
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json')                                    # json или text
+LOG_PAYLOAD_SAMPLE_RATE = float(os.environ.get('LOG_PAYLOAD_SAMPLE_RATE', '0.01'))  # Доля запросов с дампом payload
+REQUEST_ID_HEADER = 'X-Request-ID'
+REQUEST_ID_REGEX = re.compile(r'^[\w.\-]{1,64}$')
+
+# Идентификатор текущего запроса; фоновые задачи наследуют его от запроса, который их создал
+request_id_var = contextvars.ContextVar('request_id', default=None)
+
+class RequestIdFilter(logging.Filter):
+    """Attach the current correlation ID to every record"""
+
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        return True
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per line: ts, level, logger, msg, request_id, any
+    `extra=` fields and the traceback. The message is formatted only here,
+    so records below LOG_LEVEL cost nothing beyond the level check.
+    """
+
+    RESERVED = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'request_id'}
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created).astimezone().isoformat(timespec='milliseconds'),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        if getattr(record, 'request_id', None):
+            entry["request_id"] = record.request_id
+        for key, value in record.__dict__.items():
+            if key not in self.RESERVED:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+def configure_logging(level=LOG_LEVEL, fmt=LOG_FORMAT):
+    """Replace root handlers with a single stderr handler in the chosen format"""
+    handler = logging.StreamHandler()
+    handler.addFilter(RequestIdFilter())
+    if fmt == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(request_id)s] %(name)s: %(message)s'))
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level)
+
+configure_logging()
+
+def redact_payload(payload):
+    """Copy of a webhook payload for logs, with the auth[...] credentials (tokens, member_id) masked"""
+    if not isinstance(payload, dict):
+        return payload
+    return {key: '[redacted]' if key == 'auth' or str(key).startswith('auth[') else value
+            for key, value in payload.items()}
+
+def log_payload(label, payload):
+    """Dump an incoming payload: always at DEBUG, otherwise for a LOG_PAYLOAD_SAMPLE_RATE share of requests"""
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug("%s: %s", label, redact_payload(payload))
+    elif LOG_PAYLOAD_SAMPLE_RATE > 0 and random.random() < LOG_PAYLOAD_SAMPLE_RATE:
+        logging.info("%s (sampled): %s", label, redact_payload(payload), extra={"sampled": True})
+
+@app.before_request
+def assign_request_id():
+    incoming = request.headers.get(REQUEST_ID_HEADER, '')
+    request_id_var.set(incoming if REQUEST_ID_REGEX.match(incoming) else uuid.uuid4().hex[:16])
+
+@app.after_request
+def echo_request_id(response):
+    request_id = request_id_var.get()
+    if request_id:
+        response.headers[REQUEST_ID_HEADER] = request_id
+    return response
+
+@app.teardown_request
+def clear_request_id(exc=None):
+    request_id_var.set(None)
+
 # City to timezone mapping
 CITY_TIMEZONES = {
     'москва': 'МСК (UTC+3)',
@@ -96,7 +204,7 @@ CITY_TIMEZONES = {
     'белгородская область': 'МСК (UTC+3)',
 }
 
-# English to Russian city name translations
+# English names (and full Russian names) to CITY_TIMEZONES keys
 CITY_TRANSLATIONS = {
     'stary oskol': 'старый оскол',
     'moscow': 'москва',
@@ -119,6 +227,7 @@ CITY_TRANSLATIONS = {
     'samara': 'самара',
     'rostov': 'ростов',
     'rostov-on-don': 'ростов',
+    'ростов-на-дону': 'ростов',
     'ufa': 'уфа',
     'perm': 'пермь',
     'voronezh': 'воронеж',
@@ -192,559 +301,2847 @@ CITY_TRANSLATIONS = {
     'belgorod oblast': 'белгородская область',
 }
 
-def normalize_phone(phone):
-    """Normalize phone number to international format"""
+# ============================================================================
+# PHONE NORMALIZATION - нормализация и проверка номеров (RU/KZ/BY/UZ)
+# ============================================================================
+
+PhoneResult = namedtuple('PhoneResult', ['raw', 'digits', 'country', 'status'])
+
+PHONE_VALID = 'valid'
+PHONE_AMBIGUOUS = 'ambiguous'  # Похоже на номер, но код страны неизвестен или угадан
+PHONE_INVALID = 'invalid'
+
+NON_DIGITS_REGEX = re.compile(r'\D+')
+INTERNATIONAL_PREFIX_REGEX = re.compile(r'^\s*(?:\+|00)')
+
+# (страна, код, длина номера без кода, допустимые первые цифры номера)
+PHONE_COUNTRY_RULES = [
+    ('BY', '375', 9, '1234'),
+    ('UZ', '998', 9, '3456789'),
+    ('RU', '7', 10, '3489'),
+    ('KZ', '7', 10, '67'),
+]
+
+def _classify_digits(digits, international):
+    """Match full international digits against country rules"""
+    for country, code, length, first_digits in PHONE_COUNTRY_RULES:
+        national = digits[len(code):]
+        if digits.startswith(code) and len(national) == length and national[0] in first_digits:
+            return country, PHONE_VALID
+    if 8 <= len(digits) <= 15 and not digits.startswith('7'):
+        # Другая страна: с явным "+" доверяем, без него - только похоже на номер
+        return None, PHONE_VALID if international else PHONE_AMBIGUOUS
+    return None, PHONE_INVALID
+
+def classify_phone(phone):
+    """Normalize one phone to international digits and classify it (see normalize_phones)"""
     if not phone:
-        return None
+        return PhoneResult(phone, None, None, PHONE_INVALID)
     
-    # Remove all non-digit characters
-    digits = re.sub(r'\D', '', phone)
+    international = bool(INTERNATIONAL_PREFIX_REGEX.match(phone))
+    digits = NON_DIGITS_REGEX.sub('', phone)
+    if phone.lstrip().startswith('00'):
+        digits = digits[2:]
     
-    # Handle Russian numbers
-    if digits.startswith('8') and len(digits) == 11:
-        digits = '7' + digits[1:]
-    elif digits.startswith('9') and len(digits) == 10:
-        digits = '7' + digits
+    if not international:
+        # Внутренние форматы: 8 (912) ..., 912 ..., 80 29 ... (Беларусь)
+        if len(digits) == 11 and digits.startswith('80'):
+            digits = '375' + digits[2:]
+        elif len(digits) == 11 and digits.startswith('8'):
+            digits = '7' + digits[1:]
+        elif len(digits) == 10 and digits.startswith('9'):
+            digits = '7' + digits
+        elif len(digits) == 10 and digits[0] in '348':
+            # Городской номер без кода страны - скорее всего Россия, но это догадка
+            return PhoneResult(phone, '7' + digits, 'RU', PHONE_AMBIGUOUS)
     
-    return digits
+    country, status = _classify_digits(digits, international)
+    return PhoneResult(phone, digits if status != PHONE_INVALID else None, country, status)
+
+def normalize_phones(phones):
+    """
+    Normalize and validate a list of phones in one call.
+
+    Returns a PhoneResult(raw, digits, country, status) per input, where
+    status is 'valid', 'ambiguous' or 'invalid' and digits are the
+    international digits without "+" (None for invalid numbers).
+    """
+    return [classify_phone(phone) for phone in phones]
+
+def normalize_phone(phone):
+    """Normalize phone number to international format (None unless it is a valid number)"""
+    result = classify_phone(phone)
+    return result.digits if result.status == PHONE_VALID else None
+
+def get_contact_phones(contact):
+    """All phone values of a contact (the PHONE multifield)"""
+    phones = contact.get('PHONE') or []
+    if not isinstance(phones, list):
+        return []
+    return [item.get('VALUE') for item in phones if isinstance(item, dict) and item.get('VALUE')]
+
+def pick_contact_phone(contact):
+    """First valid phone among all of the contact's numbers, or None"""
+    for result in normalize_phones(get_contact_phones(contact)):
+        if result.status == PHONE_VALID:
+            return result
+    return None
+
+# Слова, которые совпадают с именами/фамилиями или обычными словами:
+# их считаем городом только после явного "Город:"
+CITY_SCAN_EXCLUDE = {'владимир', 'vladimir', 'киров', 'kirov', 'орел', 'orel', 'perm'}
+
+def _city_tokens(name):
+    """Split a city name into regex tokens: е/ё and space/hyphen runs are interchangeable"""
+    return [
+        '[её]' if char in 'её' else r'[\s\-]+' if char in ' -' else re.escape(char)
+        for char in re.sub(r'[\s\-]+', ' ', name)
+    ]
+
+def _trie_pattern(node):
+    """Turn a token trie into a regex with shared prefixes, so matching never backtracks across names"""
+    alternatives = [token + _trie_pattern(child) for token, child in sorted(node.items()) if token]
+    if not alternatives:
+        return ''
+    if len(alternatives) == 1 and '' not in node:
+        return alternatives[0]
+    return '(?:' + '|'.join(alternatives) + ')' + ('?' if '' in node else '')
+
+def _normalize_city_key(name):
+    # Регулярка допускает любой разделитель между словами, поэтому и ключ от него не зависит
+    return re.sub(r'[\s\-]+', ' ', name.lower().replace('ё', 'е')).strip()
+
+def _build_city_regex():
+    """
+    One precompiled pattern that finds, in a single pass, either an explicit
+    "Город: XXX" / "City: XXX" / "г. XXX" prefix or any known city name.
+    """
+    trie = {}
+    for name in list(CITY_TIMEZONES) + list(CITY_TRANSLATIONS):
+        if name in CITY_SCAN_EXCLUDE:
+            continue
+        node = trie
+        for token in _city_tokens(name):
+            node = node.setdefault(token, {})
+        node[''] = {}
+    # Применяется к тексту в нижнем регистре: без IGNORECASE поиск по кириллице заметно быстрее
+    return re.compile(
+        r'\b(?:город|city|г\.)[:\s]+(?P<prefixed>[а-яёa-z\s\-]+)'
+        r'|\b(?P<known>' + _trie_pattern(trie) + r')\b'
+    )
+
+CITY_REGEX = _build_city_regex()
+CITY_SPLIT_REGEX = re.compile(r'[\n\r,;]')
+KNOWN_CITY_KEYS = {_normalize_city_key(name): name for name in list(CITY_TIMEZONES) + list(CITY_TRANSLATIONS)}
 
 def extract_city_from_text(text):
     """Extract city name from text (comments, descriptions, etc.)"""
     if not text:
         return None
     
-    text_lower = text.lower()
-    
-    # Try to find "Город: XXX" or "City: XXX" pattern
-    patterns = [
-        r'город[:\s]+([а-яёa-z\s\-]+)',
-        r'city[:\s]+([а-яёa-z\s\-]+)',
-        r'г\.[:\s]+([а-яёa-z\s\-]+)',
-    ]
-    
-    for pattern in patterns:
-        match = re.search(pattern, text_lower)
-        if match:
-            city_raw = match.group(1).strip()
-            # Clean up city name (remove trailing punctuation, newlines, etc.)
-            city_clean = re.split(r'[\n\r,;]', city_raw)[0].strip()
+    known_city = None
+    for match in CITY_REGEX.finditer(text.lower()):
+        if match.group('prefixed'):
+            # Explicit "Город: XXX" wins; clean up trailing punctuation, newlines, etc.
+            city_clean = CITY_SPLIT_REGEX.split(match.group('prefixed'))[0].strip()
+            if not city_clean:
+                continue
             
             # Translate English city names to Russian
             if city_clean in CITY_TRANSLATIONS:
                 return CITY_TRANSLATIONS[city_clean]
             
             return city_clean
+        
+        if known_city is None:
+            name = KNOWN_CITY_KEYS[_normalize_city_key(match.group('known'))]
+            known_city = CITY_TRANSLATIONS.get(name, name)
     
-    return None
+    return known_city
 
-def get_deal_info(deal_id):
-    """Get deal information from Bitrix24"""
-    try:
-        response = requests.get(f"{WEBHOOK_URL}crm.deal.get", params={"ID": deal_id})
-        if response.status_code == 200:
-            data = response.json()
-            return data.get('result', {})
-    except Exception as e:
-        logging.error(f"Error getting deal info: {e}")
-    return None
+# ============================================================================
+# METRICS - счётчики и гистограммы в формате Prometheus (/metrics)
+# ============================================================================
 
-def get_contact_info(contact_id):
-    """Get contact information from Bitrix24"""
-    try:
-        response = requests.get(f"{WEBHOOK_URL}crm.contact.get", params={"ID": contact_id})
-        if response.status_code == 200:
-            data = response.json()
-            return data.get('result', {})
-    except Exception as e:
-        logging.error(f"Error getting contact info: {e}")
-    return None
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)  # секунды
+SERVER_TIMING = os.environ.get('SERVER_TIMING', '0') == '1'  # Заголовок Server-Timing с разбивкой по методам
 
-def update_contact(contact_id, fields):
-    """Update contact in Bitrix24"""
-    try:
-        response = requests.post(
-            f"{WEBHOOK_URL}crm.contact.update",
-            json={"ID": contact_id, "fields": fields}
-        )
-        return response.status_code == 200
-    except Exception as e:
-        logging.error(f"Error updating contact: {e}")
-        return False
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
 
-def update_deal(deal_id, fields):
-    """Update deal in Bitrix24"""
-    try:
-        response = requests.post(
-            f"{WEBHOOK_URL}crm.deal.update",
-            json={"ID": deal_id, "fields": fields}
-        )
-        return response.status_code == 200
-    except Exception as e:
-        logging.error(f"Error updating deal: {e}")
-        return False
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape_label(value)}"' for key, value in labels) + '}'
 
-def get_timezone_from_city(city):
-    """Get timezone from city name"""
-    if not city:
-        return None
-    
-    city_lower = city.lower().strip()
-    
-    # Try direct match
-    if city_lower in CITY_TIMEZONES:
-        return CITY_TIMEZONES[city_lower]
-    
-    # Try translation
-    if city_lower in CITY_TRANSLATIONS:
-        translated_city = CITY_TRANSLATIONS[city_lower]
-        return CITY_TIMEZONES.get(translated_city)
-    
-    return None
+class Metrics:
+    """
+    Minimal in-process Prometheus registry: labelled counters and histograms
+    rendered in the text exposition format.
 
-@app.route('/health')
-def health():
-    """Health check endpoint"""
-    return jsonify({"status": "ok"})
+    Values live in this process only, so with several gunicorn workers each
+    scrape sees one worker (add the pid label on the Prometheus side or
+    scrape workers separately).
+    """
 
-@app.route('/', methods=['POST', 'GET'])
-@app.route('/webhook', methods=['POST', 'GET'])
-def webhook():
-    """Handle Bitrix24 webhook for deal creation/update"""
+    def __init__(self, buckets=METRICS_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.descriptions = OrderedDict()  # name -> (type, help)
+        self.counters = {}
+        self.histograms = {}
+
+    def describe(self, name, kind, help_text):
+        self.descriptions[name] = (kind, help_text)
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            state = series.get(key)
+            if state is None:
+                state = series[key] = [0] * len(self.buckets) + [0.0, 0]  # счётчики корзин, sum, count
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[i] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def render(self, gauges=()):
+        """Text exposition; gauges are (name, type, help, {labels_tuple: value}) computed by the caller"""
+        lines = []
+        with self.lock:
+            for name, (kind, help_text) in self.descriptions.items():
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                if kind == 'histogram':
+                    for labels, state in sorted(self.histograms.get(name, {}).items()):
+                        for bound, count in zip(self.buckets, state):
+                            lines.append(f"{name}_bucket{_format_labels(labels + (('le', bound),))} {count}")
+                        lines.append(f"{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {state[-1]}")
+                        lines.append(f"{name}_sum{_format_labels(labels)} {state[-2]:.6f}")
+                        lines.append(f"{name}_count{_format_labels(labels)} {state[-1]}")
+                else:
+                    for labels, value in sorted(self.counters.get(name, {}).items()):
+                        lines.append(f"{name}{_format_labels(labels)} {value}")
+        for name, kind, help_text, series in gauges:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in series.items():
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+metrics.describe('http_requests_total', 'counter', 'Requests handled, by route, HTTP method and status')
+metrics.describe('http_request_duration_seconds', 'histogram', 'Request handling time by route')
+metrics.describe('bitrix_requests_total', 'counter', 'Bitrix24 REST requests by method and outcome (ok or error code)')
+metrics.describe('bitrix_request_duration_seconds', 'histogram', 'Bitrix24 REST request time by method')
+metrics.describe('bitrix_retries_total', 'counter', 'Bitrix24 requests retried after an error')
+metrics.describe('bitrix_rate_limited_total', 'counter', 'QUERY_LIMIT_EXCEEDED responses from Bitrix24')
+metrics.describe('bitrix_throttle_seconds_total', 'counter', 'Time spent waiting for the client-side rate limit')
+metrics.describe('bitrix_throttle_rejected_total', 'counter', 'Requests failed because their rate limit slot was past the patience')
+metrics.describe('bitrix_batch_commands_total', 'counter', 'Commands sent inside batch requests, by method')
+metrics.describe('bitrix_batch_command_errors_total', 'counter', 'Failed commands inside batch requests, by method')
+metrics.describe('webhook_stage_duration_seconds', 'histogram', 'Webhook handler time by handler and stage')
+
+# Разбивка времени текущего запроса для Server-Timing (только синхронная обработка)
+_request_timing = threading.local()
+
+def record_timing(name, seconds):
+    """Add time spent in `name` to the current request's Server-Timing breakdown"""
+    entries = getattr(_request_timing, 'entries', None)
+    if entries is not None:
+        entry = entries.setdefault(name, [0.0, 0])
+        entry[0] += seconds
+        entry[1] += 1
+
+@contextlib.contextmanager
+def timed_stage(handler, stage):
+    """Time one stage of a handler (fetch, duplicates, write): histogram series and Server-Timing entry"""
+    started = time.perf_counter()
     try:
-        # Log raw request for debugging
-        logging.info(f"Received request: method={request.method}, content_type={request.content_type}")
-        logging.info(f"Request args: {request.args}")
-        logging.info(f"Request form: {request.form}")
-        logging.info(f"Request headers: {dict(request.headers)}")
-        
-        # Get deal ID from request
-        data = {}
-        if request.is_json:
-            data = request.json or {}
-        else:
-            data = request.form.to_dict()
-            # Also check query parameters
-            data.update(request.args.to_dict())
-        
-        logging.info(f"Parsed data: {data}")
-        
-        # Try different formats Bitrix24 might send
-        deal_id = None
-        
-        # Format 1: document_id[2] = "DEAL_123"
-        if 'document_id[2]' in data:
-            doc_id = data.get('document_id[2]', '')
-            if doc_id.startswith('DEAL_'):
-                deal_id = doc_id.replace('DEAL_', '')
-        
-        # Format 2: Standard webhook formats
-        if not deal_id:
-            deal_id = (data.get('FIELDS[ID]') or 
-                      data.get('data[FIELDS][ID]') or 
-                      data.get('deal_id') or
-                      data.get('ID') or
-                      data.get('id'))
-        
-        # Format 3: Check if there's a PLACEMENT parameter (automation call)
-        # In this case, we need to extract deal ID from somewhere else
-        if not deal_id and 'PLACEMENT' in data:
-            # This is likely an automation call without deal ID
-            # We'll need to get the deal ID from the context
-            logging.info("Automation call detected, but no deal ID found")
-            # Try to get from document_type
-            if 'document_type' in data:
-                # This might give us hints about what to do
-                logging.info(f"Document type: {data.get('document_type')}")
-        
-        if not deal_id:
-            logging.warning(f"No deal ID in request. Full data: {data}")
-            return jsonify({"status": "error", "message": "No deal ID provided"}), 400
-        
-        logging.info(f"Processing deal {deal_id}")
-        
-        # Get deal information
-        deal = get_deal_info(deal_id)
-        if not deal:
-            return jsonify({"status": "error", "message": "Deal not found"}), 404
-        
-        contact_id = deal.get('CONTACT_ID')
-        if not contact_id:
-            logging.warning(f"No contact linked to deal {deal_id}")
-            return jsonify({"status": "error", "message": "No contact linked to deal"}), 400
-        
-        # Get contact information
-        contact = get_contact_info(contact_id)
-        if not contact:
-            return jsonify({"status": "error", "message": "Contact not found"}), 404
-        
-        # Process contact data
-        contact_updates = {}
-        
-        # Get phone number
-        phones = contact.get('PHONE', [])
-        phone = None
-        if phones and isinstance(phones, list) and len(phones) > 0:
-            phone = phones[0].get('VALUE', '')
-        
-        # Generate messenger links if phone exists
-        normalized_phone = None
-        if phone:
-            normalized_phone = normalize_phone(phone)
-            if normalized_phone:
-                # WhatsApp link
-                contact_updates['UF_CRM_WHATSAPP_LINK'] = f"https://wa.me/{normalized_phone}"
-                
-                # Telegram link
-                contact_updates['UF_CRM_TELEGRAM_LINK'] = f"https://t.me/+{normalized_phone}"
-                
-                logging.info(f"Generated links for contact {contact_id} with phone {normalized_phone}")
-        
-        # Update contact if there are changes
-        if contact_updates:
-            update_contact(contact_id, contact_updates)
-        
-        # Process deal data
-        deal_updates = {}
-        
-        # Get city from deal - try multiple sources
-        city = None
-        
-        # 1. Try to get from deal fields
-        city = deal.get('UF_CRM_CITY') or deal.get('UF_CRM_694F054732342')
-        
-        # 2. If not found, try to extract from deal comments
-        if not city:
-            deal_comments = deal.get('COMMENTS', '')
-            if deal_comments:
-                city = extract_city_from_text(deal_comments)
-                if city:
-                    logging.info(f"Extracted city '{city}' from deal comments")
-                    # Update the city field in deal
-                    deal_updates['UF_CRM_CITY'] = city.title()
-        
-        # 3. If still not found, try to extract from contact comments
-        if not city:
-            contact_comments = contact.get('COMMENTS', '')
-            if contact_comments:
-                city = extract_city_from_text(contact_comments)
-                if city:
-                    logging.info(f"Extracted city '{city}' from contact comments")
-                    # Update the city field in deal
-                    deal_updates['UF_CRM_CITY'] = city.title()
-        
-        # Set timezone based on city
-        if city:
-            timezone = get_timezone_from_city(city)
-            if timezone:
-                deal_updates['UF_CRM_TIMEZONE'] = timezone
-                logging.info(f"Set timezone {timezone} for city {city}")
-            else:
-                logging.warning(f"No timezone found for city: {city}")
-        
-        # Generate phone links for deal
-        if phone and normalized_phone:
-            # Old text fields (keep for backward compatibility)
-            deal_updates['UF_CRM_CALL_LINK'] = f"tel:+{normalized_phone}"
-            deal_updates['UF_CRM_1767001460714'] = f"https://wa.me/{normalized_phone}"  # Ссылка на вацап
-            deal_updates['UF_CRM_1767001473947'] = f"https://t.me/+{normalized_phone}"  # ссылка на тг
-            
-            # New clickable URL fields
-            deal_updates['UF_CRM_WHATSAPP_URL'] = f"https://wa.me/{normalized_phone}"  # WhatsApp (кликабельная)
-            deal_updates['UF_CRM_TELEGRAM_URL'] = f"https://t.me/+{normalized_phone}"  # Telegram (кликабельная)
-        
-        # Update deal title: "Name - Job Title"
-        contact_name = contact.get('NAME', '') + ' ' + (contact.get('LAST_NAME', '') or '')
-        contact_name = contact_name.strip()
-        
-        job_title = deal.get('TITLE', '')
-        
-        # Don't update title if it already contains contact name
-        if contact_name and job_title and contact_name not in job_title:
-            new_title = f"{contact_name} - {job_title}"
-            deal_updates['TITLE'] = new_title
-            logging.info(f"Updated deal title to: {new_title}")
-        
-        # Update deal if there are changes
-        if deal_updates:
-            success = update_deal(deal_id, deal_updates)
-            if success:
-                logging.info(f"Successfully updated deal {deal_id} with fields: {list(deal_updates.keys())}")
-            else:
-                logging.error(f"Failed to update deal {deal_id}")
-        
-        return jsonify({"status": "success", "deal_id": deal_id, "updates": list(deal_updates.keys())})
-    
-    except Exception as e:
-        logging.error(f"Error processing webhook: {e}", exc_info=True)
-        return jsonify({"status": "error", "message": str(e)}), 500
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        metrics.observe('webhook_stage_duration_seconds', elapsed, handler=handler, stage=stage)
+        record_timing(f"{handler}_{stage}", elapsed)
+
+def _server_timing_header(entries, total):
+    parts = [f'{name};dur={seconds * 1000:.1f};desc="{count} calls"' for name, (seconds, count) in entries.items()]
+    parts.append(f'total;dur={total * 1000:.1f}')
+    return ', '.join(parts)
+
+@app.before_request
+def start_request_timer():
+    request.environ['app.started'] = time.perf_counter()
+    _request_timing.entries = {}
+
+@app.after_request
+def record_request_metrics(response):
+    started = request.environ.get('app.started')
+    entries = getattr(_request_timing, 'entries', None) or {}
+    _request_timing.entries = None
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    metrics.inc('http_requests_total', route=route, method=request.method, status=response.status_code)
+    metrics.observe('http_request_duration_seconds', elapsed, route=route)
+    if SERVER_TIMING:
+        response.headers['Server-Timing'] = _server_timing_header(entries, elapsed)
+    return response
 
 # ============================================================================
-# CONTACT UPDATE HANDLER - Создание ссылок при добавлении телефона
+# SQLITE STORES - локальные файлы состояния, общие для воркеров gunicorn
 # ============================================================================
 
-@app.route('/contact-update', methods=['POST', 'GET'])
-def contact_update():
+class SQLiteStore:
     """
-    Обработка изменения контакта - создание ссылок WhatsApp/Telegram при добавлении телефона.
-    
-    Вызывается триггером Битрикс24 при изменении контакта.
-    URL: /contact-update?contact_id={{ID}}
+    Base for the local SQLite stores: the connection is opened lazily (so
+    importing the module creates no files) and shared between threads under
+    a lock; WAL mode lets several gunicorn workers use the same file.
     """
-    try:
-        logging.info(f"Contact update request: method={request.method}")
-        logging.info(f"Request args: {request.args}")
-        logging.info(f"Request form: {request.form}")
-        
-        # Получаем contact_id из разных источников
-        data = {}
-        if request.is_json:
-            data = request.json or {}
-        else:
-            data = request.form.to_dict()
-            data.update(request.args.to_dict())
-        
-        contact_id = (data.get('contact_id') or 
-                      data.get('data[FIELDS][ID]') or 
-                      data.get('FIELDS[ID]') or 
-                      data.get('ID') or
-                      data.get('id'))
-        
-        if not contact_id:
-            logging.warning(f"No contact ID in request. Full data: {data}")
-            return jsonify({"status": "error", "message": "No contact ID provided"}), 400
-        
-        logging.info(f"Processing contact {contact_id}")
-        
-        # Получаем данные контакта
-        contact = get_contact_info(contact_id)
-        if not contact:
-            return jsonify({"status": "error", "message": "Contact not found"}), 404
-        
-        # Получаем телефон
-        phones = contact.get('PHONE', [])
-        phone = None
-        if phones and isinstance(phones, list) and len(phones) > 0:
-            phone = phones[0].get('VALUE', '')
-        
-        if not phone:
-            logging.info(f"Contact {contact_id} has no phone, skipping")
-            return jsonify({"status": "skipped", "message": "No phone in contact", "contact_id": contact_id})
-        
-        normalized_phone = normalize_phone(phone)
-        if not normalized_phone:
-            logging.warning(f"Could not normalize phone: {phone}")
-            return jsonify({"status": "error", "message": "Invalid phone number"}), 400
-        
-        # Генерируем ссылки
-        whatsapp_link = f"https://wa.me/{normalized_phone}"
-        telegram_link = f"https://t.me/+{normalized_phone}"
-        
-        # Обновляем контакт
-        contact_updates = {
-            'UF_CRM_WHATSAPP_LINK': whatsapp_link,
-            'UF_CRM_TELEGRAM_LINK': telegram_link
-        }
-        update_contact(contact_id, contact_updates)
-        logging.info(f"Updated contact {contact_id} with messenger links")
-        
-        # Находим все сделки, связанные с этим контактом
-        deals_updated = []
-        try:
-            response = requests.get(
-                f"{WEBHOOK_URL}crm.deal.list",
-                params={
-                    "filter[CONTACT_ID]": contact_id,
-                    "select[]": ["ID", "TITLE"]
-                }
-            )
-            deals = response.json().get('result', [])
-            
-            for deal in deals:
-                deal_id = deal.get('ID')
-                deal_updates = {
-                    'UF_CRM_CALL_LINK': f"tel:+{normalized_phone}",
-                    'UF_CRM_1767001460714': whatsapp_link,  # Ссылка на вацап
-                    'UF_CRM_1767001473947': telegram_link,  # ссылка на тг
-                    'UF_CRM_WHATSAPP_URL': whatsapp_link,   # WhatsApp (кликабельная)
-                    'UF_CRM_TELEGRAM_URL': telegram_link    # Telegram (кликабельная)
-                }
-                
-                # Также попробуем определить город и часовой пояс
-                city = contact.get('ADDRESS_CITY')
-                if city:
-                    deal_updates['UF_CRM_CITY'] = city
-                    timezone = get_timezone_from_city(city)
-                    if timezone:
-                        deal_updates['UF_CRM_TIMEZONE'] = timezone
-                
-                success = update_deal(deal_id, deal_updates)
-                if success:
-                    deals_updated.append(deal_id)
-                    logging.info(f"Updated deal {deal_id} with messenger links")
-        except Exception as e:
-            logging.error(f"Error updating deals for contact {contact_id}: {e}")
-        
-        return jsonify({
-            "status": "success",
-            "contact_id": contact_id,
-            "phone": normalized_phone,
-            "whatsapp": whatsapp_link,
-            "telegram": telegram_link,
-            "deals_updated": deals_updated
-        })
-    
-    except Exception as e:
-        logging.error(f"Error processing contact update: {e}", exc_info=True)
-        return jsonify({"status": "error", "message": str(e)}), 500
 
+    SCHEMA = ""
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = None
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        if self.conn is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript(self.SCHEMA)
+            self.conn = conn
+        return self.conn
 
 # ============================================================================
-# STALE DEALS CHECKER
+# PORTAL RATE LIMITER - token bucket на портал, общий для всех процессов
 # ============================================================================
 
-DAYS_THRESHOLD = 2  # Количество РАБОЧИХ дней без изменений
-EXCLUDED_STAGES = ["WON", "LOSE", "UC_3IJV6C"]  # Готов работать, Провал, Кадровый резерв
+BITRIX_RATE_LIMIT = float(os.environ.get('BITRIX_RATE_LIMIT', '2'))  # запросов в секунду на портал; 0 - отключить
+BITRIX_BURST = float(os.environ.get('BITRIX_BURST', '10'))           # запросов сверх лимита после простоя
+BITRIX_BULK_RESERVE = float(os.environ.get('BITRIX_BULK_RESERVE', str(BITRIX_BURST / 2)))  # токенов, недоступных фоновым задачам
+BITRIX_RATE_LIMIT_PATH = os.environ.get(
+    'BITRIX_RATE_LIMIT_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'rate_limit.sqlite3')
+)
+BITRIX_MIN_RATE = 0.2          # Ниже AIMD скорость не опускает
+BITRIX_RATE_INCREASE = 0.05    # +запросов/с после каждого успешного ответа
+BITRIX_RATE_DECREASE = 0.5     # Множитель скорости после QUERY_LIMIT_EXCEEDED
+BITRIX_BULK_POLL = 1.0         # Максимальная пауза фоновой очереди между попытками
 
-def count_business_days(start_date, end_date):
-    """Посчитать количество рабочих дней между двумя датами (исключая выходные)"""
-    business_days = 0
-    current_date = start_date
-    
-    while current_date < end_date:
-        if current_date.weekday() < 5:  # Monday to Friday
-            business_days += 1
-        current_date += timedelta(days=1)
-    
-    return business_days
+PRIORITY_INTERACTIVE = 'interactive'  # Вебхуки: ждут в очереди, но всегда получают токен
+PRIORITY_BULK = 'bulk'                # Проверка застрявших сделок, backfill: только из избытка
 
-def get_stage_name_for_notification(stage_id):
-    """Получить название стадии по ID"""
-    stage_names = {
-        "NEW": "Новый отклик",
-        "UC_S2PZ7V": "В обработке",
-        "PREPAYMENT_INVOICE": "Телефонное интервью",
-        "EXECUTING": "Перезвонить соискателю",
-        "FINAL_INVOICE": "Отправить инструкцию",
-        "UC_O7P21K": "Название",
-        "WON": "Готов работать",
-        "LOSE": "Провал",
-        "UC_3IJV6C": "Кадровый резерв"
-    }
-    return stage_names.get(stage_id, stage_id)
+bitrix_priority_var = contextvars.ContextVar('bitrix_priority', default=PRIORITY_INTERACTIVE)
 
-@app.route('/check-stale-deals', methods=['GET'])
-def check_stale_deals():
-    """Проверить застрявшие сделки и отправить уведомления менеджерам"""
-    
+@contextlib.contextmanager
+def bitrix_priority(lane):
+    """Run Bitrix24 calls made inside the block in the given lane"""
+    token = bitrix_priority_var.set(lane)
     try:
-        logging.info("Starting stale deals check...")
-        
-        # Получить все открытые сделки
-        deals = []
-        start = 0
-        
+        yield
+    finally:
+        bitrix_priority_var.reset(token)
+
+class PortalRateLimiter(SQLiteStore):
+    """
+    Token bucket for the portal shared by every process on the host.
+
+    Bitrix24 allows about 2 requests per second per portal with a small
+    burst, whichever worker sends them. The bucket (tokens, refill rate,
+    last update) lives in one SQLite row, updated under BEGIN IMMEDIATE, so
+    all gunicorn workers, background jobs and backfill.py draw from the same
+    budget.
+
+    Interactive calls always take a token and, if the bucket is empty, sleep
+    until their slot (the bucket goes into debt, which orders them FIFO),
+    unless the slot is further away than the caller's `max_wait`: then they
+    take nothing and the caller fails fast instead of outsleeping its
+    worker timeout.
+    Bulk calls take a token only while more than `bulk_reserve` are left,
+    otherwise they wait and retry, so a stale scan never delays a webhook by
+    more than its own slot. The refill rate is AIMD: halved on
+    QUERY_LIMIT_EXCEEDED (someone else is also using the portal), then
+    raised back by `increase` per successful call up to `rate`.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS bucket (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            tokens REAL NOT NULL,
+            rate REAL NOT NULL,
+            updated_at REAL NOT NULL,
+            decreased_at REAL NOT NULL DEFAULT 0
+        );
+    """
+
+    def __init__(self, path=BITRIX_RATE_LIMIT_PATH, rate=BITRIX_RATE_LIMIT, burst=BITRIX_BURST,
+                 bulk_reserve=BITRIX_BULK_RESERVE, min_rate=BITRIX_MIN_RATE, increase=BITRIX_RATE_INCREASE,
+                 decrease=BITRIX_RATE_DECREASE):
+        super().__init__(path)
+        self.max_rate = rate
+        self.burst = max(burst, 1.0)
+        self.bulk_reserve = min(bulk_reserve, self.burst - 1)
+        self.min_rate = min(min_rate, rate)
+        self.increase = increase
+        self.decrease = decrease
+        self.current_rate = rate  # Последняя увиденная скорость: без записи в SQLite, пока она не снижена
+
+    def _update(self, change):
+        """Run change(tokens, rate, decreased_at, now) -> (tokens, rate, decreased_at, result) in one transaction"""
+        now = time.time()
+        with self.lock:
+            conn = self._connect()
+            with conn:
+                conn.execute('BEGIN IMMEDIATE')
+                row = conn.execute('SELECT tokens, rate, updated_at, decreased_at FROM bucket WHERE id = 1').fetchone()
+                if row:
+                    tokens, rate, updated_at, decreased_at = row
+                    rate = min(rate, self.max_rate)
+                    tokens = min(self.burst, tokens + max(now - updated_at, 0) * rate)
+                else:
+                    tokens, rate, decreased_at = self.burst, self.max_rate, 0.0
+                tokens, rate, decreased_at, result = change(tokens, rate, decreased_at, now)
+                conn.execute('INSERT OR REPLACE INTO bucket (id, tokens, rate, updated_at, decreased_at) '
+                             'VALUES (1, ?, ?, ?, ?)', (tokens, rate, now, decreased_at))
+        self.current_rate = rate
+        return result
+
+    def reserve(self, lane=PRIORITY_INTERACTIVE, max_wait=None):
+        """
+        Try to take a token. Returns (granted, wait): if granted, sleep `wait`
+        seconds and send; if not (bulk lane), sleep `wait` and try again.
+        (False, None) - the interactive slot is more than `max_wait` seconds away, no token taken.
+        """
+        def change(tokens, rate, decreased_at, now):
+            if lane == PRIORITY_BULK:
+                if tokens >= self.bulk_reserve + 1:
+                    return tokens - 1, rate, decreased_at, (True, 0.0)
+                return tokens, rate, decreased_at, (False, min((self.bulk_reserve + 1 - tokens) / rate,
+                                                              BITRIX_BULK_POLL))
+            wait = max((1 - tokens) / rate, 0.0)
+            if max_wait is not None and wait > max_wait:
+                return tokens, rate, decreased_at, (False, None)
+            return tokens - 1, rate, decreased_at, (True, wait)
+        return self._update(change)
+
+    def acquire(self, lane=None, max_wait=None):
+        """
+        Block until the calling thread may send a request; returns seconds waited,
+        or None if the interactive slot is more than `max_wait` seconds away.
+        """
+        lane = lane or bitrix_priority_var.get()
+        waited = 0.0
         while True:
-            response = requests.get(
-                f"{WEBHOOK_URL}crm.deal.list",
-                params={
-                    "start": start,
-                    "filter": {"CLOSED": "N"},
-                    "select": ["ID", "TITLE", "STAGE_ID", "ASSIGNED_BY_ID", "DATE_MODIFY", "MOVED_TIME"]
-                }
-            )
-            
-            result = response.json()
-            
-            if "result" in result and result["result"]:
-                deals.extend(result["result"])
-                start += 50
-                if len(result["result"]) < 50:
-                    break
-            else:
-                break
-        
-        logging.info(f"Found {len(deals)} open deals")
-        
-        # Проверить на застой
-        stale_deals = []
-        now = datetime.now()
-        
-        for deal in deals:
-            if deal.get("STAGE_ID") in EXCLUDED_STAGES:
-                continue
-            
-            date_modify_str = deal.get("DATE_MODIFY") or deal.get("MOVED_TIME")
-            if not date_modify_str:
-                continue
-            
+            granted, wait = self.reserve(lane, max_wait)
+            if wait is None:
+                return None
+            if wait > 0:
+                time.sleep(wait)
+                waited += wait
+            if granted:
+                return waited
+
+    def on_success(self):
+        """Additive increase, only while the rate is below the configured one"""
+        if self.current_rate >= self.max_rate:
+            return
+        self._update(lambda tokens, rate, decreased_at, now:
+                     (tokens, min(rate + self.increase, self.max_rate), decreased_at, None))
+
+    def on_rate_limited(self):
+        """Multiplicative decrease and an empty bucket; a burst of errors from several workers counts once"""
+        def change(tokens, rate, decreased_at, now):
+            if now - decreased_at < 1.0 / rate:
+                return min(tokens, 0.0), rate, decreased_at, rate
+            rate = max(rate * self.decrease, self.min_rate)
+            logging.warning("Bitrix24 rate limit hit, lowering request rate to %.2f/s", rate)
+            return min(tokens, 0.0), rate, now, rate
+        return self._update(change)
+
+    def stats(self):
+        with self.lock:
+            row = self._connect().execute('SELECT tokens, rate, updated_at FROM bucket WHERE id = 1').fetchone()
+        tokens, rate, updated_at = row or (self.burst, self.max_rate, time.time())
+        return {
+            "path": self.path,
+            "tokens": round(min(self.burst, tokens + max(time.time() - updated_at, 0) * rate), 2),
+            "rate": round(rate, 3),
+            "max_rate": self.max_rate,
+            "burst": self.burst,
+            "bulk_reserve": self.bulk_reserve,
+        }
+
+rate_limiter = PortalRateLimiter() if BITRIX_RATE_LIMIT > 0 else None
+
+# ============================================================================
+# BITRIX24 REST CLIENT - общий пул соединений, таймауты и повторы
+# ============================================================================
+
+BITRIX_CONNECT_TIMEOUT = 5   # секунд на установку соединения
+BITRIX_READ_TIMEOUT = 30     # секунд на ожидание ответа
+BITRIX_MAX_RETRIES = 3       # повторов после первой попытки
+BITRIX_BACKOFF = 0.5         # базовая задержка, удваивается с каждой попыткой
+BITRIX_POOL_SIZE = 10        # keep-alive соединений в пуле
+# Сколько секунд QUERY_LIMIT_EXCEEDED не расходует попытки (при rate_limiter): в фоне (задачи, backfill.py)
+# и внутри HTTP-запроса - там меньше таймаута воркера gunicorn (30 с по умолчанию), иначе воркер убьют
+BITRIX_RATE_LIMIT_PATIENCE = float(os.environ.get('BITRIX_RATE_LIMIT_PATIENCE', '60'))
+BITRIX_REQUEST_PATIENCE = float(os.environ.get('BITRIX_REQUEST_PATIENCE', '10'))
+
+class Bitrix24Error(Exception):
+    """Error returned by the Bitrix24 REST API (or a transport failure)"""
+
+    def __init__(self, code, description='', status_code=None):
+        super().__init__(f"{code}: {description}" if description else code)
+        self.code = code
+        self.description = description
+        self.status_code = status_code
+        self.retry_after = None
+
+def throttle_rejected(lane, patience):
+    """Ошибка для запроса, которому лимитер не даёт слот в пределах patience"""
+    metrics.inc('bitrix_throttle_rejected_total', lane=lane)
+    return Bitrix24Error('QUERY_LIMIT_EXCEEDED', f"No rate limit slot within {patience:.1f}s (client-side)")
+
+class Bitrix24Client:
+    """
+    Shared Bitrix24 REST client.
+
+    Keeps a pooled keep-alive Session so the TLS handshake is paid once per
+    connection, applies connect/read timeouts to every call and retries
+    transport errors, 5xx responses and QUERY_LIMIT_EXCEEDED with
+    exponential backoff. Every request first takes a token from the shared
+    PortalRateLimiter in the lane of the calling context; with the limiter
+    enabled QUERY_LIMIT_EXCEEDED is retried for BITRIX_RATE_LIMIT_PATIENCE
+    seconds (BITRIX_REQUEST_PATIENCE while serving an HTTP request) instead
+    of a fixed number of times, so updates are delayed rather than dropped.
+    The same patience caps the wait for a token: a call whose slot is further
+    away fails with QUERY_LIMIT_EXCEEDED right away.
+    """
+
+    RETRY_ERRORS = {'QUERY_LIMIT_EXCEEDED', 'INTERNAL_SERVER_ERROR', 'OPERATION_TIME_LIMIT'}
+
+    def __init__(self, base_url, connect_timeout=BITRIX_CONNECT_TIMEOUT, read_timeout=BITRIX_READ_TIMEOUT,
+                 max_retries=BITRIX_MAX_RETRIES, backoff=BITRIX_BACKOFF, pool_size=BITRIX_POOL_SIZE,
+                 limiter=rate_limiter):
+        self.base_url = base_url
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.limiter = limiter
+        self.max_rate = None  # доп. ограничение этого процесса, запросов в секунду (backfill.py --rate)
+        self.calls = 0
+        self._next_call_at = 0.0
+        self._rate_lock = threading.Lock()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def _sleep_before_retry(self, attempt, retry_after=None):
+        if retry_after:
+            delay = retry_after
+        else:
+            delay = self.backoff * (2 ** attempt) + random.uniform(0, self.backoff)
+        time.sleep(delay)
+
+    def _throttle(self, patience_until):
+        lane = bitrix_priority_var.get()
+        waited = 0.0
+        if self.limiter:
+            patience = max(patience_until - time.monotonic(), 0.0)
+            waited = self.limiter.acquire(lane, max_wait=patience)
+            if waited is None:
+                raise throttle_rejected(lane, patience)
+        if self.max_rate:
+            with self._rate_lock:
+                now = time.monotonic()
+                wait = self._next_call_at - now
+                self._next_call_at = max(now, self._next_call_at) + 1.0 / self.max_rate
+            if wait > 0:
+                time.sleep(wait)
+                waited += wait
+        if waited > 0:
+            metrics.inc('bitrix_throttle_seconds_total', waited, lane=lane)
+
+    def _record(self, method, started, outcome):
+        elapsed = time.perf_counter() - started
+        metrics.inc('bitrix_requests_total', method=method, outcome=outcome)
+        metrics.observe('bitrix_request_duration_seconds', elapsed, method=method)
+        if outcome == 'QUERY_LIMIT_EXCEEDED':
+            metrics.inc('bitrix_rate_limited_total', method=method)
+        record_timing(method, elapsed)
+        if self.limiter:
+            if outcome == 'ok':
+                self.limiter.on_success()
+            elif outcome == 'QUERY_LIMIT_EXCEEDED':
+                self.limiter.on_rate_limited()
+
+    def call(self, method, params=None, timeout=None):
+        """Call a REST method and return the decoded JSON response; raises Bitrix24Error"""
+        url = f"{self.base_url}{method}"
+        last_error = None
+        attempt = 0
+        patience = BITRIX_REQUEST_PATIENCE if has_request_context() else BITRIX_RATE_LIMIT_PATIENCE
+        patience_until = time.monotonic() + patience
+
+        while attempt <= self.max_retries:
+            if last_error:
+                logging.warning("Retrying %s (attempt %s) after error: %s", method, attempt + 1, last_error)
+                metrics.inc('bitrix_retries_total', method=method)
+                # После QUERY_LIMIT_EXCEEDED паузу задаёт лимитер (корзина опустошена, скорость снижена)
+                if last_error.retry_after or not (self.limiter and last_error.code == 'QUERY_LIMIT_EXCEEDED'):
+                    self._sleep_before_retry(max(attempt - 1, 0), last_error.retry_after)
+
+            self._throttle(patience_until)
+            self.calls += 1
+            started = time.perf_counter()
             try:
-                date_modify = datetime.fromisoformat(date_modify_str.replace("+03:00", ""))
-                business_days_stale = count_business_days(date_modify, now)
-                
-                if business_days_stale >= DAYS_THRESHOLD:
-                    days_stale = (now - date_modify).days
-                    stale_deals.append({
-                        "id": deal["ID"],
-                        "title": deal.get("TITLE", "Без названия"),
-                        "stage_id": deal.get("STAGE_ID"),
-                        "assigned_by_id": deal.get("ASSIGNED_BY_ID"),
-                        "days_stale": days_stale,
-                        "business_days_stale": business_days_stale,
-                        "last_modified": date_modify.strftime("%d.%m.%Y %H:%M")
-                    })
-            except Exception as e:
-                logging.error(f"Error processing deal {deal.get('ID')}: {e}")
+                response = self.session.post(url, json=params or {}, timeout=timeout or self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                last_error = Bitrix24Error(type(e).__name__, str(e))
+                self._record(method, started, last_error.code)
+                attempt += 1
                 continue
-        
-        logging.info(f"Found {len(stale_deals)} stale deals")
-        
-        if not stale_deals:
-            return jsonify({"status": "success", "message": "No stale deals found", "count": 0})
-        
-        # Сгруппировать по менеджерам
-        grouped = {}
-        for deal in stale_deals:
-            manager_id = deal["assigned_by_id"]
-            if manager_id not in grouped:
-                grouped[manager_id] = []
-            grouped[manager_id].append(deal)
-        
-        # Отправить уведомления
-        notifications_sent = 0
-        
-        for manager_id, deals_list in grouped.items():
-            message = f"⏰ У вас {len(deals_list)} сделок без изменений более {DAYS_THRESHOLD} рабочих дней:\n\n"
-            
-            for deal in deals_list:
-                message += f"📋 Сделка #{deal['id']}: {deal['title']}\n"
-                message += f"   Стадия: {get_stage_name_for_notification(deal['stage_id'])}\n"
-                message += f"   Без изменений: {deal['business_days_stale']} раб. дн. ({deal['days_stale']} календ. дн., с {deal['last_modified']})\n"
-                message += f"   Ссылка: https://hr-adv.bitrix24.ru/crm/deal/details/{deal['id']}/\n\n"
-            
-            message += "Пожалуйста, обработайте эти сделки или переведите на следующую стадию."
-            
+
             try:
-                response = requests.post(
-                    f"{WEBHOOK_URL}im.notify",
-                    json={"to": manager_id, "message": message, "type": "USER"}
-                )
-                
-                if "result" in response.json():
-                    notifications_sent += 1
-                    logging.info(f"Notification sent to user {manager_id}")
+                data = response.json()
+            except ValueError:
+                data = {}
+
+            if isinstance(data, dict) and 'error' in data:
+                error = Bitrix24Error(data['error'], data.get('error_description', ''), response.status_code)
+            elif response.status_code >= 400:
+                error = Bitrix24Error(f"HTTP_{response.status_code}", response.text[:200], response.status_code)
+            else:
+                self._record(method, started, 'ok')
+                return data
+
+            self._record(method, started, error.code or f"HTTP_{response.status_code}")
+            if error.code in self.RETRY_ERRORS or response.status_code >= 500:
+                retry_after = response.headers.get('Retry-After')
+                error.retry_after = float(retry_after) if retry_after and retry_after.isdigit() else None
+                last_error = error
+                # С лимитером отказ по лимиту портала - ожидание, а не неудачная попытка, но не дольше patience
+                if self.limiter and error.code == 'QUERY_LIMIT_EXCEEDED':
+                    if time.monotonic() >= patience_until:
+                        raise error
+                else:
+                    attempt += 1
+                continue
+            raise error
+
+        raise last_error
+
+bitrix = Bitrix24Client(WEBHOOK_URL)
+
+# ============================================================================
+# ENTITY READS - одна сущность через crm.*.list с проекцией полей
+# ============================================================================
+
+def projection_params(entity_id, select):
+    """
+    crm.*.list params that read one entity with only the selected fields.
+    crm.*.get always returns every standard and UF field (hundreds of keys on
+    our portal); a filtered list with select returns just what the handlers use.
+    """
+    return {"filter": {"ID": entity_id}, "select": list(select), "start": -1}
+
+def first_with_id(items, entity_id):
+    """The item with the given ID from a crm.*.list result, or None"""
+    for item in items or []:
+        if str(item.get('ID')) == str(entity_id):
+            return item
+    return None
+
+# ============================================================================
+# BATCH REQUESTS - несколько вызовов REST API за один запрос
+# ============================================================================
+
+BATCH_LIMIT = 50      # Максимум команд в одном batch-запросе Bitrix24
+LIST_PAGE_SIZE = 50   # Bitrix24 отдаёт списки страницами по 50 записей
+
+def _flatten_params(value, prefix, pairs):
+    """Flatten nested dicts/lists into PHP-style keys: fields[TITLE], select[0]"""
+    if isinstance(value, dict):
+        items = value.items()
+    elif isinstance(value, (list, tuple)):
+        items = enumerate(value)
+    else:
+        if isinstance(value, bool):
+            value = 'Y' if value else 'N'
+        pairs.append((prefix, '' if value is None else str(value)))
+        return
+    for key, item in items:
+        _flatten_params(item, f"{prefix}[{key}]" if prefix else str(key), pairs)
+
+def build_query(params):
+    """Encode params as a query string for a batch command (keeps $result[...] references readable)"""
+    pairs = []
+    _flatten_params(params or {}, None, pairs)
+    return urlencode(pairs, safe='$[]')
+
+def _as_dict(value):
+    """Bitrix24 (PHP) returns an empty list instead of an empty object"""
+    return value if isinstance(value, dict) else {}
+
+class BitrixBatch:
+    """
+    Collects REST calls and sends them through the `batch` method, up to 50 per request.
+
+    Commands can reference earlier results in the same request, e.g.
+    batch.add('contact', 'crm.contact.get', {'ID': '$result[deal][CONTACT_ID]'}).
+    """
+
+    def __init__(self, halt=False):
+        self.halt = halt
+        self.commands = []
+
+    def __len__(self):
+        return len(self.commands)
+
+    def add(self, name, method, params=None):
+        self.commands.append((name, method, params or {}))
+        return name
+
+    def execute(self):
+        """Run all queued commands. Returns (results, errors) keyed by command name."""
+        results, errors = {}, {}
+        for i in range(0, len(self.commands), BATCH_LIMIT):
+            chunk = self.commands[i:i + BATCH_LIMIT]
+            cmd = {
+                name: f"{method}?{build_query(params)}" if params else method
+                for name, method, params in chunk
+            }
+            methods = {name: method for name, method, _ in chunk}
+            for method in methods.values():
+                metrics.inc('bitrix_batch_commands_total', method=method)
+            try:
+                data = bitrix.call('batch', {"halt": 1 if self.halt else 0, "cmd": cmd})
+            except Bitrix24Error as e:
+                logging.error("Error executing batch request: %s", e)
+                for name in cmd:
+                    errors[name] = str(e)
+                    metrics.inc('bitrix_batch_command_errors_total', method=methods[name])
+                continue
+
+            batch_result = _as_dict(data.get('result'))
+            chunk_errors = _as_dict(batch_result.get('result_error'))
+            results.update(_as_dict(batch_result.get('result')))
+            errors.update(chunk_errors)
+            for name in chunk_errors:
+                metrics.inc('bitrix_batch_command_errors_total', method=methods.get(name, 'unknown'))
+
+        if errors:
+            logging.warning("Batch commands failed: %s", errors)
+        return results, errors
+
+def keyset_page_params(filter=None, select=None, last_id=0):
+    """Params for one keyset page of a crm.*.list method: the next 50 items with ID > last_id"""
+    select = list(select or ['*'])
+    if 'ID' not in select and '*' not in select:
+        select.append('ID')
+    page_filter = dict(filter or {})
+    page_filter['>ID'] = last_id
+    return {"order": {"ID": "ASC"}, "filter": page_filter, "select": select, "start": -1}
+
+def iter_list(method, filter=None, select=None, start_id=0):
+    """
+    Stream every item of a crm.*.list method.
+
+    Uses keyset pagination (order by ID, filter ID > last seen, start=-1),
+    which skips the COUNT(*) Bitrix24 runs for offset pages and stays fast
+    on deep pages. Items are yielded page by page, nothing is accumulated.
+    Pass start_id to resume after a given ID.
+    """
+    last_id = int(start_id or 0)
+    
+    while True:
+        result = bitrix.call(method, keyset_page_params(filter, select, last_id))
+        items = result.get('result') or []
+        yield from items
+        
+        if len(items) < LIST_PAGE_SIZE:
+            break
+        last_id = int(items[-1]['ID'])
+
+def iter_deals(filter=None, select=None, start_id=0):
+    """Stream deals matching the filter (see iter_list)"""
+    return iter_list('crm.deal.list', filter, select, start_id)
+
+def fetch_deal_with_contact(deal_id):
+    """Get deal and its contact in one round trip (contact ID is chained from the deal)"""
+    batch = BitrixBatch()
+    batch.add('deal', 'crm.deal.list', projection_params(deal_id, DEAL_READ_SELECT))
+    batch.add('contact', 'crm.contact.list', projection_params('$result[deal][0][CONTACT_ID]', CONTACT_SELECT))
+    results, _ = batch.execute()
+    deal = first_with_id(results.get('deal'), deal_id)
+    # Без сделки или без контакта в ней ссылка пустая: сверяем ID, а не берём первую запись
+    contact = first_with_id(results.get('contact'), deal.get('CONTACT_ID')) if deal else None
+    return deal, contact
+
+# ============================================================================
+# CITY RESOLUTION - падежи, транслитерация и опечатки в названиях городов
+# ============================================================================
+
+CITY_PREFIX_REGEX = re.compile(r'^(?:г\.?|гор\.|город|city(?: of)?)\s+|\s+г\.?$')
+CITY_NOISE_REGEX = re.compile(r'\(.*?\)|,.*$|[^\w\s\-]')
+
+TRANSLIT = {
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e', 'ж': 'zh', 'з': 'z',
+    'и': 'i', 'й': 'y', 'к': 'k', 'л': 'l', 'м': 'm', 'н': 'n', 'о': 'o', 'п': 'p',
+    'р': 'r', 'с': 's', 'т': 't', 'у': 'u', 'ф': 'f', 'х': 'kh', 'ц': 'ts', 'ч': 'ch',
+    'ш': 'sh', 'щ': 'shch', 'ъ': '', 'ы': 'y', 'ь': '', 'э': 'e', 'ю': 'yu', 'я': 'ya',
+}
+
+def normalize_city_name(name):
+    """Lowercase, drop "г."/"город" and punctuation, unify ё and separators"""
+    name = name.lower().replace('ё', 'е').strip()
+    name = CITY_NOISE_REGEX.sub('', name)
+    name = CITY_PREFIX_REGEX.sub('', name.strip())
+    name = re.sub(r'\s*-\s*', '-', name)
+    return re.sub(r'\s+', ' ', name).strip()
+
+def city_key(name):
+    """Lookup key of a city name: "Ростов-на-Дону", "ростов на дону" and "Ростов - на - Дону" share one"""
+    return normalize_city_name(name).replace('-', ' ')
+
+def _decline_word(word):
+    """Косвенные падежи (род., дат., вин., твор., предл.) для слова из названия города"""
+    if len(word) < 3:
+        return []
+    if word.endswith(('ый', 'ой')):
+        stem = word[:-2]
+        return [stem + 'ого', stem + 'ому', stem + 'ым', stem + 'ом']
+    if word.endswith('ий'):
+        stem = word[:-2]
+        if stem.endswith('н'):
+            return [stem + 'его', stem + 'ему', stem + 'им', stem + 'ем']
+        return [stem + 'ого', stem + 'ому', stem + 'им', stem + 'ом']
+    if word.endswith('ая'):
+        stem = word[:-2]
+        return [stem + 'ой', stem + 'ую']
+    if word.endswith('а'):
+        stem = word[:-1]
+        genitive = 'и' if stem[-1] in 'гкхжшчщ' else 'ы'
+        return [stem + genitive, stem + 'е', stem + 'у', stem + 'ой', stem + 'ою']
+    if word.endswith('я'):
+        stem = word[:-1]
+        return [stem + 'и', stem + 'е', stem + 'ю', stem + 'ей']
+    if word.endswith('ь'):
+        stem = word[:-1]
+        # Женский (Казань) и мужской (Ярославль) род
+        return [stem + 'и', stem + 'ью', stem + 'я', stem + 'ю', stem + 'ем', stem + 'е']
+    if word[-1] in 'оеиуюэ':
+        return []  # Кемерово, Сочи, Улан-Удэ не склоняются
+    return [word + 'а', word + 'у', word + 'ом', word + 'е']
+
+def _declensions(name):
+    """All case forms of a (possibly multi-word or hyphenated) city name"""
+    words = name.split(' ')
+    if len(words) > 1:
+        # "нижний новгород" -> "нижнем новгороде": склоняем все слова в одном падеже
+        declined = [_decline_word(word) for word in words]
+        if all(len(forms) >= 4 for forms in declined):
+            adjective_cases = lambda forms: [forms[0], forms[1], forms[2], forms[3]]
+            noun_cases = lambda forms: [forms[0], forms[-3] if len(forms) > 4 else forms[1], forms[-2], forms[-1]]
+            by_case = [adjective_cases(f) if w.endswith(('ий', 'ый', 'ой')) else noun_cases(f)
+                       for w, f in zip(words, declined)]
+            return [' '.join(case_forms) for case_forms in zip(*by_case)]
+        return []
+    head, sep, tail = name.partition('-на-')
+    if sep:
+        # "ростов-на-дону" -> "ростове-на-дону": склоняется первая часть
+        return [form + sep + tail for form in _decline_word(head)]
+    head, sep, tail = name.rpartition('-')
+    return [head + sep + form for form in _decline_word(tail)]
+
+def _transliterations(name):
+    """Latin spellings of a Russian city name: Нижний -> nizhniy, nizhny, nizhnii"""
+    base = ''.join(TRANSLIT.get(char, char) for char in name)
+    variants = {base}
+    variants.add(re.sub(r'(iy|yy)\b', 'y', base))
+    variants.add(re.sub(r'(iy|yy)\b', 'ii', base))
+    variants.update(variant.replace('kh', 'h') for variant in list(variants))
+    return variants
+
+def _trigrams(text):
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def _edit_distance(a, b, limit):
+    """Levenshtein distance, or limit + 1 as soon as it is known to exceed limit"""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+def _build_city_index():
+    """
+    Map every known spelling to its canonical Russian city name.
+
+    Priority (earlier wins): exact names, English translations, case forms,
+    transliterations, first word of multi-word names ("нижний", "nizhny").
+    Forms are generated from hyphenated names (only the part before "-на-" or
+    after the last hyphen declines), then keyed by city_key.
+    """
+    spellings = {}
+    for city in CITY_TIMEZONES:
+        spellings.setdefault(normalize_city_name(city), city)
+    for name, city in CITY_TRANSLATIONS.items():
+        spellings.setdefault(normalize_city_name(name), city)
+    russian = [(name, city) for name, city in spellings.items() if re.search('[а-я]', name)]
+    for name, city in russian:
+        for form in _declensions(name):
+            spellings.setdefault(form, city)
+    for name, city in russian:
+        for variant in _transliterations(name):
+            spellings.setdefault(variant, city)
+    for name, city in list(spellings.items()):
+        first_word = name.split(' ')[0]
+        if ' ' in name and len(first_word) >= 4:
+            spellings.setdefault(first_word, city)
+    
+    index = {}
+    for name, city in spellings.items():
+        index.setdefault(name.replace('-', ' '), city)
+    
+    trigram_index = {}
+    for key in index:
+        for gram in _trigrams(key):
+            trigram_index.setdefault(gram, []).append(key)
+    return index, trigram_index
+
+CITY_INDEX, CITY_TRIGRAM_INDEX = _build_city_index()
+
+def _fuzzy_city(name):
+    """Closest indexed spelling by edit distance among keys sharing trigrams"""
+    # Короткие названия слишком легко спутать (Орск/Омск)
+    if len(name) < 5:
+        return None
+    limit = 1 if len(name) < 8 else 2
+    shared = {}
+    for gram in _trigrams(name):
+        for key in CITY_TRIGRAM_INDEX.get(gram, ()):
+            shared[key] = shared.get(key, 0) + 1
+    candidates = sorted(shared, key=shared.get, reverse=True)[:20]
+    best, best_distance = None, limit + 1
+    for key in candidates:
+        distance = _edit_distance(name, key, limit)
+        if distance < best_distance:
+            best, best_distance = key, distance
+    return CITY_INDEX[best] if best else None
+
+@lru_cache(maxsize=4096)
+def resolve_city(city, fuzzy=True):
+    """Canonical Russian city name for any spelling we can recognise, or None"""
+    if not city:
+        return None
+    name = city_key(city)
+    if not name:
+        return None
+    return CITY_INDEX.get(name) or (_fuzzy_city(name) if fuzzy else None)
+
+# ============================================================================
+# GAZETTEER - большой справочник городов в бинарном файле (mmap)
+# ============================================================================
+
+GAZETTEER_PATH = os.environ.get(
+    'GAZETTEER_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'gazetteer.bin')
+)
+
+class Gazetteer:
+    """
+    Read-only city -> timezone label lookup over a file built by build_gazetteer.py.
+
+    The file is memory-mapped, so gunicorn workers share the same page cache
+    instead of each holding a copy, and opening it only reads the header.
+
+    Layout (little-endian):
+      header  b'GZT1', n_keys, n_labels, index_offset, labels_offset, blob_offset (uint32)
+      index   n_keys x (key_offset uint32, key_len uint16, label_id uint16), sorted by key bytes
+      labels  n_labels x (offset uint32, len uint16)
+      blob    UTF-8 keys and labels
+    """
+
+    MAGIC = b'GZT1'
+    HEADER = struct.Struct('<4s5I')
+    ENTRY = struct.Struct('<IHH')
+    LABEL = struct.Struct('<IH')
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.size, n_labels, self.index_offset, labels_offset, self.blob_offset = \
+            self.HEADER.unpack_from(self.mm, 0)
+        if magic != self.MAGIC:
+            raise ValueError(f"{path} is not a gazetteer file")
+        self.labels = []
+        for i in range(n_labels):
+            offset, length = self.LABEL.unpack_from(self.mm, labels_offset + i * self.LABEL.size)
+            start = self.blob_offset + offset
+            self.labels.append(self.mm[start:start + length].decode('utf-8'))
+
+    def __len__(self):
+        return self.size
+
+    def _key(self, i):
+        offset, length, label_id = self.ENTRY.unpack_from(self.mm, self.index_offset + i * self.ENTRY.size)
+        start = self.blob_offset + offset
+        return self.mm[start:start + length], label_id
+
+    def lookup(self, name):
+        """Timezone label for a city_key, or None (binary search over the index)"""
+        target = name.encode('utf-8')
+        low, high = 0, self.size
+        while low < high:
+            middle = (low + high) // 2
+            key, label_id = self._key(middle)
+            if key < target:
+                low = middle + 1
+            elif key > target:
+                high = middle
+            else:
+                return self.labels[label_id]
+        return None
+
+_gazetteer = None
+_gazetteer_lock = threading.Lock()
+
+def get_gazetteer():
+    """Open the gazetteer on first use; None if the file is missing"""
+    global _gazetteer
+    if _gazetteer is None:
+        with _gazetteer_lock:
+            if _gazetteer is None:
+                try:
+                    _gazetteer = Gazetteer(GAZETTEER_PATH)
+                    logging.info("Loaded gazetteer %s with %s names", GAZETTEER_PATH, len(_gazetteer))
+                except FileNotFoundError:
+                    logging.info("Gazetteer %s not found, using built-in cities only", GAZETTEER_PATH)
+                    _gazetteer = False
+    return _gazetteer or None
+
+@lru_cache(maxsize=4096)
+def lookup_gazetteer_timezone(city):
+    """Timezone label from the gazetteer, or None"""
+    gazetteer = get_gazetteer()
+    if not gazetteer or not city:
+        return None
+    name = city_key(city)
+    return gazetteer.lookup(name) if name else None
+
+def get_timezone_from_city(city):
+    """Get timezone from city name"""
+    # Known city or its spelling variant, then the full gazetteer, then typo correction
+    canonical = resolve_city(city, fuzzy=False)
+    if not canonical:
+        timezone = lookup_gazetteer_timezone(city)
+        if timezone:
+            return timezone
+        canonical = resolve_city(city)
+    return CITY_TIMEZONES.get(canonical) if canonical else None
+
+# ============================================================================
+# ENRICHMENT RULES - какие поля читать, как преобразовывать и куда писать
+# ============================================================================
+
+ENRICHMENT_RULES_PATH = os.environ.get('ENRICHMENT_RULES_PATH', '')  # JSON/YAML; пусто - встроенные правила
+
+# Встроенные правила повторяют прежнюю логику build_updates / contact_deal_updates.
+#   values - именованные значения: список выражений, берётся первое непустое
+#   fields - target <- value, пишется только если все require непусты и все unless пусты
+# Выражение: "deal.FIELD", "contact.FIELD", "$value" или шаблон "...{deal.FIELD}...{$value}...",
+# после "|" - цепочка преобразований из RULE_TRANSFORMS.
+DEFAULT_ENRICHMENT_RULES = {
+    # Событие по сделке (/webhook, backfill.py)
+    "deal": {
+        "values": {
+            "phone": "contact.PHONE|first_valid_phone",
+            "city_field": ["deal.UF_CRM_CITY", "deal.UF_CRM_694F054732342"],
+            "city_text": ["deal.COMMENTS|city_from_text", "contact.COMMENTS|city_from_text"],
+            "city": ["$city_field", "$city_text"],
+            "contact_name": "{contact.NAME} {contact.LAST_NAME}|strip",
+        },
+        "fields": [
+            {"target": "contact.UF_CRM_WHATSAPP_LINK", "value": "https://wa.me/{$phone}", "require": ["$phone"]},
+            {"target": "contact.UF_CRM_TELEGRAM_LINK", "value": "https://t.me/+{$phone}", "require": ["$phone"]},
+            {"target": "deal.UF_CRM_CITY", "value": "$city_text|title", "unless": ["$city_field"]},
+            {"target": "deal.UF_CRM_TIMEZONE", "value": "$city|timezone"},
+            {"target": "deal.UF_CRM_CALL_LINK", "value": "tel:+{$phone}", "require": ["$phone"]},
+            {"target": "deal.UF_CRM_1767001460714", "value": "https://wa.me/{$phone}", "require": ["$phone"]},
+            {"target": "deal.UF_CRM_1767001473947", "value": "https://t.me/+{$phone}", "require": ["$phone"]},
+            {"target": "deal.UF_CRM_WHATSAPP_URL", "value": "https://wa.me/{$phone}", "require": ["$phone"]},
+            {"target": "deal.UF_CRM_TELEGRAM_URL", "value": "https://t.me/+{$phone}", "require": ["$phone"]},
+            {"target": "deal.TITLE", "value": "{$contact_name} - {deal.TITLE}",
+             "require": ["$contact_name", "deal.TITLE"], "unless_contains": ["deal.TITLE", "$contact_name"]},
+        ],
+    },
+    # Событие по контакту (/contact-update): контакт и каждая из его сделок
+    "contact": {
+        "values": {
+            "phone": "contact.PHONE|first_valid_phone",
+        },
+        "fields": [
+            {"target": "contact.UF_CRM_WHATSAPP_LINK", "value": "https://wa.me/{$phone}", "require": ["$phone"]},
+            {"target": "contact.UF_CRM_TELEGRAM_LINK", "value": "https://t.me/+{$phone}", "require": ["$phone"]},
+            {"target": "deal.UF_CRM_CALL_LINK", "value": "tel:+{$phone}", "require": ["$phone"]},
+            {"target": "deal.UF_CRM_1767001460714", "value": "https://wa.me/{$phone}", "require": ["$phone"]},
+            {"target": "deal.UF_CRM_1767001473947", "value": "https://t.me/+{$phone}", "require": ["$phone"]},
+            {"target": "deal.UF_CRM_WHATSAPP_URL", "value": "https://wa.me/{$phone}", "require": ["$phone"]},
+            {"target": "deal.UF_CRM_TELEGRAM_URL", "value": "https://t.me/+{$phone}", "require": ["$phone"]},
+            {"target": "deal.UF_CRM_CITY", "value": "contact.ADDRESS_CITY"},
+            {"target": "deal.UF_CRM_TIMEZONE", "value": "contact.ADDRESS_CITY|timezone"},
+        ],
+    },
+}
+
+RULE_ENTITIES = ('deal', 'contact')
+RULE_PLACEHOLDER_REGEX = re.compile(r'\{([^{}]+)\}')
+
+def _first_valid_phone(phones):
+    phone = pick_contact_phone({'PHONE': phones})
+    return phone.digits if phone else None
+
+RULE_TRANSFORMS = {
+    'first_valid_phone': _first_valid_phone,
+    'city_from_text': extract_city_from_text,
+    'timezone': get_timezone_from_city,
+    'title': lambda value: str(value).title(),
+    'strip': lambda value: str(value).strip(),
+    'lower': lambda value: str(value).lower(),
+    'upper': lambda value: str(value).upper(),
+}
+
+class RuleContext:
+    """One deal/contact pair; named values are computed on first use and memoized"""
+
+    def __init__(self, rule_set, deal, contact, values):
+        self.rule_set = rule_set
+        self.entities = {'deal': deal or {}, 'contact': contact or {}}
+        self.values = dict(values)
+
+    def value(self, name):
+        if name not in self.values:
+            self.values[name] = None
+            for source in self.rule_set.values[name]:
+                result = source(self)
+                if result:
+                    self.values[name] = result
+                    break
+        return self.values[name]
+
+class RuleSet:
+    """
+    A rule set compiled once into closures, plus the fields it reads.
+
+    apply(deal, contact) returns (contact_updates, deal_updates) without any
+    API calls; select(entity) is the minimal field list the rules read or
+    write for that entity (written fields are read too, for diff_fields).
+    """
+
+    def __init__(self, name, rules):
+        self.name = name
+        self.rules = rules
+        self.fields_read = {entity: {'ID': None} for entity in RULE_ENTITIES}
+        self.fields_read['deal']['CONTACT_ID'] = None
+        self.values = {}
+        for value_name, sources in (rules.get('values') or {}).items():
+            if isinstance(sources, str):
+                sources = [sources]
+            # Значение может ссылаться только на уже объявленные (так исключены циклы)
+            self.values[value_name] = [self._compile(source) for source in sources]
+        self.fields = [self._compile_field(field) for field in rules.get('fields') or []]
+
+    def select(self, entity):
+        return list(self.fields_read[entity])
+
+    def _field_ref(self, ref):
+        entity, _, field = ref.partition('.')
+        if entity not in RULE_ENTITIES or not field:
+            raise ValueError(f"Rule set {self.name}: unknown field reference {ref!r}")
+        self.fields_read[entity][field] = None
+        return entity, field
+
+    def _compile_ref(self, ref):
+        ref = ref.strip()
+        if ref.startswith('$'):
+            name = ref[1:]
+            if name not in self.values:
+                raise ValueError(f"Rule set {self.name}: value ${name} is used before it is defined")
+            return lambda context: context.value(name)
+        entity, field = self._field_ref(ref)
+        return lambda context: context.entities[entity].get(field)
+
+    def _compile(self, expression):
+        head, *transform_names = [part.strip() for part in expression.split('|')]
+        for transform_name in transform_names:
+            if transform_name not in RULE_TRANSFORMS:
+                raise ValueError(f"Rule set {self.name}: unknown transform {transform_name!r}")
+        transforms = [RULE_TRANSFORMS[transform_name] for transform_name in transform_names]
+
+        if '{' in head:
+            # "a{x}b{y}" -> split даёт ['a', 'x', 'b', 'y', ''], нечётные элементы - ссылки
+            pieces = RULE_PLACEHOLDER_REGEX.split(head)
+            parts = [self._compile_ref(piece) if i % 2 else piece for i, piece in enumerate(pieces)]
+            def source(context):
+                return ''.join(part if isinstance(part, str) else str(part(context) or '') for part in parts)
+        else:
+            source = self._compile_ref(head)
+
+        if not transforms:
+            return source
+        def transformed(context):
+            value = source(context)
+            for transform in transforms:
+                if not value:
+                    return None
+                value = transform(value)
+            return value
+        return transformed
+
+    def _compile_field(self, field):
+        entity, target = self._field_ref(field['target'])
+        value = self._compile(field['value'])
+        require = [self._compile(expression) for expression in field.get('require', [])]
+        unless = [self._compile(expression) for expression in field.get('unless', [])]
+        unless_contains = field.get('unless_contains')
+        if unless_contains:
+            haystack, needle = (self._compile(expression) for expression in unless_contains)
+        def apply(context):
+            for check in require:
+                if not check(context):
+                    return None
+            for check in unless:
+                if check(context):
+                    return None
+            if unless_contains and str(needle(context) or '') in str(haystack(context) or ''):
+                return None
+            return value(context)
+        return entity, target, apply
+
+    def apply(self, deal, contact, **values):
+        """Compute updates for one deal/contact pair; keyword values skip their computation (e.g. phone)"""
+        context = RuleContext(self, deal, contact, values)
+        updates = {entity: {} for entity in RULE_ENTITIES}
+        for entity, target, apply in self.fields:
+            result = apply(context)
+            if result:
+                updates[entity][target] = result
+        logging.debug("Rules %s computed deal fields %s, contact fields %s",
+                      self.name, list(updates['deal']), list(updates['contact']))
+        return updates['contact'], updates['deal']
+
+def load_enrichment_rules(path=ENRICHMENT_RULES_PATH):
+    """
+    Built-in rules, with the rule sets defined in `path` (JSON, or YAML if
+    PyYAML is installed) replacing the built-in ones. A broken file raises
+    at import, so a bad mapping fails the deploy instead of corrupting deals.
+    """
+    rules = dict(DEFAULT_ENRICHMENT_RULES)
+    if path:
+        with open(path, encoding='utf-8') as f:
+            if path.endswith(('.yaml', '.yml')):
+                import yaml  # Опциональная зависимость, нужна только для YAML-правил
+                loaded = yaml.safe_load(f) or {}
+            else:
+                loaded = json.load(f)
+        if not isinstance(loaded, dict):
+            raise ValueError(f"{path}: expected a mapping of rule sets, got {type(loaded).__name__}")
+        # Только известные наборы: опечатка или "_comment" не должны молча пропадать
+        for name, rule_set in loaded.items():
+            if name not in DEFAULT_ENRICHMENT_RULES:
+                raise ValueError(f"{path}: unknown rule set {name!r}, expected one of "
+                                 f"{', '.join(DEFAULT_ENRICHMENT_RULES)}")
+            if not isinstance(rule_set, dict):
+                raise ValueError(f"{path}: rule set {name!r} must be a mapping with values/fields")
+        rules.update(loaded)
+        logging.info("Loaded enrichment rules from %s", path)
+    return {name: RuleSet(name, rule_set) for name, rule_set in rules.items()}
+
+ENRICHMENT_RULES = load_enrichment_rules()
+DEAL_RULES = ENRICHMENT_RULES['deal']
+CONTACT_RULES = ENRICHMENT_RULES['contact']
+
+@app.route('/rules', methods=['GET'])
+def enrichment_rules():
+    """Действующие правила обогащения и поля, которые они читают"""
+    return jsonify({
+        "source": ENRICHMENT_RULES_PATH or "built-in",
+        "rule_sets": {
+            name: {"rules": rule_set.rules, "select": {entity: rule_set.select(entity) for entity in RULE_ENTITIES}}
+            for name, rule_set in ENRICHMENT_RULES.items()
+        },
+    })
+
+# ============================================================================
+# WEBHOOK HANDLERS - обработка событий по сделкам
+# ============================================================================
+
+@app.route('/health')
+def health():
+    """Health check endpoint"""
+    return jsonify({"status": "ok"})
+
+def get_request_data():
+    """Collect webhook parameters from JSON body, form data and query string"""
+    if request.is_json:
+        return request.json or {}
+    data = request.form.to_dict()
+    # Also check query parameters
+    data.update(request.args.to_dict())
+    return data
+
+def extract_deal_id(data):
+    """Find the deal ID in the different formats Bitrix24 might send"""
+    deal_id = None
+    
+    # Format 1: document_id[2] = "DEAL_123"
+    if 'document_id[2]' in data:
+        doc_id = data.get('document_id[2]', '')
+        if doc_id.startswith('DEAL_'):
+            deal_id = doc_id.replace('DEAL_', '')
+    
+    # Format 2: Standard webhook formats
+    if not deal_id:
+        deal_id = (data.get('FIELDS[ID]') or 
+                  data.get('data[FIELDS][ID]') or 
+                  data.get('deal_id') or
+                  data.get('ID') or
+                  data.get('id'))
+    
+    # Format 3: Check if there's a PLACEMENT parameter (automation call)
+    # In this case, we need to extract deal ID from somewhere else
+    if not deal_id and 'PLACEMENT' in data:
+        # This is likely an automation call without deal ID
+        # We'll need to get the deal ID from the context
+        logging.info("Automation call detected, but no deal ID found")
+        # Try to get from document_type
+        if 'document_type' in data:
+            # This might give us hints about what to do
+            logging.info("Document type: %s", data.get('document_type'))
+    
+    return deal_id
+
+def extract_contact_id(data):
+    """Find the contact ID in the different formats Bitrix24 might send"""
+    return (data.get('contact_id') or 
+            data.get('data[FIELDS][ID]') or 
+            data.get('FIELDS[ID]') or 
+            data.get('ID') or
+            data.get('id'))
+
+@app.route('/', methods=['POST', 'GET'])
+@app.route('/webhook', methods=['POST', 'GET'])
+def webhook():
+    """Handle Bitrix24 webhook for deal creation/update"""
+    try:
+        # Get deal ID from request (заголовки не логируем, payload - выборочно)
+        data = get_request_data()
+        log_payload("Webhook payload", data)
+        
+        deal_id = extract_deal_id(data)
+        logging.info("Webhook %s: deal %s", request.method, deal_id)
+        if not deal_id:
+            logging.warning("No deal ID in request. Full data: %s", redact_payload(data))
+            return jsonify({"status": "error", "message": "No deal ID provided"}), 400
+        
+        result, status_code = dispatch_event('deal', deal_id, process_deal)
+        return jsonify(result), status_code
+    
+    except Exception as e:
+        logging.error("Error processing webhook: %s", e, exc_info=True)
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+def diff_fields(current, updates):
+    """Keep only the updates whose values differ from what the entity already has"""
+    return {
+        field: value for field, value in updates.items()
+        if str(current.get(field) or '') != str(value or '')
+    }
+
+# Поля, которые читают и пишут правила обогащения (для select в списочных методах)
+DEAL_SELECT = list(dict.fromkeys(DEAL_RULES.select('deal') + CONTACT_RULES.select('deal')))
+CONTACT_SELECT = list(dict.fromkeys(DEAL_RULES.select('contact') + CONTACT_RULES.select('contact')))
+
+def build_updates(deal, contact):
+    """
+    Compute messenger links, city/timezone and title for a deal and its contact
+    with the "deal" enrichment rules. No API calls. Returns (contact_updates, deal_updates).
+    """
+    return DEAL_RULES.apply(deal, contact)
+
+def process_deal(deal_id):
+    """Fill messenger links, city/timezone and title for a deal. Returns (result, status_code)."""
+    logging.info("Processing deal %s", deal_id)
+    
+    # Get deal and contact information in one batch request
+    with timed_stage('deal', 'fetch'):
+        deal, contact = fetch_deal_with_contact(deal_id)
+    if not deal:
+        return {"status": "error", "message": "Deal not found"}, 404
+    record_deal_state(deal)
+    
+    contact_id = deal.get('CONTACT_ID')
+    if not contact_id:
+        logging.warning("No contact linked to deal %s", deal_id)
+        return {"status": "error", "message": "No contact linked to deal"}, 400
+    
+    if not contact:
+        return {"status": "error", "message": "Contact not found"}, 404
+    
+    contact_updates, deal_updates = build_updates(deal, contact)
+    
+    # Skip fields that already hold the computed values (our own updates fire ONCRMDEALUPDATE again)
+    contact_updates = diff_fields(contact, contact_updates)
+    deal_updates = diff_fields(deal, deal_updates)
+    if not contact_updates and not deal_updates:
+        logging.info("Deal %s is already up to date", deal_id)
+    
+    # Send contact and deal updates (and a duplicate warning, if any) in one batch request
+    writes = BitrixBatch()
+    if contact_updates:
+        writes.add('contact', 'crm.contact.update', {'ID': contact_id, 'fields': contact_updates})
+    if deal_updates:
+        writes.add('deal', 'crm.deal.update', {'ID': deal_id, 'fields': deal_updates})
+    with timed_stage('deal', 'duplicates'):
+        duplicates, claimed = check_duplicates(deal_id, contact_id, valid_contact_phones(contact), writes)
+    
+    if writes:
+        with timed_stage('deal', 'write'):
+            results, errors = writes.execute()
+        if claimed and 'duplicate_comment' in errors:
+            logging.error("Failed to add duplicate comment to deal %s: %s", deal_id, errors['duplicate_comment'])
+            phone_index.release_notes(deal_id, claimed)
+        if contact_updates and 'contact' in errors:
+            logging.error("Failed to update contact %s", contact_id)
+        if deal_updates:
+            if results.get('deal') and 'deal' not in errors:
+                logging.info("Successfully updated deal %s with fields: %s", deal_id, list(deal_updates.keys()))
+            else:
+                logging.error("Failed to update deal %s", deal_id)
+    
+    result = {"status": "success", "deal_id": deal_id, "updates": list(deal_updates.keys())}
+    if duplicates:
+        result["duplicate_contacts"] = duplicates
+    return result, 200
+
+# ============================================================================
+# CONTACT UPDATE HANDLER - Создание ссылок при добавлении телефона
+# ============================================================================
+
+@app.route('/contact-update', methods=['POST', 'GET'])
+def contact_update():
+    """
+    Обработка изменения контакта - создание ссылок WhatsApp/Telegram при добавлении телефона.
+    
+    Вызывается триггером Битрикс24 при изменении контакта.
+    URL: /contact-update?contact_id={{ID}}
+    """
+    try:
+        # Получаем contact_id из разных источников
+        data = get_request_data()
+        log_payload("Contact update payload", data)
+        contact_id = extract_contact_id(data)
+        logging.info("Contact update %s: contact %s", request.method, contact_id)
+        
+        if not contact_id:
+            logging.warning("No contact ID in request. Full data: %s", redact_payload(data))
+            return jsonify({"status": "error", "message": "No contact ID provided"}), 400
+        
+        result, status_code = dispatch_event('contact', contact_id, process_contact)
+        return jsonify(result), status_code
+    
+    except Exception as e:
+        logging.error("Error processing contact update: %s", e, exc_info=True)
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+def contact_link_updates(contact, normalized_phone):
+    """Ссылки мессенджеров для самого контакта по правилам "contact" (только изменившиеся поля)"""
+    contact_updates, _ = CONTACT_RULES.apply({}, contact, phone=normalized_phone)
+    return diff_fields(contact, contact_updates)
+
+def contact_deal_updates(contact, deal, normalized_phone):
+    """Ссылки и город/часовой пояс из адреса контакта для одной из его сделок (только изменившиеся поля)"""
+    _, deal_updates = CONTACT_RULES.apply(deal, contact, phone=normalized_phone)
+    return diff_fields(deal, deal_updates)
+
+def process_contact(contact_id):
+    """Создать ссылки мессенджеров в контакте и всех его сделках. Возвращает (result, status_code)."""
+    logging.info("Processing contact %s", contact_id)
+    
+    # Получаем контакт и первую страницу его сделок одним batch-запросом
+    batch = BitrixBatch()
+    batch.add('contact', 'crm.contact.list', projection_params(contact_id, CONTACT_SELECT))
+    batch.add('deals', 'crm.deal.list', keyset_page_params({'CONTACT_ID': contact_id}, DEAL_SELECT))
+    with timed_stage('contact', 'fetch'):
+        results, errors = batch.execute()
+    
+    contact = first_with_id(results.get('contact'), contact_id)
+    if not contact:
+        return {"status": "error", "message": "Contact not found"}, 404
+    
+    # Получаем телефоны и выбираем первый корректный
+    phones = normalize_phones(get_contact_phones(contact))
+    if not phones:
+        logging.info("Contact %s has no phone, skipping", contact_id)
+        return {"status": "skipped", "message": "No phone in contact", "contact_id": contact_id}, 200
+    
+    valid_phones = [phone for phone in phones if phone.status == PHONE_VALID]
+    if not valid_phones:
+        logging.warning("Could not normalize phones: %s", [phone.raw for phone in phones])
+        return {
+            "status": "error",
+            "message": "Invalid phone number",
+            "phones": [{"value": phone.raw, "status": phone.status} for phone in phones]
+        }, 400
+    
+    normalized_phone = valid_phones[0].digits
+    
+    # Обновляем контакт и все связанные сделки batch-запросами
+    writes = BitrixBatch()
+    contact_updates = contact_link_updates(contact, normalized_phone)
+    if contact_updates:
+        writes.add('contact', 'crm.contact.update', {'ID': contact_id, 'fields': contact_updates})
+    
+    deals = results.get('deals') or []
+    if 'deals' in errors:
+        logging.error("Error listing deals for contact %s: %s", contact_id, errors['deals'])
+    elif len(deals) == LIST_PAGE_SIZE:
+        # Кандидат откликался много раз: догружаем остальные страницы
+        with timed_stage('contact', 'deal_pages'):
+            deals = deals + list(iter_deals({'CONTACT_ID': contact_id}, DEAL_SELECT, deals[-1]['ID']))
+    
+    deals_to_update = []
+    deals_skipped = 0
+    deal_ids = []
+    for deal in deals:
+        deal_id = deal.get('ID')
+        deal_ids.append(deal_id)
+        
+        # Сделки, где ссылки уже актуальны, не трогаем
+        deal_updates = contact_deal_updates(contact, deal, normalized_phone)
+        if not deal_updates:
+            deals_skipped += 1
+            continue
+        
+        deals_to_update.append(deal_id)
+        writes.add(f"deal_{deal_id}", 'crm.deal.update', {'ID': deal_id, 'fields': deal_updates})
+    
+    # Пополняем индекс дубликатов всеми корректными телефонами контакта
+    try:
+        with timed_stage('contact', 'duplicates'):
+            phone_index.add_many((phone.digits, contact_id, deal_id)
+                                 for phone in valid_phones for deal_id in [0] + deal_ids)
+    except sqlite3.Error as e:
+        logging.error("Phone index error for contact %s: %s", contact_id, e)
+    
+    # BitrixBatch сам разобьёт команды на запросы по 50
+    with timed_stage('contact', 'write'):
+        write_results, write_errors = writes.execute()
+    if 'contact' in write_results and 'contact' not in write_errors:
+        logging.info("Updated contact %s with messenger links", contact_id)
+    
+    deals_updated = []
+    for deal_id in deals_to_update:
+        name = f"deal_{deal_id}"
+        if write_results.get(name) and name not in write_errors:
+            deals_updated.append(deal_id)
+            logging.info("Updated deal %s with messenger links", deal_id)
+        else:
+            logging.error("Failed to update deal %s: %s", deal_id, write_errors.get(name))
+    
+    return {
+        "status": "success",
+        "contact_id": contact_id,
+        "phone": normalized_phone,
+        "whatsapp": f"https://wa.me/{normalized_phone}",
+        "telegram": f"https://t.me/+{normalized_phone}",
+        "deals_updated": deals_updated,
+        "deals_skipped": deals_skipped
+    }, 200
+
+# ============================================================================
+# DUPLICATE CANDIDATES - индекс телефон -> контакты/сделки (SQLite)
+# ============================================================================
+
+PORTAL_URL = "https://hr-adv.bitrix24.ru"
+PHONE_INDEX_PATH = os.environ.get(
+    'PHONE_INDEX_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'phone_index.sqlite3')
+)
+DUPLICATE_COMMENTS = os.environ.get('DUPLICATE_COMMENTS', '1') == '1'  # Писать комментарий в сделку
+DUPLICATE_LINKS_LIMIT = 10                                             # Сколько контактов перечислять
+
+class PhoneIndex(SQLiteStore):
+    """
+    Normalized phone -> (contact_id, deal_id) pairs in a local SQLite file.
+
+    Filled from deal/contact events and by `backfill.py --phone-index`, so
+    finding other contacts with the same phone is a primary-key lookup
+    instead of a crm.contact.list search per event. deal_id is 0 for rows
+    that only know the contact. The noted table remembers which
+    (deal, contact) pairs were already reported, so a duplicate comment is
+    added to a deal once.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS phones (
+            phone TEXT NOT NULL,
+            contact_id INTEGER NOT NULL,
+            deal_id INTEGER NOT NULL DEFAULT 0,
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (phone, contact_id, deal_id)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS phones_contact ON phones (contact_id);
+        CREATE TABLE IF NOT EXISTS noted (
+            deal_id INTEGER NOT NULL,
+            contact_id INTEGER NOT NULL,
+            noted_at REAL NOT NULL,
+            PRIMARY KEY (deal_id, contact_id)
+        ) WITHOUT ROWID;
+    """
+
+    def __init__(self, path=PHONE_INDEX_PATH):
+        super().__init__(path)
+
+    def add_many(self, rows):
+        """Insert (phone, contact_id, deal_id) rows in one transaction; returns how many were given"""
+        now = time.time()
+        rows = [(phone, int(contact_id), int(deal_id or 0), now) for phone, contact_id, deal_id in rows if phone]
+        if not rows:
+            return 0
+        with self.lock:
+            conn = self._connect()
+            with conn:
+                conn.execute('BEGIN')
+                conn.executemany('INSERT OR REPLACE INTO phones VALUES (?, ?, ?, ?)', rows)
+        return len(rows)
+
+    def add(self, phone, contact_id, deal_ids=()):
+        """Index a contact phone, with its deals if known"""
+        rows = [(phone, contact_id, 0)] + [(phone, contact_id, deal_id) for deal_id in deal_ids]
+        return self.add_many(rows)
+
+    def lookup(self, phone):
+        """All (contact_id, deal_id) pairs indexed under the phone"""
+        with self.lock:
+            cursor = self._connect().execute(
+                'SELECT contact_id, deal_id FROM phones WHERE phone = ? ORDER BY contact_id, deal_id', (phone,)
+            )
+            return cursor.fetchall()
+
+    def other_contacts(self, phone, contact_id):
+        """Contact IDs other than contact_id that share the phone"""
+        contact_id = int(contact_id)
+        return sorted({other for other, _ in self.lookup(phone) if other != contact_id})
+
+    def claim_notes(self, deal_id, contact_ids):
+        """Record (deal, contact) pairs as reported; returns the contacts that were not reported before"""
+        now = time.time()
+        fresh = []
+        with self.lock:
+            conn = self._connect()
+            with conn:
+                conn.execute('BEGIN')
+                for contact_id in contact_ids:
+                    cursor = conn.execute('INSERT OR IGNORE INTO noted VALUES (?, ?, ?)',
+                                          (int(deal_id), int(contact_id), now))
+                    if cursor.rowcount:
+                        fresh.append(contact_id)
+        return fresh
+
+    def release_notes(self, deal_id, contact_ids):
+        """Forget claimed pairs whose comment could not be written, so the next event retries"""
+        with self.lock:
+            conn = self._connect()
+            with conn:
+                conn.execute('BEGIN')
+                conn.executemany('DELETE FROM noted WHERE deal_id = ? AND contact_id = ?',
+                                 [(int(deal_id), int(contact_id)) for contact_id in contact_ids])
+
+    def stats(self):
+        with self.lock:
+            conn = self._connect()
+            phones, rows = conn.execute('SELECT COUNT(DISTINCT phone), COUNT(*) FROM phones').fetchone()
+            noted = conn.execute('SELECT COUNT(*) FROM noted').fetchone()[0]
+        return {"path": self.path, "phones": phones, "rows": rows, "duplicates_noted": noted}
+
+phone_index = PhoneIndex()
+
+def build_duplicate_comment(contact_ids):
+    """Текст комментария в таймлайн сделки со ссылками на контакты с тем же телефоном"""
+    links = [f"{PORTAL_URL}/crm/contact/details/{contact_id}/" for contact_id in contact_ids[:DUPLICATE_LINKS_LIMIT]]
+    comment = "⚠️ Возможный дубликат: этот телефон уже есть у других контактов:\n" + "\n".join(links)
+    if len(contact_ids) > DUPLICATE_LINKS_LIMIT:
+        comment += f"\n...и ещё {len(contact_ids) - DUPLICATE_LINKS_LIMIT}"
+    return comment
+
+def valid_contact_phones(contact):
+    """Normalized digits of every valid phone of the contact"""
+    return [result.digits for result in normalize_phones(get_contact_phones(contact)) if result.status == PHONE_VALID]
+
+def check_duplicates(deal_id, contact_id, phones, writes):
+    """
+    Index the deal's phones and, if other contacts already have one of them,
+    queue a timeline comment on the deal into `writes`. Returns
+    (duplicates, claimed) where claimed are the contacts the queued comment reports.
+    """
+    if not phones:
+        return [], []
+    try:
+        phone_index.add_many([(phone, contact_id, deal_id) for phone in phones] +
+                             [(phone, contact_id, 0) for phone in phones])
+        duplicates = sorted({other for phone in phones for other in phone_index.other_contacts(phone, contact_id)})
+        claimed = phone_index.claim_notes(deal_id, duplicates) if duplicates and DUPLICATE_COMMENTS else []
+    except sqlite3.Error as e:
+        logging.error("Phone index error for deal %s: %s", deal_id, e)
+        return [], []
+    
+    if duplicates:
+        logging.info("Deal %s: phones %s also belong to contacts %s", deal_id, phones, duplicates)
+    if claimed:
+        writes.add('duplicate_comment', 'crm.timeline.comment.add', {'fields': {
+            'ENTITY_ID': deal_id,
+            'ENTITY_TYPE': 'deal',
+            'COMMENT': build_duplicate_comment(claimed),
+        }})
+    return duplicates, claimed
+
+# ============================================================================
+# BACKGROUND JOBS - асинхронная обработка вебхуков
+# ============================================================================
+
+ASYNC_WEBHOOKS = os.environ.get('ASYNC_WEBHOOKS', '0') == '1'  # Отвечать 202 и обрабатывать в фоне
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', '4'))          # Потоков-обработчиков
+JOB_HISTORY_SIZE = 1000                                         # Сколько завершённых задач помнить
+
+class JobQueue:
+    """
+    In-process job queue with a pool of worker threads.
+
+    Jobs are (kind, entity_id) pairs processed by a handler that returns
+    (result, status_code). Workers start lazily on the first submit so that
+    importing the module (CLI scripts, gunicorn preload) does not spawn threads.
+    """
+
+    def __init__(self, workers=JOB_WORKERS, history_size=JOB_HISTORY_SIZE):
+        self.workers = workers
+        self.history_size = history_size
+        self.queue = queue.Queue()
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+        self.threads = []
+        self.running = 0
+
+    def _start_workers(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f"job-worker-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, kind, entity_id, handler):
+        """Queue handler(entity_id) and return the job record"""
+        job = {
+            "id": uuid.uuid4().hex,
+            "kind": kind,
+            "entity_id": entity_id,
+            "status": "queued",
+            "created_at": time.time(),
+            "request_id": request_id_var.get(),
+        }
+        with self.lock:
+            if not self.threads:
+                self._start_workers()
+            self.jobs[job["id"]] = job
+            while len(self.jobs) > self.history_size:
+                self.jobs.popitem(last=False)
+        self.queue.put((job, handler))
+        logging.info("Queued %s job %s for %s", kind, job['id'], entity_id)
+        return job
+
+    def _worker(self):
+        while True:
+            job, handler = self.queue.get()
+            request_id_var.set(job.get("request_id"))
+            with self.lock:
+                job["status"] = "running"
+                job["started_at"] = time.time()
+                self.running += 1
+            try:
+                result, status_code = handler(job["entity_id"])
+                job["result"] = result
+                job["status_code"] = status_code
+                job["status"] = "done" if status_code < 400 else "failed"
             except Exception as e:
-                logging.error(f"Error sending notification to {manager_id}: {e}")
+                logging.error("Job %s failed: %s", job['id'], e, exc_info=True)
+                job["result"] = {"status": "error", "message": str(e)}
+                job["status"] = "failed"
+            finally:
+                with self.lock:
+                    job["finished_at"] = time.time()
+                    self.running -= 1
+                request_id_var.set(None)
+                self.queue.task_done()
+
+    def get(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job else None
+
+    def stats(self):
+        with self.lock:
+            counts = {}
+            for job in self.jobs.values():
+                counts[job["status"]] = counts.get(job["status"], 0) + 1
+            return {
+                "queue_depth": self.queue.qsize(),
+                "running": self.running,
+                "workers": len(self.threads),
+                "jobs": counts,
+            }
+
+job_queue = JobQueue()
+
+# ============================================================================
+# EVENT DEDUPLICATION - схлопывание повторных событий по одной сущности
+# ============================================================================
+
+DEDUP_WINDOW = float(os.environ.get('DEDUP_WINDOW_SECONDS', '15'))  # 0 - отключить
+
+class EventCoalescer:
+    """
+    Collapses a burst of events for the same entity into one trailing run.
+
+    The first event runs immediately. Events that arrive while that run is
+    in progress, or within DEDUP_WINDOW seconds after it finished, mark the
+    entity dirty. One more run then happens at the end of the window and
+    reads the latest state, so a change made during the burst is never lost.
+    The ONCRMDEALUPDATE echoes of our own crm.deal.update calls cost at most
+    one extra run, which diff_fields turns into a no-op.
+    """
+
+    def __init__(self, window=DEDUP_WINDOW, max_entries=10000):
+        self.window = window
+        self.max_entries = max_entries
+        self.active = set()
+        self.dirty = set()
+        self.scheduled = set()
+        self.finished = {}
+        self.lock = threading.Lock()
+        self.collapsed = 0
+
+    def claim(self, key):
+        """
+        Returns (run_now, delay). run_now: process the event now. Otherwise,
+        if delay is not None the caller schedules a trailing run in `delay`
+        seconds (see start); if it is None a pending run already covers the event.
+        """
+        if self.window <= 0:
+            return True, None
+        now = time.time()
+        with self.lock:
+            if key in self.active or key in self.scheduled:
+                if key in self.active:
+                    self.dirty.add(key)
+                self.collapsed += 1
+                return False, None
+            finished_at = self.finished.get(key)
+            if finished_at and now - finished_at < self.window:
+                self.scheduled.add(key)
+                self.collapsed += 1
+                return False, self.window - (now - finished_at)
+            self.active.add(key)
+            return True, None
+
+    def start(self, key):
+        """A scheduled trailing run is starting"""
+        with self.lock:
+            self.scheduled.discard(key)
+            self.active.add(key)
+
+    def release(self, key):
+        """The run finished. Returns the delay of the trailing run to schedule, or None."""
+        if self.window <= 0:
+            return None
+        now = time.time()
+        with self.lock:
+            self.active.discard(key)
+            self.finished[key] = now
+            if len(self.finished) > self.max_entries:
+                self.finished = {k: t for k, t in self.finished.items() if now - t < self.window}
+            if key in self.dirty:
+                self.dirty.discard(key)
+                self.scheduled.add(key)
+                return self.window
+            return None
+
+event_coalescer = EventCoalescer()
+
+def coalesced_response(kind, entity_id):
+    return {"status": "coalesced", "message": "Will be processed by a pending run", f"{kind}_id": entity_id}, 202
+
+def run_coalesced(kind, entity_id, handler):
+    """Run the handler, then schedule the trailing run if events arrived meanwhile"""
+    try:
+        return handler(entity_id)
+    finally:
+        delay = event_coalescer.release((kind, str(entity_id)))
+        if delay is not None:
+            schedule_trailing_run(kind, entity_id, handler, delay)
+
+def schedule_trailing_run(kind, entity_id, handler, delay):
+    """Queue one more run of the handler after `delay` seconds (it reads the latest state)"""
+    request_id = request_id_var.get()
+    
+    def fire():
+        event_coalescer.start((kind, str(entity_id)))
+        request_id_var.set(request_id)
+        job_queue.submit(kind, entity_id, lambda entity_id: run_coalesced(kind, entity_id, handler))
+        logging.info("Trailing %s run queued for %s", kind, entity_id)
+    
+    timer = threading.Timer(delay, fire)
+    timer.daemon = True
+    timer.start()
+
+def dispatch_event(kind, entity_id, handler):
+    """Coalesce an event, then process it now or queue it (ASYNC_WEBHOOKS). Returns (result, status_code)."""
+    run_now, delay = event_coalescer.claim((kind, str(entity_id)))
+    if not run_now:
+        if delay is not None:
+            schedule_trailing_run(kind, entity_id, handler, delay)
+        logging.info("Coalesced %s event for %s into a pending run", kind, entity_id)
+        return coalesced_response(kind, entity_id)
+    
+    if ASYNC_WEBHOOKS:
+        job = job_queue.submit(kind, entity_id, lambda entity_id: run_coalesced(kind, entity_id, handler))
+        return {"status": "accepted", "job_id": job['id'], f"{kind}_id": entity_id}, 202
+    
+    return run_coalesced(kind, entity_id, handler)
+
+@app.route('/jobs', methods=['GET'])
+def jobs_stats():
+    """Глубина очереди и количество задач по статусам"""
+    return jsonify({
+        "async_webhooks": ASYNC_WEBHOOKS,
+        "events_collapsed": event_coalescer.collapsed,
+        "trailing_runs_scheduled": len(event_coalescer.scheduled),
+        **job_queue.stats()
+    })
+
+@app.route('/cache', methods=['GET'])
+def cache_stats():
+    """Мемоизация городов, размер справочника и индекс телефонов"""
+    city_cache = resolve_city.cache_info()
+    return jsonify({
+        "city_resolver": {"size": city_cache.currsize, "hits": city_cache.hits, "misses": city_cache.misses},
+        "gazetteer_names": len(get_gazetteer() or ()),
+        "phone_index": phone_index.stats()
+    })
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Метрики в текстовом формате Prometheus"""
+    queue_stats = job_queue.stats()
+    city_cache = resolve_city.cache_info()
+    gauges = [
+        ('city_resolver_cache_hits_total', 'counter', 'resolve_city memo hits', {(): city_cache.hits}),
+        ('city_resolver_cache_misses_total', 'counter', 'resolve_city memo misses', {(): city_cache.misses}),
+        ('job_queue_depth', 'gauge', 'Jobs waiting for a worker', {(): queue_stats['queue_depth']}),
+        ('job_queue_running', 'gauge', 'Jobs being processed', {(): queue_stats['running']}),
+        ('jobs', 'gauge', 'Remembered jobs by status',
+         {(('status', status),): count for status, count in queue_stats['jobs'].items()}),
+        ('events_collapsed_total', 'counter', 'Webhook events merged into a pending run', {(): event_coalescer.collapsed}),
+    ]
+    if rate_limiter:
+        limiter_stats = rate_limiter.stats()
+        gauges += [
+            ('bitrix_rate_limit_tokens', 'gauge', 'Tokens left in the shared portal bucket',
+             {(): limiter_stats['tokens']}),
+            ('bitrix_rate_limit_rate', 'gauge', 'Current AIMD request rate, per second', {(): limiter_stats['rate']}),
+        ]
+    return metrics.render(gauges), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """Статус и результат фоновой задачи"""
+    job = job_queue.get(job_id)
+    if not job:
+        return jsonify({"status": "error", "message": "Job not found"}), 404
+    return jsonify(job)
+
+
+# ============================================================================
+# STALE DEALS CHECKER
+# ============================================================================
+
+DAYS_THRESHOLD = 2  # Количество РАБОЧИХ дней без изменений
+PORTAL_TZ_SUFFIX = "+03:00"  # Часовой пояс дат в ответах портала
+PRODUCTION_CALENDAR_PATH = os.environ.get(
+    'PRODUCTION_CALENDAR_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'production_calendar.json')
+)
+EXCLUDED_STAGES = ["WON", "LOSE", "UC_3IJV6C"]  # Готов работать, Провал, Кадровый резерв
+
+class BusinessCalendar:
+    """
+    Рабочие дни по производственному календарю.
+    
+    Рабочий день - понедельник-пятница, кроме праздников, плюс рабочие субботы
+    (переносы). Количество рабочих дней на отрезке считается за O(1) арифметикой
+    по неделям и двоичным поиском по отсортированным спискам исключений.
+    """
+
+    def __init__(self, holidays=(), workdays=()):
+        # Храним только исключения, меняющие результат: праздники в будни и рабочие выходные
+        self.holidays = sorted({d.toordinal() for d in holidays if d.weekday() < 5})
+        self.workdays = sorted({d.toordinal() for d in workdays if d.weekday() >= 5})
+
+    @classmethod
+    def load(cls, path):
+        """Загрузить календарь из JSON-файла {"holidays": [...], "workdays": [...]}"""
+        try:
+            with open(path, encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            logging.warning("Production calendar %s not found, using plain weekends", path)
+            return cls()
+        parse = lambda values: [date.fromisoformat(value) for value in values]
+        return cls(parse(data.get('holidays', [])), parse(data.get('workdays', [])))
+
+    @staticmethod
+    def _weekdays_before(ordinal):
+        # Число будних дней с ordinal 1 (понедельник, 0001-01-01) до ordinal, не включая его
+        weeks, rest = divmod(ordinal - 1, 7)
+        return weeks * 5 + min(rest, 5)
+
+    @staticmethod
+    def _count_in_range(ordinals, start, end):
+        return bisect_left(ordinals, end) - bisect_left(ordinals, start)
+
+    def is_business_day(self, day):
+        ordinal = day.toordinal()
+        if day.weekday() < 5:
+            return self._count_in_range(self.holidays, ordinal, ordinal + 1) == 0
+        return self._count_in_range(self.workdays, ordinal, ordinal + 1) == 1
+
+    def business_days(self, start_day, end_day):
+        """Количество рабочих дней в [start_day, end_day)"""
+        start, end = start_day.toordinal(), end_day.toordinal()
+        if end <= start:
+            return 0
+        return (self._weekdays_before(end) - self._weekdays_before(start)
+                - self._count_in_range(self.holidays, start, end)
+                + self._count_in_range(self.workdays, start, end))
+
+business_calendar = BusinessCalendar.load(PRODUCTION_CALENDAR_PATH)
+
+def count_business_days(start_date, end_date):
+    """Посчитать количество рабочих дней между двумя датами (исключая выходные и праздники)"""
+    if end_date <= start_date:
+        return 0
+    # Дни start_date + k (k = 0, 1, ...), пока они раньше end_date
+    delta = end_date - start_date
+    steps = delta.days + (1 if delta.seconds or delta.microseconds else 0)
+    first_day = start_date.date()
+    return business_calendar.business_days(first_day, first_day + timedelta(days=steps))
+
+def get_stale_cutoff(now):
+    """
+    Граница для фильтра <DATE_MODIFY: сделки, изменённые позже, не могут быть застрявшими.
+    
+    Это начало дня, следующего за последним днём D, для которого на отрезке
+    [D, сегодня] набирается DAYS_THRESHOLD рабочих дней. Точная проверка
+    остаётся за count_business_days, фильтр лишь отсекает заведомо свежие сделки.
+    """
+    day = now.date()
+    counted = 0
+    while True:
+        if business_calendar.is_business_day(day):
+            counted += 1
+            if counted >= DAYS_THRESHOLD:
+                break
+        day -= timedelta(days=1)
+    return datetime.combine(day + timedelta(days=1), datetime.min.time())
+
+def get_stage_name_for_notification(stage_id):
+    """Получить название стадии по ID"""
+    stage_names = {
+        "NEW": "Новый отклик",
+        "UC_S2PZ7V": "В обработке",
+        "PREPAYMENT_INVOICE": "Телефонное интервью",
+        "EXECUTING": "Перезвонить соискателю",
+        "FINAL_INVOICE": "Отправить инструкцию",
+        "UC_O7P21K": "Название",
+        "WON": "Готов работать",
+        "LOSE": "Провал",
+        "UC_3IJV6C": "Кадровый резерв"
+    }
+    return stage_names.get(stage_id, stage_id)
+
+def get_stale_info(deal, now):
+    """Вернуть данные для уведомления, если сделка застряла, иначе None"""
+    if deal.get("STAGE_ID") in EXCLUDED_STAGES:
+        return None
+    
+    date_modify_str = deal.get("DATE_MODIFY") or deal.get("MOVED_TIME")
+    if not date_modify_str:
+        return None
+    
+    try:
+        date_modify = datetime.fromisoformat(date_modify_str.replace(PORTAL_TZ_SUFFIX, ""))
+        business_days_stale = count_business_days(date_modify, now)
         
-        return jsonify({
-            "status": "success",
-            "stale_deals_count": len(stale_deals),
-            "notifications_sent": notifications_sent,
-            "managers_notified": list(grouped.keys())
+        if business_days_stale >= DAYS_THRESHOLD:
+            days_stale = (now - date_modify).days
+            return {
+                "id": deal["ID"],
+                "title": deal.get("TITLE", "Без названия"),
+                "stage_id": deal.get("STAGE_ID"),
+                "assigned_by_id": deal.get("ASSIGNED_BY_ID"),
+                "days_stale": days_stale,
+                "business_days_stale": business_days_stale,
+                "last_modified": date_modify.strftime("%d.%m.%Y %H:%M")
+            }
+    except Exception as e:
+        logging.error("Error processing deal %s: %s", deal.get('ID'), e)
+    return None
+
+def build_stale_message(deals_list):
+    """Текст уведомления менеджеру со списком его застрявших сделок"""
+    message = f"⏰ У вас {len(deals_list)} сделок без изменений более {DAYS_THRESHOLD} рабочих дней:\n\n"
+    
+    for deal in deals_list:
+        message += f"📋 Сделка #{deal['id']}: {deal['title']}\n"
+        message += f"   Стадия: {get_stage_name_for_notification(deal['stage_id'])}\n"
+        message += f"   Без изменений: {deal['business_days_stale']} раб. дн. ({deal['days_stale']} календ. дн., с {deal['last_modified']})\n"
+        message += f"   Ссылка: {PORTAL_URL}/crm/deal/details/{deal['id']}/\n\n"
+    
+    message += "Пожалуйста, обработайте эти сделки или переведите на следующую стадию."
+    return message
+
+def queue_stale_notifications(grouped, batch):
+    """Добавить в batch по одному im.notify на каждого менеджера"""
+    for manager_id, deals_list in grouped.items():
+        batch.add(f"notify_{manager_id}", 'im.notify', {
+            "to": manager_id,
+            "message": build_stale_message(deals_list),
+            "type": "USER"
         })
+    return batch
+
+def send_stale_notifications(grouped):
+    """
+    Отправить уведомления всем менеджерам через batch (до 50 im.notify за запрос).
+    Возвращает результат по каждому менеджеру: {manager_id: {"status", "deals", "error"}}.
+    """
+    results, errors = queue_stale_notifications(grouped, BitrixBatch()).execute()
+    return summarize_notifications(grouped, results, errors)
+
+def summarize_notifications(grouped, results, errors):
+    """Результат отправки по каждому менеджеру из ответа batch-запроса"""
+    report = {}
+    for manager_id, deals_list in grouped.items():
+        name = f"notify_{manager_id}"
+        if results.get(name) and name not in errors:
+            report[manager_id] = {"status": "sent", "deals": len(deals_list)}
+            logging.info("Notification sent to user %s", manager_id)
+        else:
+            error = errors.get(name)
+            if isinstance(error, dict):
+                error = error.get('error_description') or error.get('error')
+            report[manager_id] = {"status": "failed", "deals": len(deals_list), "error": error or "No result"}
+            logging.error("Error sending notification to %s: %s", manager_id, error)
+    return report
+
+STALE_DEAL_SELECT = ["ID", "TITLE", "STAGE_ID", "ASSIGNED_BY_ID", "DATE_MODIFY", "MOVED_TIME"]
+
+def stale_deals_filter(now):
+    """Фильтр crm.deal.list: открытые сделки вне исключённых стадий, не менявшиеся до порога"""
+    return {
+        "CLOSED": "N",
+        "!STAGE_ID": EXCLUDED_STAGES,
+        "<DATE_MODIFY": get_stale_cutoff(now).strftime("%Y-%m-%dT%H:%M:%S") + PORTAL_TZ_SUFFIX
+    }
+
+class StaleDealsGroup:
+    """
+    Застрявшие сделки, сгруппированные по ответственному, по мере чтения потока сделок.
+    policy(stale) решает, нужно ли уведомлять о сделке; без policy уведомляем обо всех.
+    """
+
+    def __init__(self, now, policy=None):
+        self.now = now
+        self.policy = policy
+        self.scanned = 0
+        self.stale_count = 0
+        self.suppressed = 0
+        self.by_manager = {}
+
+    def add(self, deal):
+        self.scanned += 1
+        stale = get_stale_info(deal, self.now)
+        if not stale:
+            return
+        self.stale_count += 1
+        if self.policy and not self.policy(stale):
+            self.suppressed += 1
+            return
+        self.by_manager.setdefault(stale["assigned_by_id"], []).append(stale)
+
+    def log_summary(self):
+        logging.info("Scanned %s candidate deals (modified before %s), found %s stale deals, %s already notified",
+                     self.scanned, get_stale_cutoff(self.now), self.stale_count, self.suppressed)
+
+def stale_check_result(grouped, notifications):
+    """Ответ /check-stale-deals после отправки уведомлений"""
+    return {
+        "status": "success",
+        "stale_deals_count": grouped.stale_count,
+        "already_notified": grouped.suppressed,
+        "notifications_sent": sum(1 for item in notifications.values() if item["status"] == "sent"),
+        "managers_notified": list(grouped.by_manager.keys()),
+        "notifications": notifications
+    }
+
+# ============================================================================
+# STALE STATE STORE - последнее известное состояние сделок (SQLite)
+# ============================================================================
+
+STALE_STATE_PATH = os.environ.get(
+    'STALE_STATE_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'stale_state.sqlite3')
+)  # Пустая строка - без хранилища, полный скан при каждой проверке
+STALE_NOTIFY_MODE = os.environ.get('STALE_NOTIFY_MODE', 'escalate')  # escalate | new | all
+STALE_ESCALATION_DAYS = sorted(
+    {int(days) for days in os.environ.get('STALE_ESCALATION_DAYS', f'{DAYS_THRESHOLD},5,10').split(',') if days.strip()}
+)  # Пороги в рабочих днях, на каждом из которых менеджер получает напоминание
+STALE_SYNC_OVERLAP = timedelta(minutes=10)  # Перекрытие инкрементального скана на случай расхождения часов
+STALE_STATE_SELECT = STALE_DEAL_SELECT + ["CLOSED"]
+# Сделка из вебхука идёт и в правила обогащения, и в record_deal_state
+DEAL_READ_SELECT = list(dict.fromkeys(DEAL_SELECT + STALE_STATE_SELECT))
+
+def escalation_level(business_days):
+    """Сколько порогов STALE_ESCALATION_DAYS сделка уже прошла"""
+    return sum(1 for days in STALE_ESCALATION_DAYS if business_days >= days)
+
+class StaleStateStore(SQLiteStore):
+    """
+    Last seen title/stage/responsible/DATE_MODIFY of every deal, plus the
+    escalation level the responsible manager was last notified at.
+
+    Kept current by deal webhooks and by incremental crm.deal.list scans
+    filtered by >DATE_MODIFY since the previous run, so a stale check reads
+    only the deals modified since then and finds candidates with an indexed
+    query. A deal whose DATE_MODIFY changes starts over at level 0.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS deals (
+            id INTEGER PRIMARY KEY,
+            title TEXT,
+            stage_id TEXT,
+            assigned_by_id TEXT,
+            closed INTEGER NOT NULL DEFAULT 0,
+            date_modify TEXT NOT NULL,
+            seen_at REAL NOT NULL,
+            notified_level INTEGER NOT NULL DEFAULT 0,
+            notified_at REAL
+        );
+        CREATE INDEX IF NOT EXISTS deals_open_modify ON deals (closed, date_modify);
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+    """
+
+    def __init__(self, path=STALE_STATE_PATH):
+        super().__init__(path)
+
+    def record_many(self, deals):
+        """Upsert deals as returned by crm.deal.get/list; deals without DATE_MODIFY are ignored"""
+        now = time.time()
+        rows = [
+            (int(deal['ID']), deal.get('TITLE'), deal.get('STAGE_ID'), deal.get('ASSIGNED_BY_ID'),
+             1 if deal.get('CLOSED') == 'Y' else 0, deal['DATE_MODIFY'], now)
+            for deal in deals if deal.get('ID') and deal.get('DATE_MODIFY')
+        ]
+        if not rows:
+            return 0
+        with self.lock:
+            conn = self._connect()
+            with conn:
+                conn.execute('BEGIN')
+                conn.executemany("""
+                    INSERT INTO deals (id, title, stage_id, assigned_by_id, closed, date_modify, seen_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (id) DO UPDATE SET
+                        title = COALESCE(excluded.title, title),
+                        stage_id = COALESCE(excluded.stage_id, stage_id),
+                        assigned_by_id = COALESCE(excluded.assigned_by_id, assigned_by_id),
+                        closed = excluded.closed,
+                        notified_level = CASE WHEN excluded.date_modify = date_modify THEN notified_level ELSE 0 END,
+                        date_modify = excluded.date_modify,
+                        seen_at = excluded.seen_at
+                """, rows)
+        return len(rows)
+
+    def delete(self, deal_ids):
+        with self.lock:
+            conn = self._connect()
+            with conn:
+                conn.execute('BEGIN')
+                conn.executemany('DELETE FROM deals WHERE id = ?', [(int(deal_id),) for deal_id in deal_ids])
+
+    def get_meta(self, key):
+        with self.lock:
+            row = self._connect().execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        with self.lock:
+            self._connect().execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, value))
+
+    def sync_filter(self):
+        """(crm.deal.list filter, watermark) for the next sync: modified since the last one, or all open deals"""
+        watermark = self.get_meta('watermark')
+        if watermark:
+            since = datetime.fromisoformat(watermark.replace(PORTAL_TZ_SUFFIX, '')) - STALE_SYNC_OVERLAP
+            return {">DATE_MODIFY": since.strftime("%Y-%m-%dT%H:%M:%S") + PORTAL_TZ_SUFFIX}, watermark
+        return {"CLOSED": "N"}, watermark
+
+    def record_synced(self, page, watermark):
+        """Store one page of the sync; returns (deals recorded, advanced watermark)"""
+        watermark = max([watermark or ''] + [item.get('DATE_MODIFY') or '' for item in page])
+        return self.record_many(page), watermark
+
+    def finish_sync(self, synced, watermark):
+        if watermark:
+            self.set_meta('watermark', watermark)
+        logging.info("Stale state sync read %s deals, watermark %s", synced, watermark)
+
+    def sync(self):
+        """
+        Pull deals modified since the last sync (all open deals on the first
+        run). Returns how many deals were read.
+        """
+        filter, watermark = self.sync_filter()
+        synced = 0
+        page = []
+        for deal in iter_deals(filter, STALE_STATE_SELECT):
+            page.append(deal)
+            if len(page) == LIST_PAGE_SIZE:
+                count, watermark = self.record_synced(page, watermark)
+                synced += count
+                page = []
+        count, watermark = self.record_synced(page, watermark)
+        synced += count
+        self.finish_sync(synced, watermark)
+        return synced
+
+    def candidates(self, now):
+        """Open deals outside EXCLUDED_STAGES last modified before the stale cutoff (uses deals_open_modify)"""
+        cutoff = get_stale_cutoff(now).strftime("%Y-%m-%dT%H:%M:%S") + PORTAL_TZ_SUFFIX
+        placeholders = ','.join('?' * len(EXCLUDED_STAGES))
+        with self.lock:
+            rows = self._connect().execute(f"""
+                SELECT id, title, stage_id, assigned_by_id, date_modify FROM deals
+                WHERE closed = 0 AND date_modify < ? AND stage_id NOT IN ({placeholders})
+                ORDER BY id
+            """, [cutoff] + EXCLUDED_STAGES).fetchall()
+        return [
+            {"ID": str(deal_id), "TITLE": title, "STAGE_ID": stage_id, "ASSIGNED_BY_ID": assigned_by_id,
+             "DATE_MODIFY": date_modify}
+            for deal_id, title, stage_id, assigned_by_id, date_modify in rows
+        ]
+
+    def verified_candidates(self, now):
+        """
+        Candidates re-read from Bitrix24 (one crm.deal.list per 50 IDs, batched)
+        so that deleted deals and changes the sync missed drop out before
+        anyone is notified. Deals whose re-read failed are kept as stored.
+        """
+        candidates = self.candidates(now)
+        results, errors = self.queue_verification(candidates, BitrixBatch()).execute()
+        return self.apply_verification(candidates, results, errors)
+
+    def queue_verification(self, candidates, batch):
+        """Add the crm.deal.list re-reads of the candidates to batch"""
+        for i in range(0, len(candidates), LIST_PAGE_SIZE):
+            chunk = candidates[i:i + LIST_PAGE_SIZE]
+            batch.add(f"page_{i}", 'crm.deal.list', {
+                "filter": {"ID": [deal["ID"] for deal in chunk]}, "select": STALE_STATE_SELECT, "start": -1
+            })
+        return batch
+
+    def apply_verification(self, candidates, results, errors):
+        """Store the re-read deals, forget deleted ones; returns the verified candidates"""
+        verified = []
+        for i in range(0, len(candidates), LIST_PAGE_SIZE):
+            chunk = candidates[i:i + LIST_PAGE_SIZE]
+            name = f"page_{i}"
+            if name in errors or not isinstance(results.get(name), list):
+                verified.extend(chunk)
+                continue
+            fresh = results[name]
+            self.record_many(fresh)
+            self.delete({deal["ID"] for deal in chunk} - {str(deal["ID"]) for deal in fresh})
+            verified.extend(fresh)
+        return verified
+
+    def notified_level(self, deal_id):
+        with self.lock:
+            row = self._connect().execute('SELECT notified_level FROM deals WHERE id = ?', (int(deal_id),)).fetchone()
+        return row[0] if row else 0
+
+    def should_notify(self, stale):
+        """Notification policy for StaleDealsGroup (STALE_NOTIFY_MODE)"""
+        stale["level"] = max(escalation_level(stale["business_days_stale"]), 1)
+        if STALE_NOTIFY_MODE == 'all':
+            return True
+        notified = self.notified_level(stale["id"])
+        if STALE_NOTIFY_MODE == 'new':
+            return notified == 0
+        return stale["level"] > notified
+
+    def mark_notified(self, by_manager, notifications):
+        """Remember the level each deal was reported at, for managers whose notification went out"""
+        now = time.time()
+        rows = [
+            (stale["level"], now, int(stale["id"]))
+            for manager_id, deals_list in by_manager.items()
+            if notifications.get(manager_id, {}).get("status") == "sent"
+            for stale in deals_list
+        ]
+        with self.lock:
+            conn = self._connect()
+            with conn:
+                conn.execute('BEGIN')
+                conn.executemany(
+                    'UPDATE deals SET notified_level = MAX(notified_level, ?), notified_at = ? WHERE id = ?', rows
+                )
+
+    def stats(self):
+        with self.lock:
+            deals, open_deals, notified = self._connect().execute(
+                'SELECT COUNT(*), SUM(closed = 0), SUM(notified_level > 0) FROM deals'
+            ).fetchone()
+        return {"path": self.path, "deals": deals, "open": open_deals or 0, "notified": notified or 0,
+                "watermark": self.get_meta('watermark'), "mode": STALE_NOTIFY_MODE}
+
+stale_state = StaleStateStore() if STALE_STATE_PATH else None
+
+def record_deal_state(deal):
+    """Обновить хранилище по сделке, полученной из вебхука (ошибки хранилища не мешают обработке)"""
+    if not stale_state or not deal:
+        return
+    try:
+        stale_state.record_many([deal])
+    except sqlite3.Error as e:
+        logging.error("Stale state error for deal %s: %s", deal.get('ID'), e)
+
+def run_stale_check():
+    """Найти застрявшие сделки и уведомить менеджеров. Возвращает (result, status_code)."""
+    # Скан и уведомления идут в фоновой полосе лимитера: вебхуки в это время не ждут
+    with bitrix_priority(PRIORITY_BULK):
+        logging.info("Starting stale deals check...")
+        now = datetime.now()
+        
+        if stale_state:
+            # Дочитать изменения с прошлого запуска и взять кандидатов из индекса
+            synced = stale_state.sync()
+            grouped = StaleDealsGroup(now, policy=stale_state.should_notify)
+            for deal in stale_state.verified_candidates(now):
+                grouped.add(deal)
+        else:
+            # Потоково пройти по открытым сделкам, сохраняя только застрявшие.
+            # Исключённые стадии и недавно изменённые сделки отсекаются на стороне Bitrix24.
+            synced = None
+            grouped = StaleDealsGroup(now)
+            for deal in iter_deals(stale_deals_filter(now), STALE_DEAL_SELECT):
+                grouped.add(deal)
+        grouped.log_summary()
+        
+        skipped = stale_check_skipped(grouped, synced)
+        if skipped:
+            return skipped, 200
+        
+        # Отправить уведомления (batch-запросами по 50)
+        notifications = send_stale_notifications(grouped.by_manager)
+        return finish_stale_check(grouped, notifications, synced), 200
+
+def stale_check_skipped(grouped, synced):
+    """Ответ проверки, если уведомлять некого, иначе None"""
+    if not grouped.stale_count:
+        return {"status": "success", "message": "No stale deals found", "count": 0}
+    if not grouped.by_manager:
+        return {"status": "success", "message": "All stale deals were already notified",
+                "count": grouped.stale_count, "already_notified": grouped.suppressed, "deals_synced": synced}
+    return None
+
+def finish_stale_check(grouped, notifications, synced):
+    """Запомнить отправленные уведомления в хранилище и собрать ответ проверки"""
+    if stale_state:
+        stale_state.mark_notified(grouped.by_manager, notifications)
+    result = stale_check_result(grouped, notifications)
+    if synced is not None:
+        result["deals_synced"] = synced
+    return result
+
+@app.route('/check-stale-deals', methods=['GET'])
+def check_stale_deals():
+    """Проверить застрявшие сделки и отправить уведомления менеджерам"""
+    
+    try:
+        result, status_code = run_stale_check()
+        return jsonify(result), status_code
     
     except Exception as e:
-        logging.error(f"Error in stale deals check: {e}", exc_info=True)
+        logging.error("Error in stale deals check: %s", e, exc_info=True)
         return jsonify({"status": "error", "message": str(e)}), 500
 
+# ============================================================================
+# SCHEDULER - проверка застрявших сделок фоновой задачей по расписанию
+# ============================================================================
+
+SCHEDULER_ENABLED = os.environ.get('SCHEDULER_ENABLED', '1') == '1'
+STALE_CHECK_AT = os.environ.get('STALE_CHECK_AT', '07:00')      # Время запуска (UTC); пусто - только по запросу
+STALE_CHECK_DAYS = os.environ.get('STALE_CHECK_DAYS', '1-5')    # Дни недели как в cron: 1 - понедельник, 7 - воскресенье
+STALE_CHECK_TIMEOUT = 3600                                      # Запуск старше часа считаем зависшим
+SCHEDULER_INTERVAL = 30                                         # Секунд между проверками расписания
+SCHEDULER_DB_PATH = os.environ.get(
+    'SCHEDULER_DB_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'scheduler.sqlite3')
+)
+SCHEDULER_LOCK_PATH = SCHEDULER_DB_PATH + '.lock'
+STALE_CHECK_TRIGGERS = ('manual', 'schedule')
+
+def parse_weekdays(spec):
+    """'1-5' / '1,3,5' / '1-3,6' -> множество datetime.isoweekday()"""
+    days = set()
+    for part in spec.split(','):
+        part = part.strip()
+        if '-' in part:
+            start, end = part.split('-', 1)
+            days.update(range(int(start), int(end) + 1))
+        elif part:
+            days.add(int(part))
+    return days
+
+def day_start(now):
+    """Timestamp начала суток `now` (в его часовом поясе)"""
+    return datetime(now.year, now.month, now.day, tzinfo=now.tzinfo).timestamp()
+
+class StaleCheckRuns(SQLiteStore):
+    """
+    Stale-check runs persisted in SQLite, so a run started through one
+    gunicorn worker can be looked up through any other, and the scheduler
+    knows whether today's run already happened after a restart.
+
+    The process that creates a run holds an flock on the run's own lock file
+    until it records the outcome. A queued or running row whose lock is free
+    belongs to a worker that died mid-run; it is marked failed on the next
+    trigger or when a scheduler takes leadership, instead of blocking
+    triggers until STALE_CHECK_TIMEOUT.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS runs (
+            id TEXT PRIMARY KEY,
+            trigger TEXT NOT NULL,
+            status TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            started_at REAL,
+            finished_at REAL,
+            pid INTEGER,
+            result TEXT
+        );
+        CREATE INDEX IF NOT EXISTS runs_created ON runs (created_at);
+    """
+    COLUMNS = ('id', 'trigger', 'status', 'created_at', 'started_at', 'finished_at', 'pid', 'result')
+
+    def __init__(self, path=SCHEDULER_DB_PATH):
+        super().__init__(path)
+        self.held = {}  # run_id -> файл блокировки запусков этого процесса
+
+    def _row(self, row):
+        if not row:
+            return None
+        run = dict(zip(self.COLUMNS, row))
+        run['result'] = json.loads(run['result']) if run['result'] else None
+        return run
+
+    def _lock_path(self, run_id):
+        return f"{self.path}.run-{run_id}.lock"
+
+    def _hold(self, run_id):
+        if fcntl is None:
+            return
+        lock_file = open(self._lock_path(run_id), 'a')
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self.held[run_id] = lock_file
+
+    def _release(self, run_id):
+        lock_file = self.held.pop(run_id, None)
+        with contextlib.suppress(OSError):
+            os.remove(self._lock_path(run_id))
+        if lock_file is not None:
+            lock_file.close()
+
+    def _is_orphaned(self, run):
+        """Владелец запуска завершился: блокировку запуска никто не держит"""
+        if fcntl is None:  # не-Unix: один процесс, чужой pid - запуск до перезапуска
+            return run['pid'] != os.getpid()
+        with open(self._lock_path(run['id']), 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return False
+        self._release(run['id'])
+        return True
+
+    def _fail_inactive(self, conn, now):
+        """
+        Mark queued/running runs failed when their owner died or they exceeded
+        STALE_CHECK_TIMEOUT. Returns the newest run that is still alive. Runs inside BEGIN IMMEDIATE.
+        """
+        alive = None
+        for row in conn.execute("SELECT * FROM runs WHERE status IN ('queued', 'running') "
+                                "ORDER BY created_at DESC").fetchall():
+            run = self._row(row)
+            if self._is_orphaned(run):
+                reason = "Worker exited before the run finished"
+            elif run['created_at'] <= now - STALE_CHECK_TIMEOUT:
+                reason = "Run timed out"
+            else:
+                alive = alive or run
+                continue
+            logging.warning("Stale check run %s marked failed: %s", run['id'], reason)
+            conn.execute("UPDATE runs SET status = 'failed', finished_at = ?, result = ? WHERE id = ?",
+                         (now, json.dumps({"status": "error", "message": reason}), run['id']))
+        return alive
+
+    def fail_orphaned(self):
+        """Пометить failed запуски умерших воркеров (при старте планировщика)"""
+        with self.lock:
+            conn = self._connect()
+            with conn:
+                conn.execute('BEGIN IMMEDIATE')
+                self._fail_inactive(conn, time.time())
+
+    def create(self, trigger, since=None):
+        """
+        Insert a queued run unless one is already queued or running, or (with
+        `since`) a run of this trigger was created after that timestamp.
+        Returns (run, created). BEGIN IMMEDIATE serializes concurrent triggers from several workers.
+        """
+        now = time.time()
+        with self.lock:
+            conn = self._connect()
+            with conn:
+                conn.execute('BEGIN IMMEDIATE')
+                active = self._fail_inactive(conn, now)
+                if since is not None:
+                    earlier = conn.execute(
+                        "SELECT * FROM runs WHERE trigger = ? AND created_at >= ? ORDER BY created_at DESC LIMIT 1",
+                        (trigger, since)
+                    ).fetchone()
+                    if earlier:
+                        return self._row(earlier), False
+                if active:
+                    return active, False
+                run_id = uuid.uuid4().hex
+                self._hold(run_id)
+                conn.execute('INSERT INTO runs (id, trigger, status, created_at, pid) VALUES (?, ?, ?, ?, ?)',
+                             (run_id, trigger, 'queued', now, os.getpid()))
+        return self.get(run_id), True
+
+    def finish(self, run_id, status, result):
+        """Записать итог запуска и отпустить его блокировку"""
+        self.update(run_id, status=status, finished_at=time.time(), result=result)
+        self._release(run_id)
+
+    def update(self, run_id, **fields):
+        if 'result' in fields:
+            fields['result'] = json.dumps(fields['result'], ensure_ascii=False, default=str)
+        assignments = ', '.join(f"{key} = ?" for key in fields)
+        with self.lock:
+            self._connect().execute(f"UPDATE runs SET {assignments} WHERE id = ?", list(fields.values()) + [run_id])
+
+    def get(self, run_id):
+        with self.lock:
+            return self._row(self._connect().execute('SELECT * FROM runs WHERE id = ?', (run_id,)).fetchone())
+
+    def latest(self, trigger=None, since=0):
+        query = 'SELECT * FROM runs WHERE created_at >= ?'
+        params = [since]
+        if trigger:
+            query += ' AND trigger = ?'
+            params.append(trigger)
+        with self.lock:
+            return self._row(self._connect().execute(query + ' ORDER BY created_at DESC LIMIT 1', params).fetchone())
+
+stale_check_runs = StaleCheckRuns()
+
+def _execute_stale_check_run(run_id):
+    """Обработчик для job_queue: выполнить запуск и сохранить результат в SQLite"""
+    stale_check_runs.update(run_id, status='running', started_at=time.time(), pid=os.getpid())
+    try:
+        result, status_code = run_stale_check()
+    except Exception as e:
+        logging.error("Stale check run %s failed: %s", run_id, e, exc_info=True)
+        stale_check_runs.finish(run_id, 'failed', {"status": "error", "message": str(e)})
+        raise
+    stale_check_runs.finish(run_id, 'done' if status_code < 400 else 'failed', result)
+    return result, status_code
+
+def stale_check_since(trigger):
+    """Плановый запуск - один в сутки (UTC): повторный вызов вернёт сегодняшний"""
+    return day_start(datetime.now(timezone.utc)) if trigger == 'schedule' else None
+
+def stale_check_accepted(run, created):
+    """Ответ /check-stale-deals/start"""
+    if created:
+        status = "accepted"
+    elif run['status'] in ('queued', 'running'):
+        status = "already_running"
+    else:
+        status = "already_done"
+    return {"status": status, "job_id": run['id'], "run": run}
+
+def trigger_stale_check(trigger='manual'):
+    """Поставить проверку в фоновую очередь, если она ещё не идёт. Возвращает (run, created)."""
+    run, created = stale_check_runs.create(trigger, since=stale_check_since(trigger))
+    if created:
+        job_queue.submit('stale_check', run['id'], _execute_stale_check_run)
+        logging.info("Stale check run %s queued (%s)", run['id'], trigger)
+    return run, created
+
+class Scheduler:
+    """
+    Daily stale check at STALE_CHECK_AT (UTC) on STALE_CHECK_DAYS.
+
+    Every gunicorn worker starts the thread, but only the one holding an
+    exclusive flock on SCHEDULER_LOCK_PATH acts; if that worker dies the OS
+    releases the lock and another worker takes over on its next tick. A run
+    missed while the instance slept is started on the first tick after it
+    wakes up the same day. The new leader fails the runs orphaned by the
+    worker it replaces.
+    """
+
+    def __init__(self, at=STALE_CHECK_AT, days=STALE_CHECK_DAYS, lock_path=SCHEDULER_LOCK_PATH,
+                 interval=SCHEDULER_INTERVAL):
+        self.at = datetime.strptime(at, '%H:%M').time() if at else None
+        self.days = parse_weekdays(days)
+        self.lock_path = lock_path
+        self.interval = interval
+        self.lock_file = None
+        self.thread = None
+        self.start_lock = threading.Lock()
+
+    @property
+    def is_leader(self):
+        return self.lock_file is not None
+
+    def _acquire_leadership(self):
+        if self.lock_file is not None:
+            return True
+        if fcntl is None:  # не-Unix: один процесс, блокировка не нужна
+            self.lock_file = True
+            stale_check_runs.fail_orphaned()
+            return True
+        os.makedirs(os.path.dirname(os.path.abspath(self.lock_path)), exist_ok=True)
+        lock_file = open(self.lock_path, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self.lock_file = lock_file
+        logging.info("Scheduler leadership acquired by pid %s", os.getpid())
+        stale_check_runs.fail_orphaned()
+        return True
+
+    def due(self, now):
+        """Пора ли запускать: сегодня рабочий день расписания, время прошло, сегодня запуска ещё не было"""
+        if not self.at or now.isoweekday() not in self.days or now.time() < self.at:
+            return False
+        return stale_check_runs.latest(trigger='schedule', since=day_start(now)) is None
+
+    def ready(self, now):
+        """Этот процесс - лидер, и пора запускать"""
+        return self._acquire_leadership() and self.due(now)
+
+    def tick(self):
+        if self.ready(datetime.now(timezone.utc)):
+            trigger_stale_check('schedule')
+
+    def _loop(self):
+        while True:
+            try:
+                self.tick()
+            except Exception as e:
+                logging.error("Scheduler tick failed: %s", e, exc_info=True)
+            time.sleep(self.interval)
+
+    def start(self):
+        """Start the scheduler thread once per process (called lazily, see ensure_scheduler)"""
+        with self.start_lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._loop, name='scheduler', daemon=True)
+                self.thread.start()
+
+    def status(self):
+        return {
+            "enabled": SCHEDULER_ENABLED and bool(self.at),
+            "at_utc": self.at.strftime('%H:%M') if self.at else None,
+            "days": sorted(self.days),
+            "leader": self.is_leader,
+            "pid": os.getpid(),
+        }
+
+scheduler = Scheduler()
+
+@app.before_request
+def ensure_scheduler():
+    # Поток стартует при первом запросе к воркеру, а не при импорте (gunicorn --preload, CLI-скрипты)
+    if SCHEDULER_ENABLED and scheduler.at and scheduler.thread is None:
+        scheduler.start()
+
+@app.route('/check-stale-deals/start', methods=['POST', 'GET'])
+def start_stale_check():
+    """Запустить проверку застрявших сделок в фоне; возвращает ID запуска сразу"""
+    trigger = request.args.get('trigger') or 'manual'
+    if trigger not in STALE_CHECK_TRIGGERS:
+        return jsonify({"status": "error", "message": f"Unknown trigger: {trigger}"}), 400
+    run, created = trigger_stale_check(trigger)
+    return jsonify(stale_check_accepted(run, created)), 202
+
+@app.route('/check-stale-deals/status', methods=['GET'])
+@app.route('/check-stale-deals/status/<job_id>', methods=['GET'])
+def stale_check_status(job_id=None):
+    """Статус и результат запуска проверки (без ID - последний запуск)"""
+    run = stale_check_runs.get(job_id) if job_id else stale_check_runs.latest()
+    if not run:
+        return jsonify({"status": "error", "message": "Run not found"}), 404
+    return jsonify({"run": run, "scheduler": scheduler.status()})
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=10000)
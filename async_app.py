@@ -0,0 +1,666 @@
+"""
+Async (ASGI) implementation of the webhook handlers.
+
+Serves the same routes as app.py: /, /webhook, /contact-update,
+/check-stale-deals (plus /start and /status/<job_id>), /health and
+/metrics. It parses payloads the same way and reuses app.py's pure logic
+(extract_deal_id, build_updates, diff_fields, stale-deal grouping, event
+deduplication, duplicate index, metrics). Bitrix24 calls go through one
+httpx.AsyncClient with a bounded connection pool. A semaphore caps how
+many requests are in flight towards the portal, so a single process can
+hold hundreds of concurrent webhook events while Bitrix24 sees at most
+ASYNC_BITRIX_CONCURRENCY requests at a time.
+
+Run:
+    uvicorn async_app:app --host 0.0.0.0 --port 10000
+"""
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+import uuid
+from datetime import datetime, timezone
+from urllib.parse import parse_qsl
+
+import httpx
+
+from app import (
+    ASYNC_WEBHOOKS, BATCH_LIMIT, BITRIX_BACKOFF, BITRIX_CONNECT_TIMEOUT, BITRIX_MAX_RETRIES, BITRIX_READ_TIMEOUT,
+    BITRIX_REQUEST_PATIENCE, CONTACT_SELECT, DEAL_READ_SELECT, DEAL_SELECT, LIST_PAGE_SIZE, PHONE_VALID,
+    PRIORITY_BULK, REQUEST_ID_HEADER, REQUEST_ID_REGEX, SCHEDULER_ENABLED, STALE_CHECK_TRIGGERS, STALE_DEAL_SELECT,
+    STALE_STATE_SELECT, WEBHOOK_URL, Bitrix24Client, Bitrix24Error, StaleDealsGroup, _as_dict, bitrix_priority,
+    bitrix_priority_var, build_query, build_updates, check_duplicates, coalesced_response, contact_deal_updates,
+    contact_link_updates, diff_fields, event_coalescer, extract_contact_id, extract_deal_id, finish_stale_check,
+    first_with_id, get_contact_phones, keyset_page_params, log_payload, metrics, metrics_endpoint, normalize_phones,
+    phone_index, projection_params, queue_stale_notifications, rate_limiter, record_deal_state, redact_payload,
+    request_id_var, scheduler, stale_check_accepted, stale_check_runs, stale_check_since, stale_check_skipped,
+    stale_deals_filter, stale_state, summarize_notifications, throttle_rejected, timed_stage, valid_contact_phones,
+)
+
+ASYNC_BITRIX_CONCURRENCY = int(os.environ.get('ASYNC_BITRIX_CONCURRENCY', '10'))  # Одновременных запросов к Bitrix24
+ASYNC_BITRIX_CONNECTIONS = int(os.environ.get('ASYNC_BITRIX_CONNECTIONS', '20'))  # Соединений в пуле httpx
+
+if ASYNC_WEBHOOKS:
+    logging.warning("ASYNC_WEBHOOKS is ignored by async_app: events are processed concurrently in the event loop")
+
+# ============================================================================
+# ASYNC BITRIX24 CLIENT
+# ============================================================================
+
+class AsyncBitrix24Client:
+    """
+    asyncio counterpart of app.Bitrix24Client: same retries, backoff,
+    metrics and shared PortalRateLimiter lanes, with an httpx connection
+    pool and a semaphore limiting concurrent requests to the portal.
+    """
+
+    def __init__(self, base_url, concurrency=ASYNC_BITRIX_CONCURRENCY, connections=ASYNC_BITRIX_CONNECTIONS,
+                 connect_timeout=BITRIX_CONNECT_TIMEOUT, read_timeout=BITRIX_READ_TIMEOUT,
+                 max_retries=BITRIX_MAX_RETRIES, backoff=BITRIX_BACKOFF, limiter=rate_limiter):
+        self.base_url = base_url
+        self.limiter = limiter
+        self.concurrency = concurrency
+        self.connections = connections
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.calls = 0
+        self.client = None
+        self.semaphore = None
+
+    async def start(self):
+        limits = httpx.Limits(max_connections=self.connections, max_keepalive_connections=self.connections)
+        self.client = httpx.AsyncClient(limits=limits, timeout=self.timeout)
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+
+    async def close(self):
+        if self.client:
+            await self.client.aclose()
+            self.client = None
+
+    async def _record(self, method, started, outcome):
+        metrics.inc('bitrix_requests_total', method=method, outcome=outcome)
+        metrics.observe('bitrix_request_duration_seconds', time.perf_counter() - started, method=method)
+        if outcome == 'QUERY_LIMIT_EXCEEDED':
+            metrics.inc('bitrix_rate_limited_total', method=method)
+        if not self.limiter:
+            return
+        # AIMD пишет в SQLite (BEGIN IMMEDIATE, ожидание блокировки до 10 с) - не в цикле событий
+        if outcome == 'ok':
+            if self.limiter.current_rate < self.limiter.max_rate:
+                await asyncio.to_thread(self.limiter.on_success)
+        elif outcome == 'QUERY_LIMIT_EXCEEDED':
+            await asyncio.to_thread(self.limiter.on_rate_limited)
+
+    async def _throttle(self, patience_until):
+        """Take a token from the shared limiter without blocking the event loop"""
+        if not self.limiter:
+            return
+        lane = bitrix_priority_var.get()
+        waited = 0.0
+        while True:
+            patience = max(patience_until - time.monotonic(), 0.0)
+            granted, wait = await asyncio.to_thread(self.limiter.reserve, lane, patience)
+            if wait is None:
+                raise throttle_rejected(lane, patience)
+            if wait > 0:
+                await asyncio.sleep(wait)
+                waited += wait
+            if granted:
+                break
+        if waited:
+            metrics.inc('bitrix_throttle_seconds_total', waited, lane=lane)
+
+    async def call(self, method, params=None):
+        """Call a REST method and return the decoded JSON response; raises Bitrix24Error"""
+        if self.client is None:
+            await self.start()
+        url = f"{self.base_url}{method}"
+        last_error = None
+        attempt = 0
+        # Обработчики async_app выполняются внутри запроса: ограничение как для запроса синхронного app
+        patience_until = time.monotonic() + BITRIX_REQUEST_PATIENCE
+
+        while attempt <= self.max_retries:
+            if last_error:
+                metrics.inc('bitrix_retries_total', method=method)
+                logging.warning("Retrying %s (attempt %s) after error: %s", method, attempt + 1, last_error)
+                if last_error.retry_after or not (self.limiter and last_error.code == 'QUERY_LIMIT_EXCEEDED'):
+                    delay = last_error.retry_after or \
+                        self.backoff * (2 ** max(attempt - 1, 0)) + random.uniform(0, self.backoff)
+                    await asyncio.sleep(delay)
+
+            await self._throttle(patience_until)
+            async with self.semaphore:
+                self.calls += 1
+                started = time.perf_counter()
+                try:
+                    response = await self.client.post(url, json=params or {})
+                except (httpx.TransportError, httpx.TimeoutException) as e:
+                    last_error = Bitrix24Error(type(e).__name__, str(e))
+                    await self._record(method, started, last_error.code)
+                    attempt += 1
+                    continue
+
+            try:
+                data = response.json()
+            except ValueError:
+                data = {}
+
+            if isinstance(data, dict) and 'error' in data:
+                error = Bitrix24Error(data['error'], data.get('error_description', ''), response.status_code)
+            elif response.status_code >= 400:
+                error = Bitrix24Error(f"HTTP_{response.status_code}", response.text[:200], response.status_code)
+            else:
+                await self._record(method, started, 'ok')
+                return data
+
+            await self._record(method, started, error.code or f"HTTP_{response.status_code}")
+            if error.code in Bitrix24Client.RETRY_ERRORS or response.status_code >= 500:
+                retry_after = response.headers.get('Retry-After')
+                error.retry_after = float(retry_after) if retry_after and retry_after.isdigit() else None
+                last_error = error
+                if self.limiter and error.code == 'QUERY_LIMIT_EXCEEDED':
+                    if time.monotonic() >= patience_until:
+                        raise error
+                else:
+                    attempt += 1
+                continue
+            raise error
+
+        raise last_error
+
+bitrix = AsyncBitrix24Client(WEBHOOK_URL)
+
+class AsyncBitrixBatch:
+    """app.BitrixBatch over the async client; chunks of 50 commands run concurrently"""
+
+    def __init__(self, halt=False):
+        self.halt = halt
+        self.commands = []
+
+    def __len__(self):
+        return len(self.commands)
+
+    def add(self, name, method, params=None):
+        self.commands.append((name, method, params or {}))
+        return name
+
+    async def _execute_chunk(self, chunk):
+        methods = {name: method for name, method, _ in chunk}
+        for method in methods.values():
+            metrics.inc('bitrix_batch_commands_total', method=method)
+        cmd = {name: f"{method}?{build_query(params)}" if params else method for name, method, params in chunk}
+        try:
+            data = await bitrix.call('batch', {"halt": 1 if self.halt else 0, "cmd": cmd})
+        except Bitrix24Error as e:
+            logging.error("Error executing batch request: %s", e)
+            for name in cmd:
+                metrics.inc('bitrix_batch_command_errors_total', method=methods[name])
+            return {}, {name: str(e) for name in cmd}
+        batch_result = _as_dict(data.get('result'))
+        errors = _as_dict(batch_result.get('result_error'))
+        for name in errors:
+            metrics.inc('bitrix_batch_command_errors_total', method=methods.get(name, 'unknown'))
+        return _as_dict(batch_result.get('result')), errors
+
+    async def execute(self):
+        """Run all queued commands. Returns (results, errors) keyed by command name."""
+        chunks = [self.commands[i:i + BATCH_LIMIT] for i in range(0, len(self.commands), BATCH_LIMIT)]
+        if self.halt:
+            # halt: после ошибки следующие пачки не отправляются
+            outcomes = []
+            for chunk in chunks:
+                outcomes.append(await self._execute_chunk(chunk))
+                if outcomes[-1][1]:
+                    break
+        else:
+            outcomes = await asyncio.gather(*(self._execute_chunk(chunk) for chunk in chunks))
+        results, errors = {}, {}
+        for chunk_results, chunk_errors in outcomes:
+            results.update(chunk_results)
+            errors.update(chunk_errors)
+        if errors:
+            logging.warning("Batch commands failed: %s", errors)
+        return results, errors
+
+async def iter_list(method, filter=None, select=None, start_id=0):
+    """Async app.iter_list: keyset pages of a crm.*.list method"""
+    last_id = int(start_id or 0)
+    while True:
+        result = await bitrix.call(method, keyset_page_params(filter, select, last_id))
+        items = result.get('result') or []
+        for item in items:
+            yield item
+        if len(items) < LIST_PAGE_SIZE:
+            break
+        last_id = int(items[-1]['ID'])
+
+async def fetch_deal_with_contact(deal_id):
+    """Get deal and its contact in one round trip (see app.fetch_deal_with_contact)"""
+    batch = AsyncBitrixBatch()
+    batch.add('deal', 'crm.deal.list', projection_params(deal_id, DEAL_READ_SELECT))
+    batch.add('contact', 'crm.contact.list', projection_params('$result[deal][0][CONTACT_ID]', CONTACT_SELECT))
+    results, _ = await batch.execute()
+    deal = first_with_id(results.get('deal'), deal_id)
+    contact = first_with_id(results.get('contact'), deal.get('CONTACT_ID')) if deal else None
+    return deal, contact
+
+# ============================================================================
+# HANDLERS - та же логика, что process_deal / process_contact / check_stale_deals
+# ============================================================================
+
+async def process_deal(deal_id):
+    logging.info("Processing deal %s", deal_id)
+    with timed_stage('deal', 'fetch'):
+        deal, contact = await fetch_deal_with_contact(deal_id)
+    if not deal:
+        return {"status": "error", "message": "Deal not found"}, 404
+    await asyncio.to_thread(record_deal_state, deal)
+
+    contact_id = deal.get('CONTACT_ID')
+    if not contact_id:
+        logging.warning("No contact linked to deal %s", deal_id)
+        return {"status": "error", "message": "No contact linked to deal"}, 400
+    if not contact:
+        return {"status": "error", "message": "Contact not found"}, 404
+
+    contact_updates, deal_updates = build_updates(deal, contact)
+    contact_updates = diff_fields(contact, contact_updates)
+    deal_updates = diff_fields(deal, deal_updates)
+    if not contact_updates and not deal_updates:
+        logging.info("Deal %s is already up to date", deal_id)
+
+    writes = AsyncBitrixBatch()
+    if contact_updates:
+        writes.add('contact', 'crm.contact.update', {'ID': contact_id, 'fields': contact_updates})
+    if deal_updates:
+        writes.add('deal', 'crm.deal.update', {'ID': deal_id, 'fields': deal_updates})
+    # SQLite-индекс дубликатов - блокирующий ввод-вывод, уводим из event loop
+    with timed_stage('deal', 'duplicates'):
+        duplicates, claimed = await asyncio.to_thread(
+            check_duplicates, deal_id, contact_id, valid_contact_phones(contact), writes
+        )
+
+    if writes:
+        with timed_stage('deal', 'write'):
+            results, errors = await writes.execute()
+        if claimed and 'duplicate_comment' in errors:
+            logging.error("Failed to add duplicate comment to deal %s: %s", deal_id, errors['duplicate_comment'])
+            await asyncio.to_thread(phone_index.release_notes, deal_id, claimed)
+        if contact_updates and 'contact' in errors:
+            logging.error("Failed to update contact %s", contact_id)
+        if deal_updates:
+            if results.get('deal') and 'deal' not in errors:
+                logging.info("Successfully updated deal %s with fields: %s", deal_id, list(deal_updates.keys()))
+            else:
+                logging.error("Failed to update deal %s", deal_id)
+
+    result = {"status": "success", "deal_id": deal_id, "updates": list(deal_updates.keys())}
+    if duplicates:
+        result["duplicate_contacts"] = duplicates
+    return result, 200
+
+async def process_contact(contact_id):
+    logging.info("Processing contact %s", contact_id)
+    batch = AsyncBitrixBatch()
+    batch.add('contact', 'crm.contact.list', projection_params(contact_id, CONTACT_SELECT))
+    batch.add('deals', 'crm.deal.list', keyset_page_params({'CONTACT_ID': contact_id}, DEAL_SELECT))
+    with timed_stage('contact', 'fetch'):
+        results, errors = await batch.execute()
+
+    contact = first_with_id(results.get('contact'), contact_id)
+    if not contact:
+        return {"status": "error", "message": "Contact not found"}, 404
+
+    phones = normalize_phones(get_contact_phones(contact))
+    if not phones:
+        logging.info("Contact %s has no phone, skipping", contact_id)
+        return {"status": "skipped", "message": "No phone in contact", "contact_id": contact_id}, 200
+    valid_phones = [phone for phone in phones if phone.status == PHONE_VALID]
+    if not valid_phones:
+        logging.warning("Could not normalize phones: %s", [phone.raw for phone in phones])
+        return {
+            "status": "error",
+            "message": "Invalid phone number",
+            "phones": [{"value": phone.raw, "status": phone.status} for phone in phones]
+        }, 400
+    normalized_phone = valid_phones[0].digits
+
+    writes = AsyncBitrixBatch()
+    contact_updates = contact_link_updates(contact, normalized_phone)
+    if contact_updates:
+        writes.add('contact', 'crm.contact.update', {'ID': contact_id, 'fields': contact_updates})
+
+    deals = results.get('deals') or []
+    if 'deals' in errors:
+        logging.error("Error listing deals for contact %s: %s", contact_id, errors['deals'])
+    elif len(deals) == LIST_PAGE_SIZE:
+        # Кандидат откликался много раз: догружаем остальные страницы
+        with timed_stage('contact', 'deal_pages'):
+            deals = deals + [deal async for deal in iter_list('crm.deal.list', {'CONTACT_ID': contact_id},
+                                                              DEAL_SELECT, deals[-1]['ID'])]
+
+    deals_to_update = []
+    deals_skipped = 0
+    deal_ids = []
+    for deal in deals:
+        deal_id = deal.get('ID')
+        deal_ids.append(deal_id)
+        deal_updates = contact_deal_updates(contact, deal, normalized_phone)
+        if not deal_updates:
+            deals_skipped += 1
+            continue
+        deals_to_update.append(deal_id)
+        writes.add(f"deal_{deal_id}", 'crm.deal.update', {'ID': deal_id, 'fields': deal_updates})
+
+    rows = [(phone.digits, contact_id, deal_id) for phone in valid_phones for deal_id in [0] + deal_ids]
+    try:
+        with timed_stage('contact', 'duplicates'):
+            await asyncio.to_thread(phone_index.add_many, rows)
+    except Exception as e:
+        logging.error("Phone index error for contact %s: %s", contact_id, e)
+
+    with timed_stage('contact', 'write'):
+        write_results, write_errors = await writes.execute()
+    if 'contact' in write_results and 'contact' not in write_errors:
+        logging.info("Updated contact %s with messenger links", contact_id)
+
+    deals_updated = []
+    for deal_id in deals_to_update:
+        name = f"deal_{deal_id}"
+        if write_results.get(name) and name not in write_errors:
+            deals_updated.append(deal_id)
+        else:
+            logging.error("Failed to update deal %s: %s", deal_id, write_errors.get(name))
+
+    return {
+        "status": "success",
+        "contact_id": contact_id,
+        "phone": normalized_phone,
+        "whatsapp": f"https://wa.me/{normalized_phone}",
+        "telegram": f"https://t.me/+{normalized_phone}",
+        "deals_updated": deals_updated,
+        "deals_skipped": deals_skipped
+    }, 200
+
+async def sync_stale_state():
+    """StaleStateStore.sync over the async client; SQLite writes go to a thread"""
+    filter, watermark = await asyncio.to_thread(stale_state.sync_filter)
+    synced = 0
+    page = []
+    async for deal in iter_list('crm.deal.list', filter, STALE_STATE_SELECT):
+        page.append(deal)
+        if len(page) == LIST_PAGE_SIZE:
+            count, watermark = await asyncio.to_thread(stale_state.record_synced, page, watermark)
+            synced += count
+            page = []
+    count, watermark = await asyncio.to_thread(stale_state.record_synced, page, watermark)
+    synced += count
+    await asyncio.to_thread(stale_state.finish_sync, synced, watermark)
+    return synced
+
+async def verified_stale_candidates(now):
+    """StaleStateStore.verified_candidates over the async client"""
+    candidates = await asyncio.to_thread(stale_state.candidates, now)
+    results, errors = await stale_state.queue_verification(candidates, AsyncBitrixBatch()).execute()
+    return await asyncio.to_thread(stale_state.apply_verification, candidates, results, errors)
+
+def group_stale_deals(now, deals, policy):
+    grouped = StaleDealsGroup(now, policy=policy)
+    for deal in deals:
+        grouped.add(deal)
+    return grouped
+
+async def check_stale_deals():
+    """Same check as app.run_stale_check, with every Bitrix24 call on the async client"""
+    with bitrix_priority(PRIORITY_BULK):
+        logging.info("Starting stale deals check...")
+        now = datetime.now()
+        if stale_state:
+            synced = await sync_stale_state()
+            deals = await verified_stale_candidates(now)
+            # Политика уведомлений читает SQLite - группируем в потоке
+            grouped = await asyncio.to_thread(group_stale_deals, now, deals, stale_state.should_notify)
+        else:
+            synced = None
+            grouped = StaleDealsGroup(now)
+            async for deal in iter_list('crm.deal.list', stale_deals_filter(now), STALE_DEAL_SELECT):
+                grouped.add(deal)
+        grouped.log_summary()
+
+        skipped = stale_check_skipped(grouped, synced)
+        if skipped:
+            return skipped, 200
+
+        results, errors = await queue_stale_notifications(grouped.by_manager, AsyncBitrixBatch()).execute()
+    notifications = summarize_notifications(grouped.by_manager, results, errors)
+    return await asyncio.to_thread(finish_stale_check, grouped, notifications, synced), 200
+
+background_tasks = set()  # Ссылки на отложенные задачи, чтобы их не собрал GC
+
+def spawn(coro):
+    """Запустить корутину отдельной задачей, сохранив ссылку на неё"""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+async def run_coalesced(kind, entity_id, handler):
+    try:
+        return await handler(entity_id)
+    finally:
+        delay = event_coalescer.release((kind, str(entity_id)))
+        if delay is not None:
+            schedule_trailing_run(kind, entity_id, handler, delay)
+
+def schedule_trailing_run(kind, entity_id, handler, delay):
+    """Run the handler once more after `delay` seconds, in its own task"""
+    async def trailing():
+        await asyncio.sleep(delay)
+        event_coalescer.start((kind, str(entity_id)))
+        logging.info("Trailing %s run for %s", kind, entity_id)
+        try:
+            await run_coalesced(kind, entity_id, handler)
+        except Exception as e:
+            logging.error("Trailing %s run for %s failed: %s", kind, entity_id, e, exc_info=True)
+    spawn(trailing())
+
+async def execute_stale_check_run(run_id):
+    """Same as app._execute_stale_check_run, with the check on the async client"""
+    await asyncio.to_thread(stale_check_runs.update, run_id, status='running', started_at=time.time(),
+                            pid=os.getpid())
+    try:
+        result, status_code = await check_stale_deals()
+    except Exception as e:
+        logging.error("Stale check run %s failed: %s", run_id, e, exc_info=True)
+        await asyncio.to_thread(stale_check_runs.finish, run_id, 'failed', {"status": "error", "message": str(e)})
+        return
+    await asyncio.to_thread(stale_check_runs.finish, run_id, 'done' if status_code < 400 else 'failed', result)
+
+async def trigger_stale_check(trigger='manual'):
+    """Same as app.trigger_stale_check; the run is an asyncio task instead of a job_queue job"""
+    run, created = await asyncio.to_thread(stale_check_runs.create, trigger, stale_check_since(trigger))
+    if created:
+        spawn(execute_stale_check_run(run['id']))
+        logging.info("Stale check run %s started (%s)", run['id'], trigger)
+    return run, created
+
+async def run_scheduler():
+    """app.Scheduler in the event loop: same flock leadership, the run is started by trigger_stale_check"""
+    while True:
+        try:
+            if await asyncio.to_thread(scheduler.ready, datetime.now(timezone.utc)):
+                await trigger_stale_check('schedule')
+        except Exception as e:
+            logging.error("Scheduler tick failed: %s", e, exc_info=True)
+        await asyncio.sleep(scheduler.interval)
+
+async def dispatch_event(kind, entity_id, handler):
+    """Same coalescing as app.dispatch_event; the first event is processed inline"""
+    run_now, delay = event_coalescer.claim((kind, str(entity_id)))
+    if not run_now:
+        if delay is not None:
+            schedule_trailing_run(kind, entity_id, handler, delay)
+        logging.info("Coalesced %s event for %s into a pending run", kind, entity_id)
+        return coalesced_response(kind, entity_id)
+    return await run_coalesced(kind, entity_id, handler)
+
+# ============================================================================
+# ASGI
+# ============================================================================
+
+def request_data(headers, query_string, body):
+    """Same merge as app.get_request_data: JSON body, or form fields overlaid by query parameters"""
+    content_type = headers.get('content-type', '')
+    if content_type.startswith('application/json'):
+        try:
+            return json.loads(body or b'{}') or {}
+        except ValueError:
+            return {}
+    data = {}
+    if content_type.startswith('application/x-www-form-urlencoded'):
+        for key, value in parse_qsl(body.decode('utf-8', 'replace'), keep_blank_values=True):
+            data.setdefault(key, value)
+    query = {}
+    for key, value in parse_qsl(query_string.decode('utf-8', 'replace'), keep_blank_values=True):
+        query.setdefault(key, value)
+    data.update(query)
+    return data
+
+async def webhook(data):
+    log_payload("Webhook payload", data)
+    deal_id = extract_deal_id(data)
+    logging.info("Webhook: deal %s", deal_id)
+    if not deal_id:
+        logging.warning("No deal ID in request. Full data: %s", redact_payload(data))
+        return {"status": "error", "message": "No deal ID provided"}, 400
+    return await dispatch_event('deal', deal_id, process_deal)
+
+async def contact_update(data):
+    log_payload("Contact update payload", data)
+    contact_id = extract_contact_id(data)
+    logging.info("Contact update: contact %s", contact_id)
+    if not contact_id:
+        logging.warning("No contact ID in request. Full data: %s", redact_payload(data))
+        return {"status": "error", "message": "No contact ID provided"}, 400
+    return await dispatch_event('contact', contact_id, process_contact)
+
+async def health(data):
+    return {"status": "ok"}, 200
+
+async def stale_route(data):
+    return await check_stale_deals()
+
+async def start_stale_check(data):
+    trigger = data.get('trigger') or 'manual'
+    if trigger not in STALE_CHECK_TRIGGERS:
+        return {"status": "error", "message": f"Unknown trigger: {trigger}"}, 400
+    run, created = await trigger_stale_check(trigger)
+    return stale_check_accepted(run, created), 202
+
+async def stale_check_status(data, job_id=None):
+    run = await asyncio.to_thread(stale_check_runs.get, job_id) if job_id else \
+        await asyncio.to_thread(stale_check_runs.latest)
+    if not run:
+        return {"status": "error", "message": "Run not found"}, 404
+    return {"run": run, "scheduler": scheduler.status()}, 200
+
+async def jobs(data):
+    """Отложенные повторные запуски (для benchmark.py: дождаться, пока всё обработано)"""
+    return {"events_collapsed": event_coalescer.collapsed,
+            "trailing_runs_scheduled": len(event_coalescer.scheduled),
+            "running": len(event_coalescer.active)}, 200
+
+ROUTES = {
+    '/': (webhook, {'GET', 'POST'}),
+    '/webhook': (webhook, {'GET', 'POST'}),
+    '/contact-update': (contact_update, {'GET', 'POST'}),
+    '/check-stale-deals': (stale_route, {'GET'}),
+    '/check-stale-deals/start': (start_stale_check, {'GET', 'POST'}),
+    '/check-stale-deals/status': (stale_check_status, {'GET'}),
+    '/check-stale-deals/status/<job_id>': (stale_check_status, {'GET'}),
+    '/health': (health, {'GET'}),
+    '/jobs': (jobs, {'GET'}),
+}
+
+def match_route(path):
+    """Ключ ROUTES и параметры пути: точное совпадение или <параметр> последним сегментом"""
+    if path in ROUTES:
+        return path, {}
+    head, _, value = path.rpartition('/')
+    for route in ROUTES:
+        route_head, _, name = route.rpartition('/')
+        if value and route_head == head and name.startswith('<') and name.endswith('>'):
+            return route, {name[1:-1]: value}
+    return None, {}
+
+async def read_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+async def send_response(send, status_code, body, content_type, request_id):
+    headers = [(b'content-type', content_type.encode()), (b'content-length', str(len(body)).encode())]
+    if request_id:
+        headers.append((REQUEST_ID_HEADER.lower().encode(), request_id.encode()))
+    await send({'type': 'http.response.start', 'status': status_code, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+async def lifespan(receive, send):
+    scheduler_task = None
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await bitrix.start()
+            scheduler_task = spawn(run_scheduler()) if SCHEDULER_ENABLED and scheduler.at else None
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            if scheduler_task:
+                scheduler_task.cancel()
+            await bitrix.close()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+
+    started = time.perf_counter()
+    headers = {key.decode('latin-1').lower(): value.decode('latin-1') for key, value in scope['headers']}
+    incoming = headers.get(REQUEST_ID_HEADER.lower(), '')
+    request_id = incoming if REQUEST_ID_REGEX.match(incoming) else uuid.uuid4().hex[:16]
+    request_id_var.set(request_id)
+
+    path, method = scope['path'], scope['method']
+    body = await read_body(receive)
+    matched, params = match_route(path)
+    route = matched or ('/metrics' if path == '/metrics' else 'unmatched')
+    content_type = 'application/json'
+    try:
+        if path == '/metrics' and method == 'GET':
+            text, status_code, _ = metrics_endpoint()
+            payload = text.encode('utf-8')
+            content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        elif matched and method in ROUTES[matched][1]:
+            result, status_code = await ROUTES[matched][0](request_data(headers, scope['query_string'], body),
+                                                           **params)
+            payload = json.dumps(result, ensure_ascii=False).encode('utf-8')
+        else:
+            status_code = 405 if matched else 404
+            payload = json.dumps({"status": "error", "message": "Not found"}).encode('utf-8')
+    except Exception as e:
+        logging.error("Error processing %s: %s", path, e, exc_info=True)
+        status_code = 500
+        payload = json.dumps({"status": "error", "message": str(e)}, ensure_ascii=False).encode('utf-8')
+
+    await send_response(send, status_code, payload, content_type, request_id)
+    metrics.inc('http_requests_total', route=route, method=method, status=status_code)
+    metrics.observe('http_request_duration_seconds', time.perf_counter() - started, route=route)
@@ -0,0 +1,193 @@
+"""
+Backfill messenger links, city/timezone and "Name - Job Title" for existing deals.
+
+Streams every deal with keyset pagination, loads the linked contacts one page
+at a time, computes updates with the same build_updates() the webhook uses and
+writes only the fields that differ, through batch requests of up to 50
+commands. The last processed deal ID is checkpointed after every page, so an
+interrupted run resumes where it stopped.
+
+Every page also feeds the phone -> contact/deal duplicate index
+(app.PhoneIndex). With --phone-index the script only builds that index: it
+reads deal IDs and contact phones and writes nothing to Bitrix24.
+
+All requests go through the bulk lane of the shared portal rate limiter
+(app.PortalRateLimiter), so running the backfill next to the service does not
+delay webhook processing; --rate additionally caps this process.
+
+Note: every written deal gets a fresh DATE_MODIFY, which resets its stale-deal
+clock. Run with --dry-run first to see how many deals would change.
+
+Usage:
+    python backfill.py [--rate 2] [--checkpoint backfill_checkpoint.json] [--restart] [--dry-run] [--limit N]
+    python backfill.py --phone-index [--rate 2] [--restart]
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+from app import (
+    CONTACT_SELECT, DEAL_SELECT, LIST_PAGE_SIZE, PRIORITY_BULK, BitrixBatch, bitrix, bitrix_priority, build_updates,
+    diff_fields, iter_deals, iter_list, phone_index, valid_contact_phones,
+)
+
+# Минимальные выборки для --phone-index
+INDEX_DEAL_SELECT = ['ID', 'CONTACT_ID']
+INDEX_CONTACT_SELECT = ['ID', 'PHONE']
+
+
+def load_checkpoint(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def save_checkpoint(path, state):
+    """Write the checkpoint atomically so a crash never leaves a half-written file"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+
+def pages(items, size):
+    """Group a stream into lists of `size` items"""
+    page = []
+    for item in items:
+        page.append(item)
+        if len(page) == size:
+            yield page
+            page = []
+    if page:
+        yield page
+
+
+def fetch_contacts(contact_ids, select=CONTACT_SELECT):
+    """Load contacts for one page of deals with a single crm.contact.list call"""
+    if not contact_ids:
+        return {}
+    contacts = iter_list('crm.contact.list', {'ID': sorted(contact_ids)}, select)
+    return {str(contact['ID']): contact for contact in contacts}
+
+
+def plan_page(deals, contacts, writes):
+    """Queue the changed fields of one page of deals; returns (deals_changed, contacts_changed)"""
+    deals_changed = 0
+    seen_contacts = set()
+    for deal in deals:
+        contact = contacts.get(str(deal.get('CONTACT_ID')))
+        if not contact:
+            continue
+        contact_updates, deal_updates = build_updates(deal, contact)
+        contact_updates = diff_fields(contact, contact_updates)
+        deal_updates = diff_fields(deal, deal_updates)
+
+        # Один контакт может быть привязан к нескольким сделкам на странице
+        if contact_updates and contact['ID'] not in seen_contacts:
+            seen_contacts.add(contact['ID'])
+            writes.add(f"contact_{contact['ID']}", 'crm.contact.update',
+                       {'ID': contact['ID'], 'fields': contact_updates})
+        if deal_updates:
+            deals_changed += 1
+            writes.add(f"deal_{deal['ID']}", 'crm.deal.update', {'ID': deal['ID'], 'fields': deal_updates})
+    return deals_changed, len(seen_contacts)
+
+
+def index_page(deals, contacts):
+    """Add the phones of one page of deals to the duplicate index"""
+    rows = []
+    for deal in deals:
+        contact = contacts.get(str(deal.get('CONTACT_ID')))
+        if contact:
+            for phone in valid_contact_phones(contact):
+                rows += [(phone, contact['ID'], deal['ID']), (phone, contact['ID'], 0)]
+    return phone_index.add_many(rows)
+
+
+def report(state, scanned_this_run, started_at, calls_at_start):
+    elapsed = max(time.monotonic() - started_at, 1e-9)
+    calls = bitrix.calls - calls_at_start
+    print(
+        f"last_id={state['last_id']} scanned={state['scanned']} "
+        f"deals_updated={state['deals_updated']} contacts_updated={state['contacts_updated']} "
+        f"errors={state['errors']} | {scanned_this_run / elapsed:.1f} deals/s, "
+        f"{calls / elapsed:.2f} API calls/s",
+        file=sys.stderr,
+        flush=True,
+    )
+
+
+def run(args):
+    state = None if args.restart else load_checkpoint(args.checkpoint)
+    if state:
+        print(f"Resuming after deal {state['last_id']}", file=sys.stderr)
+    else:
+        state = {'last_id': 0, 'scanned': 0, 'deals_updated': 0, 'contacts_updated': 0, 'errors': 0}
+    scanned_this_run = 0
+
+    bitrix.max_rate = args.rate
+    started_at = time.monotonic()
+    calls_at_start = bitrix.calls
+
+    if args.phone_index:
+        deal_select, contact_select = INDEX_DEAL_SELECT, INDEX_CONTACT_SELECT
+    else:
+        deal_select, contact_select = DEAL_SELECT, CONTACT_SELECT
+    for page in pages(iter_deals({}, deal_select, start_id=state['last_id']), LIST_PAGE_SIZE):
+        contact_ids = {str(deal['CONTACT_ID']) for deal in page if deal.get('CONTACT_ID') not in (None, '', '0', 0)}
+        contacts = fetch_contacts(contact_ids, contact_select)
+        if not args.dry_run:
+            index_page(page, contacts)
+
+        writes = BitrixBatch()
+        deals_changed, contacts_changed = (0, 0) if args.phone_index else plan_page(page, contacts, writes)
+        if writes and not args.dry_run:
+            _, errors = writes.execute()
+            state['errors'] += len(errors)
+            for name in errors:
+                logging.error("Backfill write %s failed: %s", name, errors[name])
+
+        state['deals_updated'] += deals_changed
+        state['contacts_updated'] += contacts_changed
+        state['scanned'] += len(page)
+        scanned_this_run += len(page)
+        state['last_id'] = int(page[-1]['ID'])
+        if not args.dry_run:
+            save_checkpoint(args.checkpoint, state)
+
+        if scanned_this_run % (LIST_PAGE_SIZE * args.report_every) == 0:
+            report(state, scanned_this_run, started_at, calls_at_start)
+        if args.limit and scanned_this_run >= args.limit:
+            break
+
+    report(state, scanned_this_run, started_at, calls_at_start)
+    return 1 if state['errors'] else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rate', type=float, default=2.0, help='max Bitrix24 API calls per second (default 2)')
+    parser.add_argument('--checkpoint', help='checkpoint file path (default backfill_checkpoint.json, '
+                                               'phone_index_checkpoint.json with --phone-index)')
+    parser.add_argument('--restart', action='store_true', help='ignore the checkpoint and start from the first deal')
+    parser.add_argument('--dry-run', action='store_true', help='compute and count changes without writing')
+    parser.add_argument('--limit', type=int, default=0, help='stop after this many deals (0 = all)')
+    parser.add_argument('--report-every', type=int, default=10, help='print progress every N pages')
+    parser.add_argument('--phone-index', action='store_true', help='only build the duplicate phone index, no writes')
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args(argv)
+    if not args.checkpoint:
+        args.checkpoint = 'phone_index_checkpoint.json' if args.phone_index else 'backfill_checkpoint.json'
+
+    logging.getLogger().setLevel(args.log_level.upper())
+    with bitrix_priority(PRIORITY_BULK):
+        return run(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,297 @@
+"""
+Replay webhook bursts against the app and report latency, throughput and API usage.
+
+By default both the app and bitrix_emulator.py run in this process on free
+ports, so nothing touches the production portal. With --app-url and
+--emulator-url the benchmark drives servers that are already running (for
+example gunicorn started with BITRIX_WEBHOOK_URL pointing at the emulator).
+
+Scenarios:
+    webhook  - deal events on /webhook, each deal repeated --repeat times the
+               way Bitrix24 fires ONCRMDEALADD + ONCRMDEALUPDATE
+    contact  - /contact-update for distinct contacts
+    stale    - sequential /check-stale-deals runs
+    reads    - the deal + contact read of a webhook event, sent straight to the
+               emulator twice: as crm.*.get (every field) and as crm.*.list
+               with filter[ID] and the handlers' select list
+
+For each app scenario it prints p50/p99/max latency, requests per second and
+Bitrix24 requests (and batch sub-commands) per event, as counted by the
+emulator. For reads it prints response bytes, JSON parse time and fields per
+entity for both variants (--uf-fields sets how many custom fields the
+emulator's entities carry).
+
+Usage:
+    python benchmark.py [--events 200] [--concurrency 20] [--scenarios webhook,contact,stale] [--latency 0.05] [--rate 2]
+    python benchmark.py --asgi   # the same scenarios against async_app under uvicorn
+    python benchmark.py --app-url http://127.0.0.1:10000 --emulator-url http://127.0.0.1:8900
+"""
+import argparse
+import json
+import logging
+import math
+import os
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from werkzeug.serving import make_server
+
+import bitrix_emulator
+
+SCENARIOS = ('webhook', 'contact', 'stale', 'reads')
+APP_SCENARIOS = ('webhook', 'contact', 'stale')
+
+
+def serve(wsgi_app):
+    """Start a threaded WSGI server on a free local port; returns its base URL"""
+    server = make_server('127.0.0.1', 0, wsgi_app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}"
+
+
+def serve_asgi(asgi_app):
+    """Start uvicorn with an ASGI app on a free local port in a background thread"""
+    import uvicorn
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(asgi_app, host='127.0.0.1', port=port, log_level='warning'))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+    return f"http://127.0.0.1:{port}"
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of a non-empty list"""
+    ordered = sorted(values)
+    return ordered[max(math.ceil(p / 100 * len(ordered)) - 1, 0)]
+
+
+def webhook_events(args, rng):
+    """Deal IDs in burst order: every deal fires --repeat events close together"""
+    deal_ids = rng.sample(range(1, args.deals + 1), min(args.events // max(args.repeat, 1) or 1, args.deals))
+    events = []
+    for deal_id in deal_ids:
+        for i in range(args.repeat):
+            event = 'ONCRMDEALADD' if i == 0 else 'ONCRMDEALUPDATE'
+            events.append(('POST', '/webhook', {'event': event, 'data[FIELDS][ID]': str(deal_id)}))
+    # Соседние события перемешиваются, но остаются рядом, как в реальном потоке
+    for i in range(len(events) - 1):
+        if rng.random() < 0.3:
+            events[i], events[i + 1] = events[i + 1], events[i]
+    return events[:args.events]
+
+
+def contact_events(args, rng):
+    contacts = max(args.deals * 2 // 3, 1)
+    contact_ids = rng.sample(range(1, contacts + 1), min(args.events, contacts))
+    return [('POST', f'/contact-update?contact_id={contact_id}', None) for contact_id in contact_ids]
+
+
+def stale_events(args, rng):
+    return [('GET', '/check-stale-deals', None)] * args.stale_runs
+
+
+def read_commands(variant, deal_id):
+    """Batch commands reading a deal and its contact: full crm.*.get or projected crm.*.list"""
+    from app import CONTACT_SELECT, DEAL_READ_SELECT, build_query, projection_params
+    if variant == 'get':
+        commands = [('deal', 'crm.deal.get', {'ID': deal_id}),
+                    ('contact', 'crm.contact.get', {'ID': '$result[deal][CONTACT_ID]'})]
+    else:
+        commands = [('deal', 'crm.deal.list', projection_params(deal_id, DEAL_READ_SELECT)),
+                    ('contact', 'crm.contact.list', projection_params('$result[deal][0][CONTACT_ID]', CONTACT_SELECT))]
+    return {name: f"{method}?{build_query(params)}" for name, method, params in commands}
+
+
+def compare_reads(session, emulator_url, deal_ids):
+    """Payload size and parse time of both read variants for the same deals"""
+    results = []
+    for variant in ('get', 'select'):
+        sizes, parse_times, fields = [], [], []
+        for deal_id in deal_ids:
+            response = session.post(f"{emulator_url}/rest/1/emulator/batch",
+                                    json={"halt": 0, "cmd": read_commands(variant, deal_id)}, timeout=30)
+            started = time.perf_counter()
+            data = json.loads(response.content)
+            parse_times.append(time.perf_counter() - started)
+            sizes.append(len(response.content))
+            for entity in data['result']['result'].values():
+                entity = entity[0] if isinstance(entity, list) and entity else entity
+                if isinstance(entity, dict):
+                    fields.append(len(entity))
+        results.append({
+            "variant": variant,
+            "events": len(deal_ids),
+            "bytes_per_event": round(sum(sizes) / len(sizes)),
+            "parse_us_p50": round(percentile(parse_times, 50) * 1e6, 1),
+            "parse_us_p99": round(percentile(parse_times, 99) * 1e6, 1),
+            "fields_per_entity": round(sum(fields) / max(len(fields), 1), 1),
+        })
+    return results
+
+
+def print_reads_report(results):
+    header = f"{'reads':<9} {'events':>6} {'bytes/evt':>10} {'parse p50 us':>13} {'parse p99 us':>13} {'fields':>7}"
+    print(header)
+    print('-' * len(header))
+    for r in results:
+        print(f"{r['variant']:<9} {r['events']:>6} {r['bytes_per_event']:>10} {r['parse_us_p50']:>13} "
+              f"{r['parse_us_p99']:>13} {r['fields_per_entity']:>7}")
+
+
+class Benchmark:
+    def __init__(self, app_url, emulator_url, concurrency):
+        self.app_url = app_url.rstrip('/')
+        self.emulator_url = emulator_url.rstrip('/')
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=max(concurrency, 10))
+        self.session.mount('http://', adapter)
+
+    def emulator_stats(self):
+        return self.session.get(f"{self.emulator_url}/_emulator/stats", timeout=10).json()
+
+    def wait_idle(self, timeout=300):
+        """Wait until the app's job queue drains and coalesced events got their trailing runs"""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            stats = self.session.get(f"{self.app_url}/jobs", timeout=10).json()
+            if not stats.get('queue_depth') and not stats.get('running') and not stats.get('trailing_runs_scheduled'):
+                return
+            time.sleep(0.05)
+
+    def send(self, event):
+        method, path, data = event
+        started = time.perf_counter()
+        try:
+            response = self.session.request(method, f"{self.app_url}{path}", data=data, timeout=300)
+            status_code = response.status_code
+        except requests.RequestException:
+            status_code = 0
+        return time.perf_counter() - started, status_code
+
+    def run(self, name, events, concurrency):
+        before = self.emulator_stats()
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            samples = list(pool.map(self.send, events))
+        elapsed = time.perf_counter() - started
+        # API-вызовы считаем вместе с фоновой обработкой и повторными запусками схлопнутых событий
+        self.wait_idle()
+        after = self.emulator_stats()
+
+        latencies = [latency for latency, _ in samples]
+        statuses = {}
+        for _, status_code in samples:
+            statuses[status_code] = statuses.get(status_code, 0) + 1
+        return {
+            "scenario": name,
+            "events": len(events),
+            "concurrency": concurrency,
+            "statuses": statuses,
+            "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 1),
+            "max_ms": round(max(latencies) * 1000, 1),
+            "rps": round(len(events) / elapsed, 1),
+            "api_requests_per_event": round((after['requests'] - before['requests']) / len(events), 2),
+            "api_commands_per_event": round((after['commands'] - before['commands']) / len(events), 2),
+            "rate_limited": after['rate_limited'] - before['rate_limited'],
+            "injected_errors": after['injected_errors'] - before['injected_errors'],
+        }
+
+
+def print_report(results):
+    header = f"{'scenario':<9} {'events':>6} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8} {'req/s':>7} " \
+             f"{'API/evt':>8} {'cmd/evt':>8} {'429/503':>7}  statuses"
+    print(header)
+    print('-' * len(header))
+    for r in results:
+        statuses = ' '.join(f"{code}:{count}" for code, count in sorted(r['statuses'].items()))
+        print(f"{r['scenario']:<9} {r['events']:>6} {r['p50_ms']:>8} {r['p99_ms']:>8} {r['max_ms']:>8} "
+              f"{r['rps']:>7} {r['api_requests_per_event']:>8} {r['api_commands_per_event']:>8} "
+              f"{r['rate_limited']:>7}  {statuses}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--app-url', help='benchmark an already running app instead of an in-process one')
+    parser.add_argument('--emulator-url', help='emulator used by --app-url (default: start one in-process)')
+    parser.add_argument('--asgi', action='store_true', help='benchmark async_app under uvicorn instead of app.py')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='comma-separated: webhook,contact,stale,reads')
+    parser.add_argument('--events', type=int, default=200, help='events per scenario (default 200)')
+    parser.add_argument('--repeat', type=int, default=3, help='webhook events per deal (default 3)')
+    parser.add_argument('--stale-runs', type=int, default=3, help='/check-stale-deals calls (default 3)')
+    parser.add_argument('--concurrency', type=int, default=20, help='parallel clients (default 20)')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    parser.add_argument('--log-level', default='WARNING')
+    bitrix_emulator.add_arguments(parser)
+    args = parser.parse_args(argv)
+
+    logging.getLogger().setLevel(args.log_level.upper())
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    logging.getLogger('urllib3').setLevel(logging.ERROR)
+
+    emulator_url = args.emulator_url
+    if not emulator_url:
+        bitrix_emulator.configure(args)
+        emulator_url = serve(bitrix_emulator.emulator)
+        if args.app_url:
+            print(f"Emulator: {emulator_url}/rest/1/emulator/ (start the app with BITRIX_WEBHOOK_URL set to it)",
+                  file=sys.stderr)
+
+    app_url = args.app_url
+    if not app_url:
+        # Индекс дубликатов и состояние сделок бенчмарка не должны смешиваться с рабочими
+        workdir = tempfile.mkdtemp()
+        os.environ.setdefault('PHONE_INDEX_PATH', os.path.join(workdir, 'phone_index.sqlite3'))
+        os.environ.setdefault('STALE_STATE_PATH', os.path.join(workdir, 'stale_state.sqlite3'))
+        os.environ.setdefault('SCHEDULER_DB_PATH', os.path.join(workdir, 'scheduler.sqlite3'))
+        os.environ.setdefault('SCHEDULER_ENABLED', '0')  # Плановая проверка не должна вклиниться в замеры
+        # Лимитер приложения настраивается под лимит эмулятора (--rate 0 - без ограничения)
+        os.environ.setdefault('BITRIX_RATE_LIMIT', str(args.rate))
+        os.environ.setdefault('BITRIX_RATE_LIMIT_PATH', os.path.join(workdir, 'rate_limit.sqlite3'))
+        import app as webhook_app
+        logging.getLogger().setLevel(args.log_level.upper())
+        webhook_app.bitrix.base_url = f"{emulator_url}/rest/1/emulator/"
+        if args.asgi:
+            import async_app
+            async_app.bitrix.base_url = webhook_app.bitrix.base_url
+            app_url = serve_asgi(async_app.app)
+        else:
+            app_url = serve(webhook_app.app)
+
+    rng = random.Random(args.seed)
+    generators = {'webhook': webhook_events, 'contact': contact_events, 'stale': stale_events}
+    benchmark = Benchmark(app_url, emulator_url, args.concurrency)
+    results, reads = [], []
+    for name in args.scenarios.split(','):
+        name = name.strip()
+        if name == 'reads':
+            deal_ids = [rng.randint(1, args.deals) for _ in range(args.events)]
+            reads = compare_reads(benchmark.session, benchmark.emulator_url, deal_ids)
+            continue
+        if name not in generators:
+            parser.error(f"unknown scenario: {name}")
+        concurrency = 1 if name == 'stale' else args.concurrency
+        results.append(benchmark.run(name, generators[name](args, rng), concurrency))
+
+    if args.json:
+        print(json.dumps(results + reads, indent=2))
+    else:
+        if results:
+            print_report(results)
+        if reads:
+            print_reads_report(reads)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,453 @@
+"""
+Local stand-in for the Bitrix24 REST API, for benchmarks and manual testing.
+
+Serves the methods app.py uses: crm.deal.get/list/update,
+crm.contact.get/list/update, crm.timeline.comment.add, im.notify and batch
+(with $result[...] references), on an in-memory store seeded with generated
+deals and contacts. Latency, the portal rate limit (leaky bucket,
+QUERY_LIMIT_EXCEEDED when full) and random 500 errors are configurable
+from the command line or at runtime via POST /_emulator/config.
+
+Usage:
+    python bitrix_emulator.py [--port 8900] [--deals 2000] [--latency 0.05] [--rate 2 --burst 50] [--error-rate 0.01]
+    BITRIX_WEBHOOK_URL=http://127.0.0.1:8900/rest/1/emulator/ gunicorn app:app
+
+GET /_emulator/stats returns call counters; POST /_emulator/reset clears them.
+"""
+import argparse
+import random
+import re
+import sys
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from urllib.parse import parse_qsl
+
+from flask import Flask, jsonify, request
+
+PORTAL_TZ = timezone(timedelta(hours=3))
+
+CITIES = ['Москва', 'Казань', 'Екатеринбург', 'Новосибирск', 'Краснодар', 'Самара', 'Омск', 'Пермь']
+STAGES = ['NEW', 'PREPARATION', 'PREPAYMENT_INVOICE', 'EXECUTING', 'FINAL_INVOICE', 'WON', 'LOSE', 'UC_3IJV6C']
+CLOSED_STAGES = {'WON', 'LOSE'}
+JOB_TITLES = ['Курьер', 'Водитель', 'Кладовщик', 'Продавец-кассир', 'Оператор call-центра']
+PHONE_FORMATS = ['+7 (9{0:02d}) {1:03d}-{2:02d}-{3:02d}', '89{0:02d}{1:03d}{2:02d}{3:02d}', '9{0:02d} {1:03d} {2:02d} {3:02d}']
+
+RESULT_REFERENCE = re.compile(r'\$result\[([^\]]+)\]((?:\[[^\]]*\])*)')
+FILTER_OPERATOR = re.compile(r'^(>=|<=|!=|>|<|!|=|%)?(.+)$')
+NUMERIC_FIELDS = {'ID', 'CONTACT_ID', 'COMPANY_ID', 'ASSIGNED_BY_ID', 'CREATED_BY_ID', 'MODIFY_BY_ID'}
+
+
+class NotFound(Exception):
+    pass
+
+
+def now_iso():
+    return datetime.now(PORTAL_TZ).strftime('%Y-%m-%dT%H:%M:%S+03:00')
+
+
+def parse_query(query):
+    """'filter[ID][0]=1&select[0]=ID' -> {'filter': {'ID': ['1']}, 'select': ['ID']}"""
+    root = {}
+    for key, value in parse_qsl(query, keep_blank_values=True):
+        parts = re.findall(r'[^\[\]]+', key)
+        node = root
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+        node[parts[-1]] = value
+    return _listify(root)
+
+
+def _listify(node):
+    """PHP-style arrays with keys 0..n-1 become lists"""
+    if not isinstance(node, dict):
+        return node
+    node = {key: _listify(value) for key, value in node.items()}
+    if node and all(key.isdigit() for key in node) and sorted(map(int, node)) == list(range(len(node))):
+        return [node[str(i)] for i in range(len(node))]
+    return node
+
+
+def resolve_references(value, results):
+    """Substitute $result[name][FIELD]... with values returned by earlier batch commands"""
+    if isinstance(value, dict):
+        return {key: resolve_references(item, results) for key, item in value.items()}
+    if isinstance(value, list):
+        return [resolve_references(item, results) for item in value]
+    if not isinstance(value, str) or '$result[' not in value:
+        return value
+
+    def lookup(match):
+        node = results.get(match.group(1))
+        for key in re.findall(r'\[([^\]]*)\]', match.group(2)):
+            if isinstance(node, list) and key.isdigit() and int(key) < len(node):
+                node = node[int(key)]
+            elif isinstance(node, dict):
+                node = node.get(key)
+            else:
+                node = None
+        return '' if node is None else str(node)
+
+    return RESULT_REFERENCE.sub(lookup, value)
+
+
+def _comparable(field, value):
+    if field in NUMERIC_FIELDS:
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return 0
+    if field.startswith('DATE_') or field.endswith('_TIME'):
+        try:
+            moment = datetime.fromisoformat(str(value))
+        except ValueError:
+            return None
+        return moment if moment.tzinfo else moment.replace(tzinfo=PORTAL_TZ)
+    return '' if value is None else str(value)
+
+
+def matches(item, filter):
+    """Subset of the crm.*.list filter syntax: =, !, >, <, >=, <=, %, list values mean IN"""
+    for key, expected in (filter or {}).items():
+        operator, field = FILTER_OPERATOR.match(key).groups()
+        actual = _comparable(field, item.get(field))
+        if isinstance(expected, dict):
+            expected = list(expected.values())
+        if isinstance(expected, list):
+            values = [_comparable(field, value) for value in expected]
+            found = actual in values
+            if found == (operator in ('!', '!=')):
+                return False
+            continue
+        expected = _comparable(field, expected)
+        if actual is None or expected is None:
+            return False
+        if operator == '%':
+            if str(expected).lower() not in str(actual).lower():
+                return False
+        elif operator in ('!', '!='):
+            if actual == expected:
+                return False
+        elif operator == '>' and not actual > expected:
+            return False
+        elif operator == '<' and not actual < expected:
+            return False
+        elif operator == '>=' and not actual >= expected:
+            return False
+        elif operator == '<=' and not actual <= expected:
+            return False
+        elif operator in (None, '=') and actual != expected:
+            return False
+    return True
+
+
+class EmulatorStore:
+    """In-memory deals and contacts plus everything written by the app"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.deals = {}
+        self.contacts = {}
+        self.notifications = []
+        self.comments = []
+
+    def seed(self, deals=2000, contacts=None, managers=10, duplicate_rate=0.05, uf_fields=0, seed=1):
+        """
+        Generate contacts (some sharing phones) and deals with realistic stages and dates.
+        uf_fields adds that many custom UF_CRM_* fields to every deal and contact, the way a
+        real portal's crm.*.get returns all of them.
+        """
+        rng = random.Random(seed)
+        field_rng = random.Random(seed)  # Отдельный генератор: сделки и контакты не зависят от uf_fields
+        custom = {
+            f'UF_CRM_{1700000000000 + i}': field_rng.choice([None, '', '0', 'N', f'Значение поля {i}', ['1', '2'], 12.5])
+            for i in range(uf_fields)
+        }
+        contacts = contacts or max(deals * 2 // 3, 1)
+        now = datetime.now(PORTAL_TZ)
+        with self.lock:
+            self.deals.clear()
+            self.contacts.clear()
+            phones = []
+            for contact_id in range(1, contacts + 1):
+                if phones and rng.random() < duplicate_rate:
+                    phone = rng.choice(phones)  # повторный отклик с тем же телефоном
+                else:
+                    digits = (rng.randint(0, 99), rng.randint(0, 999), rng.randint(0, 99), rng.randint(0, 99))
+                    phone = rng.choice(PHONE_FORMATS).format(*digits)
+                    phones.append(phone)
+                city = rng.choice(CITIES)
+                self.contacts[contact_id] = {
+                    **custom,
+                    'ID': str(contact_id),
+                    'NAME': f'Кандидат{contact_id}',
+                    'LAST_NAME': rng.choice(['Иванов', 'Петрова', None]),
+                    'PHONE': [{'ID': str(contact_id), 'VALUE_TYPE': 'MOBILE', 'VALUE': phone, 'TYPE_ID': 'PHONE'}],
+                    'COMMENTS': rng.choice([f'Город: {city}', f'Откликнулся с Авито, живу в г. {city}', '']),
+                    'ADDRESS_CITY': rng.choice([city, None]),
+                    'DATE_MODIFY': now.strftime('%Y-%m-%dT%H:%M:%S+03:00'),
+                }
+            for deal_id in range(1, deals + 1):
+                stage = rng.choice(STAGES)
+                modified = now - timedelta(hours=rng.uniform(0, 24 * 14))
+                self.deals[deal_id] = {
+                    **custom,
+                    'ID': str(deal_id),
+                    'TITLE': rng.choice(JOB_TITLES),
+                    'CONTACT_ID': str(rng.randint(1, contacts)),
+                    'STAGE_ID': stage,
+                    'CLOSED': 'Y' if stage in CLOSED_STAGES else 'N',
+                    'ASSIGNED_BY_ID': str(rng.randint(1, managers)),
+                    'COMMENTS': rng.choice(['', f'Кандидат из города {rng.choice(CITIES)}']),
+                    'DATE_MODIFY': modified.strftime('%Y-%m-%dT%H:%M:%S+03:00'),
+                    'MOVED_TIME': modified.strftime('%Y-%m-%dT%H:%M:%S+03:00'),
+                }
+
+    def _entities(self, method):
+        return self.deals if method.startswith('crm.deal.') else self.contacts
+
+    def call(self, method, params):
+        """Run one REST method against the store; raises NotFound, KeyError for unknown methods"""
+        params = params or {}
+        with self.lock:
+            if method in ('crm.deal.get', 'crm.contact.get'):
+                item = self._entities(method).get(_comparable('ID', params.get('ID') or params.get('id')))
+                if item is None:
+                    raise NotFound()
+                return dict(item), {}
+            if method in ('crm.deal.list', 'crm.contact.list'):
+                return self._list(self._entities(method), params)
+            if method in ('crm.deal.update', 'crm.contact.update'):
+                item = self._entities(method).get(_comparable('ID', params.get('ID') or params.get('id')))
+                if item is None:
+                    raise NotFound()
+                item.update(params.get('fields') or {})
+                item['DATE_MODIFY'] = now_iso()
+                return True, {}
+            if method == 'im.notify':
+                self.notifications.append(params)
+                return len(self.notifications), {}
+            if method == 'crm.timeline.comment.add':
+                self.comments.append(params.get('fields') or {})
+                return len(self.comments), {}
+        raise KeyError(method)
+
+    def _list(self, entities, params):
+        order = params.get('order') or {'ID': 'ASC'}
+        reverse = str(order.get('ID', 'ASC')).upper() == 'DESC'
+        items = [item for item in entities.values() if matches(item, params.get('filter'))]
+        items.sort(key=lambda item: int(item['ID']), reverse=reverse)
+        start = int(params.get('start') or 0)
+        page = items[max(start, 0):max(start, 0) + 50]
+        select = params.get('select') or ['*']
+        if isinstance(select, dict):
+            select = list(select.values())
+        if '*' not in select:
+            page = [{key: item.get(key) for key in set(select) | {'ID'}} for item in page]
+        else:
+            page = [dict(item) for item in page]
+        extra = {}
+        if start >= 0:
+            extra['total'] = len(items)
+            if start + 50 < len(items):
+                extra['next'] = start + 50
+        return page, extra
+
+
+class Emulator:
+    """HTTP side: latency, leaky-bucket rate limit, error injection and counters"""
+
+    def __init__(self, store, latency=0.0, jitter=0.0, rate=0.0, burst=50, error_rate=0.0):
+        self.store = store
+        self.latency = latency
+        self.jitter = jitter
+        self.rate = rate
+        self.burst = burst
+        self.error_rate = error_rate
+        self.lock = threading.Lock()
+        self.bucket_level = 0.0
+        self.bucket_updated = time.monotonic()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.requests = 0
+            self.commands = 0
+            self.rate_limited = 0
+            self.injected_errors = 0
+            self.by_method = {}
+
+    def stats(self):
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "commands": self.commands,
+                "rate_limited": self.rate_limited,
+                "injected_errors": self.injected_errors,
+                "by_method": dict(self.by_method),
+                "notifications": len(self.store.notifications),
+                "comments": len(self.store.comments),
+                "config": self.config(),
+            }
+
+    def config(self):
+        return {"latency": self.latency, "jitter": self.jitter, "rate": self.rate,
+                "burst": self.burst, "error_rate": self.error_rate}
+
+    def _admit(self):
+        """Leaky bucket like the portal's: `burst` requests, drained at `rate` per second"""
+        if not self.rate:
+            return True
+        with self.lock:
+            now = time.monotonic()
+            self.bucket_level = max(0.0, self.bucket_level - (now - self.bucket_updated) * self.rate)
+            self.bucket_updated = now
+            if self.bucket_level + 1 > self.burst:
+                self.rate_limited += 1
+                return False
+            self.bucket_level += 1
+            return True
+
+    def _count(self, method):
+        with self.lock:
+            self.commands += 1
+            self.by_method[method] = self.by_method.get(method, 0) + 1
+
+    def _run(self, method, params):
+        """One command -> (result, extra, error)"""
+        self._count(method)
+        try:
+            result, extra = self.store.call(method, params)
+            return result, extra, None
+        except NotFound:
+            return None, {}, {"error": "", "error_description": "Not found"}
+        except KeyError:
+            return None, {}, {"error": "ERROR_METHOD_NOT_FOUND", "error_description": "Method not found!"}
+
+    def handle(self, method, params):
+        """Return (body, status_code) for a REST request"""
+        with self.lock:
+            self.requests += 1
+        if self.latency or self.jitter:
+            time.sleep(self.latency + random.uniform(0, self.jitter))
+        if not self._admit():
+            return {"error": "QUERY_LIMIT_EXCEEDED", "error_description": "Too many requests"}, 503
+        if self.error_rate and random.random() < self.error_rate:
+            with self.lock:
+                self.injected_errors += 1
+            return {"error": "INTERNAL_SERVER_ERROR", "error_description": "Injected error"}, 500
+
+        started = time.time()
+        if method == 'batch':
+            body = self._batch(params)
+        else:
+            result, extra, error = self._run(method, params)
+            if error:
+                return error, 400
+            body = {"result": result, **extra}
+        body["time"] = {"start": started, "finish": time.time(), "duration": time.time() - started}
+        return body, 200
+
+    def _batch(self, params):
+        results, errors, totals, nexts = {}, {}, {}, {}
+        halt = str(params.get('halt', '0')) not in ('0', '', 'N', 'false', 'False')
+        commands = params.get('cmd') or {}
+        for name, command in list(commands.items())[:50]:
+            method, _, query = command.partition('?')
+            command_params = resolve_references(parse_query(query), results)
+            result, extra, error = self._run(method, command_params)
+            if error:
+                errors[name] = error
+                if halt:
+                    break
+                continue
+            results[name] = result
+            if 'total' in extra:
+                totals[name] = extra['total']
+            if 'next' in extra:
+                nexts[name] = extra['next']
+        # PHP отдаёт пустые объекты как []
+        return {"result": {
+            "result": results or [],
+            "result_error": errors or [],
+            "result_total": totals or [],
+            "result_next": nexts or [],
+        }}
+
+
+store = EmulatorStore()
+emulator_state = Emulator(store)
+emulator = Flask(__name__)
+
+
+@emulator.route('/rest/<user_id>/<token>/<method>', methods=['GET', 'POST'])
+def rest(user_id, token, method):
+    if method.endswith('.json'):
+        method = method[:-5]
+    if request.is_json:
+        params = request.get_json(silent=True) or {}
+    else:
+        params = parse_query(request.get_data(as_text=True) or request.query_string.decode())
+    body, status_code = emulator_state.handle(method, params)
+    return jsonify(body), status_code
+
+
+@emulator.route('/_emulator/stats', methods=['GET'])
+def stats():
+    return jsonify(emulator_state.stats())
+
+
+@emulator.route('/_emulator/reset', methods=['POST'])
+def reset():
+    emulator_state.reset()
+    return jsonify({"status": "ok"})
+
+
+@emulator.route('/_emulator/config', methods=['GET', 'POST'])
+def config():
+    for key, value in (request.get_json(silent=True) or {}).items():
+        if key in emulator_state.config():
+            setattr(emulator_state, key, type(getattr(emulator_state, key))(value))
+    return jsonify(emulator_state.config())
+
+
+def add_arguments(parser):
+    """Emulator options, shared with benchmark.py"""
+    parser.add_argument('--deals', type=int, default=2000, help='deals to generate (default 2000)')
+    parser.add_argument('--managers', type=int, default=10, help='responsible users to spread deals over')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds added to every API request')
+    parser.add_argument('--jitter', type=float, default=0.02, help='extra random latency, 0..N seconds')
+    parser.add_argument('--rate', type=float, default=0.0, help='portal rate limit, requests/s (0 = unlimited)')
+    parser.add_argument('--burst', type=int, default=50, help='requests allowed above the rate limit')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests failing with 500')
+    parser.add_argument('--uf-fields', type=int, default=150,
+                        help='custom UF_CRM_* fields per deal/contact, returned by *.get (default 150)')
+    parser.add_argument('--seed', type=int, default=1)
+
+
+def configure(args):
+    store.seed(deals=args.deals, managers=args.managers, uf_fields=args.uf_fields, seed=args.seed)
+    emulator_state.latency = args.latency
+    emulator_state.jitter = args.jitter
+    emulator_state.rate = args.rate
+    emulator_state.burst = args.burst
+    emulator_state.error_rate = args.error_rate
+    emulator_state.reset()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8900)
+    add_arguments(parser)
+    args = parser.parse_args(argv)
+
+    configure(args)
+    print(f"Bitrix24 emulator: http://{args.host}:{args.port}/rest/1/emulator/ "
+          f"({len(store.deals)} deals, {len(store.contacts)} contacts)", file=sys.stderr)
+    emulator.run(host=args.host, port=args.port, threaded=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,156 @@
+"""
+Build the city -> timezone gazetteer used by app.get_timezone_from_city.
+
+Input is a GeoNames country dump (RU.txt or RU.zip from
+https://download.geonames.org/export/dump/), optionally several countries.
+Every populated place contributes its name, ASCII name and Cyrillic/Latin
+alternate names (plus Russian case forms), normalized the same way the
+app normalizes lookups. When two places share a name the more populous
+one wins.
+
+Usage:
+    python build_gazetteer.py RU.zip KZ.zip -o data/gazetteer.bin
+"""
+import argparse
+import io
+import os
+import re
+import sys
+import zipfile
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+from app import Gazetteer, _declensions, normalize_city_name
+
+# Сокращения в том же стиле, что и CITY_TIMEZONES в app.py
+TZ_ABBREVIATIONS = {
+    'Europe/Kaliningrad': 'КЛД',
+    'Europe/Moscow': 'МСК',
+    'Europe/Simferopol': 'МСК',
+    'Europe/Kirov': 'МСК',
+    'Europe/Volgograd': 'МСК',
+    'Europe/Samara': 'СМР',
+    'Europe/Astrakhan': 'АСТ',
+    'Europe/Saratov': 'СРТ',
+    'Europe/Ulyanovsk': 'УЛН',
+    'Asia/Yekaterinburg': 'ЕКБ',
+    'Asia/Omsk': 'ОМС',
+    'Asia/Novosibirsk': 'НСК',
+    'Asia/Barnaul': 'БРН',
+    'Asia/Tomsk': 'ТМС',
+    'Asia/Novokuznetsk': 'НКЗ',
+    'Asia/Krasnoyarsk': 'КРС',
+    'Asia/Irkutsk': 'ИРК',
+    'Asia/Chita': 'ЧТ',
+    'Asia/Yakutsk': 'ЯКТ',
+    'Asia/Khandyga': 'ЯКТ',
+    'Asia/Vladivostok': 'ВЛД',
+    'Asia/Ust-Nera': 'ВЛД',
+    'Asia/Magadan': 'МГД',
+    'Asia/Sakhalin': 'СХЛ',
+    'Asia/Srednekolymsk': 'СРК',
+    'Asia/Kamchatka': 'КМЧ',
+    'Asia/Anadyr': 'АНД',
+}
+
+NAME_SCRIPT = re.compile(r'^[а-яёa-z][а-яёa-z\s\-.]*$', re.IGNORECASE)
+CYRILLIC = re.compile(r'[а-яё]')
+
+
+def timezone_label(zone):
+    """'Asia/Yekaterinburg' -> 'ЕКБ (UTC+5)'"""
+    offset = datetime.now(ZoneInfo(zone)).utcoffset()
+    hours, rest = divmod(int(offset.total_seconds()), 3600)
+    utc = f"UTC{hours:+d}" + (f":{rest // 60:02d}" if rest else "")
+    abbreviation = TZ_ABBREVIATIONS.get(zone)
+    return f"{abbreviation} ({utc})" if abbreviation else utc
+
+
+def open_dump(path):
+    """Open a GeoNames dump, either the .txt itself or the .zip it ships in"""
+    if path.endswith('.zip'):
+        archive = zipfile.ZipFile(path)
+        member = os.path.basename(path)[:-4] + '.txt'
+        return io.TextIOWrapper(archive.open(member), encoding='utf-8')
+    return open(path, encoding='utf-8')
+
+
+def read_places(paths):
+    """Yield (names, population, timezone) for populated places"""
+    for path in paths:
+        with open_dump(path) as f:
+            for line in f:
+                columns = line.rstrip('\n').split('\t')
+                if len(columns) < 18 or columns[6] != 'P' or not columns[17]:
+                    continue
+                names = {columns[1], columns[2]}
+                names.update(name for name in columns[3].split(',') if name)
+                population = int(columns[14] or 0)
+                yield names, population, columns[17]
+
+
+def collect(paths):
+    """Normalized name -> (population, timezone) of the most populous place with that name"""
+    entries = {}
+    for names, population, zone in read_places(paths):
+        keys = set()
+        for name in names:
+            if not NAME_SCRIPT.match(name):
+                continue
+            key = normalize_city_name(name)
+            if not key:
+                continue
+            keys.add(key)
+            if CYRILLIC.search(key):
+                keys.update(_declensions(key))
+        # Падежи строятся по написанию с дефисом, ключи - как у app.city_key
+        for key in {key.replace('-', ' ') for key in keys}:
+            if key not in entries or entries[key][0] < population:
+                entries[key] = (population, zone)
+    return entries
+
+
+def write_gazetteer(entries, output):
+    """Serialize entries in the layout documented on app.Gazetteer"""
+    labels = sorted({timezone_label(zone) for _, zone in entries.values()})
+    label_ids = {label: i for i, label in enumerate(labels)}
+    keys = sorted((key.encode('utf-8'), label_ids[timezone_label(zone)]) for key, (_, zone) in entries.items())
+
+    blob = bytearray()
+    index = bytearray()
+    for key, label_id in keys:
+        index += Gazetteer.ENTRY.pack(len(blob), len(key), label_id)
+        blob += key
+    label_table = bytearray()
+    for label in labels:
+        encoded = label.encode('utf-8')
+        label_table += Gazetteer.LABEL.pack(len(blob), len(encoded))
+        blob += encoded
+
+    index_offset = Gazetteer.HEADER.size
+    labels_offset = index_offset + len(index)
+    blob_offset = labels_offset + len(label_table)
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'wb') as f:
+        f.write(Gazetteer.HEADER.pack(Gazetteer.MAGIC, len(keys), len(labels),
+                                      index_offset, labels_offset, blob_offset))
+        f.write(index)
+        f.write(label_table)
+        f.write(blob)
+    return len(keys)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('dumps', nargs='+', help='GeoNames country dumps (.txt or .zip)')
+    parser.add_argument('-o', '--output', default=os.path.join('data', 'gazetteer.bin'))
+    args = parser.parse_args(argv)
+
+    entries = collect(args.dumps)
+    count = write_gazetteer(entries, args.output)
+    print(f"Wrote {count} names to {args.output} ({os.path.getsize(args.output) // 1024} KB)")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
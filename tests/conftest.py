@@ -0,0 +1,20 @@
+import json
+import os
+import sys
+from datetime import date
+
+import pytest
+
+# Модули сервиса лежат в корне репозитория, а не в пакете
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Тестовый клиент Flask не должен запускать планировщик и писать в data/
+os.environ.setdefault('SCHEDULER_ENABLED', '0')
+
+@pytest.fixture(scope='session')
+def production_calendar():
+    """(holidays, workdays) из производственного календаря репозитория"""
+    import app
+    with open(app.PRODUCTION_CALENDAR_PATH, encoding='utf-8') as f:
+        data = json.load(f)
+    return ({date.fromisoformat(value) for value in data['holidays']},
+            {date.fromisoformat(value) for value in data['workdays']})
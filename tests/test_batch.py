@@ -0,0 +1,112 @@
+"""
+BitrixBatch: разбиение на запросы по 50 команд, ссылки $result[...] и
+ошибки отдельных команд. Вместо Bitrix24 - подменённый bitrix.call.
+"""
+from urllib.parse import parse_qsl
+
+import pytest
+
+import app
+
+class FakeCall:
+    """Записывает вызовы batch и отвечает заданными ответами по очереди"""
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.calls = []
+
+    def __call__(self, method, params=None, timeout=None):
+        self.calls.append((method, params))
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+def batch_response(result=None, result_error=None):
+    return {'result': {'result': result or [], 'result_error': result_error or []}}
+
+@pytest.fixture
+def fake_call(monkeypatch):
+    def install(*responses):
+        fake = FakeCall(*responses)
+        monkeypatch.setattr(app.bitrix, 'call', fake)
+        return fake
+    return install
+
+def test_build_query_keeps_result_references():
+    query = app.build_query({'filter': {'ID': '$result[deal][0][CONTACT_ID]'}, 'select': ['ID', 'PHONE']})
+    assert query == 'filter[ID]=$result[deal][0][CONTACT_ID]&select[0]=ID&select[1]=PHONE'
+
+def test_build_query_encodes_values():
+    query = app.build_query({'fields': {'TITLE': 'Иван & Co', 'OPENED': True}})
+    assert parse_qsl(query) == [('fields[TITLE]', 'Иван & Co'), ('fields[OPENED]', 'Y')]
+    assert ' ' not in query and '&Co' not in query
+
+def test_execute_chains_commands_in_one_request(fake_call):
+    fake = fake_call(batch_response({'deal': [{'ID': '1', 'CONTACT_ID': '2'}], 'contact': [{'ID': '2'}]}))
+    batch = app.BitrixBatch()
+    batch.add('deal', 'crm.deal.list', {'filter': {'ID': 1}})
+    batch.add('contact', 'crm.contact.list', {'filter': {'ID': '$result[deal][0][CONTACT_ID]'}})
+    batch.add('fields', 'crm.deal.fields')
+
+    results, errors = batch.execute()
+
+    assert errors == {}
+    assert results['contact'] == [{'ID': '2'}]
+    assert len(fake.calls) == 1
+    method, params = fake.calls[0]
+    assert method == 'batch'
+    assert params['halt'] == 0
+    assert params['cmd'] == {
+        'deal': 'crm.deal.list?filter[ID]=1',
+        'contact': 'crm.contact.list?filter[ID]=$result[deal][0][CONTACT_ID]',
+        'fields': 'crm.deal.fields',
+    }
+
+def test_execute_splits_into_chunks_of_batch_limit(fake_call):
+    count = app.BATCH_LIMIT * 2 + 1
+    fake = fake_call(*[batch_response({f'c{i}': i for i in range(start, min(start + app.BATCH_LIMIT, count))})
+                       for start in range(0, count, app.BATCH_LIMIT)])
+    batch = app.BitrixBatch(halt=True)
+    for i in range(count):
+        batch.add(f'c{i}', 'crm.deal.get', {'ID': i})
+
+    results, errors = batch.execute()
+
+    assert [len(params['cmd']) for _, params in fake.calls] == [app.BATCH_LIMIT, app.BATCH_LIMIT, 1]
+    assert all(params['halt'] == 1 for _, params in fake.calls)
+    assert results == {f'c{i}': i for i in range(count)}
+    assert errors == {}
+
+def test_execute_maps_result_error_per_command(fake_call):
+    fake_call(batch_response(
+        {'ok': True},
+        {'bad': {'error': 'NOT_FOUND', 'error_description': 'Not found'}},
+    ))
+    batch = app.BitrixBatch()
+    batch.add('ok', 'crm.deal.update', {'id': 1, 'fields': {'TITLE': 'x'}})
+    batch.add('bad', 'crm.deal.update', {'id': 2, 'fields': {'TITLE': 'y'}})
+
+    results, errors = batch.execute()
+
+    assert results == {'ok': True}
+    assert errors == {'bad': {'error': 'NOT_FOUND', 'error_description': 'Not found'}}
+
+def test_execute_treats_empty_php_arrays_as_no_results(fake_call):
+    fake_call({'result': {'result': [], 'result_error': []}})
+    batch = app.BitrixBatch()
+    batch.add('deal', 'crm.deal.get', {'ID': 1})
+    assert batch.execute() == ({}, {})
+
+def test_transport_error_fails_only_its_chunk(fake_call):
+    count = app.BATCH_LIMIT + 1
+    fake_call(app.Bitrix24Error('ConnectionError', 'reset'), batch_response({f'c{app.BATCH_LIMIT}': 'ok'}))
+    batch = app.BitrixBatch()
+    for i in range(count):
+        batch.add(f'c{i}', 'crm.deal.get', {'ID': i})
+
+    results, errors = batch.execute()
+
+    assert results == {f'c{app.BATCH_LIMIT}': 'ok'}
+    assert set(errors) == {f'c{i}' for i in range(app.BATCH_LIMIT)}
+    assert errors['c0'] == 'ConnectionError: reset'
@@ -0,0 +1,42 @@
+"""
+BusinessCalendar против прежнего перебора по дням на производственном
+календаре репозитория.
+"""
+from datetime import date, timedelta
+
+import pytest
+
+import app
+
+def loop_business_days(start_day, end_day, holidays, workdays):
+    """Прежний подсчёт: перебор дней с проверкой выходных, праздников и рабочих суббот"""
+    count = 0
+    day = start_day
+    while day < end_day:
+        if (day.weekday() < 5 and day not in holidays) or day in workdays:
+            count += 1
+        day += timedelta(days=1)
+    return count
+
+@pytest.mark.parametrize('start_day, end_day', [
+    (date(2026, 10, 12), date(2026, 10, 19)),   # Обычная неделя
+    (date(2026, 10, 17), date(2026, 10, 19)),   # Только выходные
+    (date(2026, 10, 14), date(2026, 10, 14)),   # Пустой отрезок
+    (date(2026, 10, 15), date(2026, 10, 14)),   # Конец раньше начала
+    (date(2025, 12, 29), date(2026, 1, 13)),    # Новогодние каникулы
+    (date(2025, 10, 30), date(2025, 11, 6)),    # Рабочая суббота 1 ноября и праздники 3-4 ноября
+    (date(2024, 12, 30), date(2027, 1, 4)),     # Несколько лет
+])
+def test_business_days_matches_loop(production_calendar, start_day, end_day):
+    calendar = app.BusinessCalendar(*production_calendar)
+    assert calendar.business_days(start_day, end_day) == loop_business_days(start_day, end_day, *production_calendar)
+
+def test_business_days_matches_loop_on_every_short_span(production_calendar):
+    calendar = app.BusinessCalendar(*production_calendar)
+    first_day = date(2025, 12, 20)
+    for offset in range(30):
+        start_day = first_day + timedelta(days=offset)
+        for length in range(15):
+            end_day = start_day + timedelta(days=length)
+            assert calendar.business_days(start_day, end_day) == loop_business_days(start_day, end_day,
+                                                                                   *production_calendar)
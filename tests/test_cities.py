@@ -0,0 +1,77 @@
+"""
+Определение города и часового пояса: дефисы и пробелы в составных
+названиях, падежи, транслитерация и справочник build_gazetteer.py.
+"""
+import pytest
+
+import app
+import build_gazetteer
+
+@pytest.fixture
+def no_gazetteer(monkeypatch):
+    monkeypatch.setattr(app, '_gazetteer', False)
+    app.lookup_gazetteer_timezone.cache_clear()
+    yield
+    app.lookup_gazetteer_timezone.cache_clear()
+
+@pytest.mark.parametrize('city, canonical', [
+    ('Ростов-на-Дону', 'ростов'),
+    ('ростов на дону', 'ростов'),
+    ('г. Ростов - на - Дону', 'ростов'),
+    ('Ростове-на-Дону', 'ростов'),
+    ('Rostov-na-Donu', 'ростов'),
+    ('Rostov on Don', 'ростов'),
+    ('Санкт Петербург', 'санкт-петербург'),
+    ('Улан Удэ', 'улан-удэ'),
+    ('Йошкар Ола', 'йошкар-ола'),
+    ('Комсомольске-на-Амуре', 'комсомольск-на-амуре'),
+    ('Нижнем Новгороде', 'нижний новгород'),
+    ('Нижний-Новгород', 'нижний новгород'),
+    ('nizhny-novgorod', 'нижний новгород'),
+    ('Казани', 'казань'),
+    ('Орск', None),
+])
+def test_resolve_city_folds_hyphens_and_spaces(city, canonical):
+    assert app.resolve_city(city, fuzzy=False) == canonical
+
+@pytest.mark.parametrize('city, timezone', [
+    ('Ростов-на-Дону', 'РСТ (UTC+3)'),
+    ('ростов на дону', 'РСТ (UTC+3)'),
+    ('Улан Удэ', 'УУ (UTC+8)'),
+    ('Санкт-Петербурге', 'МСК (UTC+3)'),
+])
+def test_get_timezone_from_city(no_gazetteer, city, timezone):
+    assert app.get_timezone_from_city(city) == timezone
+
+@pytest.mark.parametrize('text, city', [
+    ('Живу в Ростов-на-Дону, ищу работу', 'ростов'),
+    ('ростов на дону', 'ростов'),
+    ('Город: Ростов-на-Дону', 'ростов'),
+    ('Улан Удэ', 'улан-удэ'),
+    ('Nizhny Novgorod', 'нижний новгород'),
+])
+def test_extract_city_from_text_accepts_any_separator(text, city):
+    assert app.extract_city_from_text(text) == city
+
+def geonames_row(name, alternate_names, population, zone):
+    columns = [''] * 19
+    columns[1], columns[2], columns[3] = name, name, alternate_names
+    columns[6], columns[14], columns[17] = 'P', str(population), zone
+    return '\t'.join(columns) + '\n'
+
+def test_gazetteer_keys_match_lookups(tmp_path, monkeypatch):
+    dump = tmp_path / 'RU.txt'
+    dump.write_text(geonames_row('Petropavlovsk-Kamchatsky', 'Петропавловск-Камчатский', 164000, 'Asia/Kamchatka') +
+                    geonames_row('Nikolayevsk-on-Amur', 'Николаевск-на-Амуре', 17000, 'Asia/Vladivostok'),
+                    encoding='utf-8')
+    output = tmp_path / 'gazetteer.bin'
+    build_gazetteer.write_gazetteer(build_gazetteer.collect([str(dump)]), str(output))
+    monkeypatch.setattr(app, '_gazetteer', app.Gazetteer(str(output)))
+    app.lookup_gazetteer_timezone.cache_clear()
+    try:
+        for city in ('Петропавловск-Камчатский', 'петропавловск камчатский', 'Petropavlovsk Kamchatsky'):
+            assert app.lookup_gazetteer_timezone(city) == 'КМЧ (UTC+12)'
+        for city in ('Николаевск-на-Амуре', 'николаевск на амуре', 'Николаевске-на-Амуре'):
+            assert app.lookup_gazetteer_timezone(city) == 'ВЛД (UTC+10)'
+    finally:
+        app.lookup_gazetteer_timezone.cache_clear()
@@ -0,0 +1,102 @@
+"""
+Bitrix24Client: повторы транспортных ошибок, 5xx и QUERY_LIMIT_EXCEEDED с
+экспоненциальной паузой и Retry-After. Сессия и time.sleep подменены.
+"""
+import pytest
+import requests
+
+import app
+
+class FakeResponse:
+    def __init__(self, status_code=200, data=None, headers=None):
+        self.status_code = status_code
+        self.data = data
+        self.headers = headers or {}
+        self.text = '' if data is None else str(data)
+
+    def json(self):
+        if self.data is None:
+            raise ValueError('no json')
+        return self.data
+
+class FakeSession:
+    """Отвечает заданными ответами (или исключениями) по очереди"""
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.urls = []
+
+    def post(self, url, json=None, timeout=None):
+        self.urls.append(url)
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+def rest_error(code, status_code=503, headers=None):
+    return FakeResponse(status_code, {'error': code, 'error_description': code.lower()}, headers)
+
+OK = FakeResponse(200, {'result': {'ID': '1'}})
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    delays = []
+    monkeypatch.setattr(app.time, 'sleep', delays.append)
+    monkeypatch.setattr(app.random, 'uniform', lambda low, high: 0)
+    return delays
+
+def make_client(*responses, max_retries=3):
+    client = app.Bitrix24Client('https://portal.example/rest/1/token/', max_retries=max_retries,
+                                backoff=0.5, limiter=None)
+    client.session = FakeSession(*responses)
+    return client
+
+def test_success_needs_one_request(sleeps):
+    client = make_client(OK)
+    assert client.call('crm.deal.get', {'ID': 1}) == {'result': {'ID': '1'}}
+    assert client.session.urls == ['https://portal.example/rest/1/token/crm.deal.get']
+    assert sleeps == []
+
+def test_server_errors_are_retried_with_exponential_backoff(sleeps):
+    client = make_client(FakeResponse(502), rest_error('INTERNAL_SERVER_ERROR', 500),
+                         rest_error('QUERY_LIMIT_EXCEEDED'), OK)
+    assert client.call('crm.deal.get') == {'result': {'ID': '1'}}
+    assert sleeps == [0.5, 1.0, 2.0]
+    assert client.calls == 4
+
+def test_transport_errors_are_retried(sleeps):
+    client = make_client(requests.ConnectionError('reset'), requests.Timeout('slow'), OK)
+    assert client.call('crm.deal.get') == {'result': {'ID': '1'}}
+    assert sleeps == [0.5, 1.0]
+
+def test_retry_after_header_overrides_backoff(sleeps):
+    client = make_client(rest_error('QUERY_LIMIT_EXCEEDED', headers={'Retry-After': '7'}), OK)
+    client.call('crm.deal.get')
+    assert sleeps == [7.0]
+
+def test_gives_up_after_max_retries(sleeps):
+    client = make_client(*[rest_error('QUERY_LIMIT_EXCEEDED')] * 3, max_retries=2)
+    with pytest.raises(app.Bitrix24Error) as raised:
+        client.call('crm.deal.get')
+    assert raised.value.code == 'QUERY_LIMIT_EXCEEDED'
+    assert raised.value.status_code == 503
+    assert client.calls == 3
+    assert client.session.responses == []
+
+def test_gives_up_on_transport_errors(sleeps):
+    client = make_client(*[requests.ConnectionError('reset')] * 2, max_retries=1)
+    with pytest.raises(app.Bitrix24Error, match='ConnectionError'):
+        client.call('crm.deal.get')
+
+@pytest.mark.parametrize('response, code', [
+    (rest_error('NOT_FOUND', 400), 'NOT_FOUND'),
+    (rest_error('ACCESS_DENIED', 403), 'ACCESS_DENIED'),
+    (FakeResponse(404), 'HTTP_404'),
+])
+def test_client_errors_are_not_retried(sleeps, response, code):
+    client = make_client(response, OK)
+    with pytest.raises(app.Bitrix24Error) as raised:
+        client.call('crm.deal.get')
+    assert raised.value.code == code
+    assert client.calls == 1
+    assert sleeps == []
@@ -0,0 +1,73 @@
+"""
+EventCoalescer: первый event выполняется сразу, повторные в пределах окна
+схлопываются в один завершающий прогон. Часы подменены.
+"""
+import pytest
+
+import app
+
+KEY = ('deal', '42')
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(app.time, 'time', lambda: now[0])
+    return now
+
+def test_first_event_runs_now(clock):
+    coalescer = app.EventCoalescer(window=15)
+    assert coalescer.claim(KEY) == (True, None)
+    assert coalescer.release(KEY) is None
+
+def test_events_during_a_run_collapse_into_one_trailing_run(clock):
+    coalescer = app.EventCoalescer(window=15)
+    coalescer.claim(KEY)
+    assert coalescer.claim(KEY) == (False, None)
+    assert coalescer.claim(KEY) == (False, None)
+    assert coalescer.release(KEY) == 15
+    # Пока завершающий прогон ждёт, новые события им покрыты
+    clock[0] += 5
+    assert coalescer.claim(KEY) == (False, None)
+    coalescer.start(KEY)
+    assert coalescer.release(KEY) is None
+    assert coalescer.collapsed == 3
+
+def test_event_within_window_after_run_schedules_trailing_run(clock):
+    coalescer = app.EventCoalescer(window=15)
+    coalescer.claim(KEY)
+    coalescer.release(KEY)
+    clock[0] += 4
+    run_now, delay = coalescer.claim(KEY)
+    assert not run_now
+    assert delay == pytest.approx(11)
+    # Второе событие того же окна не планирует ещё один прогон
+    assert coalescer.claim(KEY) == (False, None)
+
+def test_event_after_window_runs_now(clock):
+    coalescer = app.EventCoalescer(window=15)
+    coalescer.claim(KEY)
+    coalescer.release(KEY)
+    clock[0] += 15
+    assert coalescer.claim(KEY) == (True, None)
+
+def test_keys_are_independent(clock):
+    coalescer = app.EventCoalescer(window=15)
+    coalescer.claim(KEY)
+    assert coalescer.claim(('deal', '43')) == (True, None)
+    assert coalescer.claim(('contact', '42')) == (True, None)
+
+def test_zero_window_disables_coalescing(clock):
+    coalescer = app.EventCoalescer(window=0)
+    assert coalescer.claim(KEY) == (True, None)
+    assert coalescer.claim(KEY) == (True, None)
+    assert coalescer.release(KEY) is None
+
+def test_finished_entries_are_pruned(clock):
+    coalescer = app.EventCoalescer(window=15, max_entries=2)
+    for entity_id in range(3):
+        key = ('deal', str(entity_id))
+        coalescer.claim(key)
+        coalescer.release(key)
+        clock[0] += 10
+    # Запись deal 0 старше окна и вычищена, deal 1 и 2 ещё в окне
+    assert set(coalescer.finished) == {('deal', '1'), ('deal', '2')}
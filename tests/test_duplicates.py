@@ -0,0 +1,68 @@
+"""
+PhoneIndex и check_duplicates: поиск других контактов с тем же телефоном
+и однократный комментарий о дубликате. Индекс - во временном SQLite.
+"""
+import pytest
+
+import app
+
+@pytest.fixture
+def index(tmp_path, monkeypatch):
+    phone_index = app.PhoneIndex(str(tmp_path / 'phone_index.sqlite3'))
+    monkeypatch.setattr(app, 'phone_index', phone_index)
+    monkeypatch.setattr(app, 'DUPLICATE_COMMENTS', True)
+    return phone_index
+
+def test_lookup_and_other_contacts(index):
+    assert index.add('79123456789', 1, deal_ids=[10, 11]) == 3
+    index.add_many([('79123456789', 2, 20), ('79123456789', '3', None), ('', 4, 0)])
+    assert index.lookup('79123456789') == [(1, 0), (1, 10), (1, 11), (2, 20), (3, 0)]
+    assert index.other_contacts('79123456789', '1') == [2, 3]
+    assert index.other_contacts('70000000000', 1) == []
+
+def test_add_many_is_idempotent(index):
+    index.add('79123456789', 1, deal_ids=[10])
+    index.add('79123456789', 1, deal_ids=[10])
+    assert index.stats()['rows'] == 2
+
+def test_claim_notes_reports_each_pair_once(index):
+    assert index.claim_notes(10, [2, 3]) == [2, 3]
+    assert index.claim_notes(10, [2, 3, 4]) == [4]
+    assert index.claim_notes(11, [2]) == [2]
+    index.release_notes(10, [3])
+    assert index.claim_notes(10, [3]) == [3]
+
+def test_check_duplicates_comments_once(index):
+    index.add('79123456789', 2, deal_ids=[20])
+
+    writes = app.BitrixBatch()
+    duplicates, claimed = app.check_duplicates(10, 1, ['79123456789'], writes)
+    assert (duplicates, claimed) == ([2], [2])
+    [(name, method, params)] = writes.commands
+    assert (name, method) == ('duplicate_comment', 'crm.timeline.comment.add')
+    assert params['fields']['ENTITY_ID'] == 10
+    assert f"{app.PORTAL_URL}/crm/contact/details/2/" in params['fields']['COMMENT']
+    assert index.other_contacts('79123456789', 2) == [1]
+
+    # Следующее событие по той же сделке видит дубликат, но комментарий не повторяет
+    writes = app.BitrixBatch()
+    assert app.check_duplicates(10, 1, ['79123456789'], writes) == ([2], [])
+    assert len(writes) == 0
+
+def test_check_duplicates_without_other_contacts(index):
+    writes = app.BitrixBatch()
+    assert app.check_duplicates(10, 1, ['79123456789'], writes) == ([], [])
+    assert app.check_duplicates(10, 1, [], writes) == ([], [])
+    assert len(writes) == 0
+
+def test_check_duplicates_respects_duplicate_comments_off(index, monkeypatch):
+    monkeypatch.setattr(app, 'DUPLICATE_COMMENTS', False)
+    index.add('79123456789', 2)
+    writes = app.BitrixBatch()
+    assert app.check_duplicates(10, 1, ['79123456789'], writes) == ([2], [])
+    assert len(writes) == 0
+
+def test_duplicate_comment_lists_at_most_the_limit():
+    comment = app.build_duplicate_comment(list(range(1, app.DUPLICATE_LINKS_LIMIT + 4)))
+    assert comment.count('/crm/contact/details/') == app.DUPLICATE_LINKS_LIMIT
+    assert comment.endswith('...и ещё 3')
@@ -0,0 +1,36 @@
+"""
+Логи вебхуков: токены портала из auth[*] не попадают в payload и предупреждения.
+"""
+import logging
+
+import app
+
+AUTH = {
+    'auth[domain]': 'hr-adv.bitrix24.ru',
+    'auth[member_id]': 'member-secret',
+    'auth[application_token]': 'app-secret',
+    'auth[access_token]': 'access-secret',
+}
+
+def test_redact_payload_masks_auth_keys():
+    payload = {'event': 'ONCRMDEALUPDATE', 'data[FIELDS][ID]': '5', **AUTH}
+    redacted = app.redact_payload(payload)
+    assert redacted['event'] == 'ONCRMDEALUPDATE'
+    assert redacted['data[FIELDS][ID]'] == '5'
+    assert all(redacted[key] == '[redacted]' for key in AUTH)
+    assert payload['auth[access_token]'] == 'access-secret'
+
+def test_redact_payload_masks_nested_auth():
+    assert app.redact_payload({'auth': {'access_token': 'x'}, 'id': 1}) == {'auth': '[redacted]', 'id': 1}
+    assert app.redact_payload(None) is None
+
+def test_webhook_logs_never_contain_tokens(caplog):
+    client = app.app.test_client()
+    with caplog.at_level(logging.DEBUG):
+        assert client.post('/webhook', data={'event': 'ONCRMDEALUPDATE', **AUTH}).status_code == 400
+        assert client.post('/contact-update', data={'event': 'ONCRMCONTACTUPDATE', **AUTH}).status_code == 400
+    assert 'Webhook payload' in caplog.text
+    assert 'No deal ID in request' in caplog.text
+    assert 'No contact ID in request' in caplog.text
+    for secret in ('member-secret', 'app-secret', 'access-secret'):
+        assert secret not in caplog.text
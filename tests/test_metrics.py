@@ -0,0 +1,33 @@
+"""
+Метрики: этапы обработчиков в гистограмме и в Server-Timing.
+"""
+import app
+
+def test_timed_stage_records_histogram_and_server_timing(monkeypatch):
+    monkeypatch.setattr(app, 'metrics', app.Metrics())
+    monkeypatch.setattr(app._request_timing, 'entries', {}, raising=False)
+    app.record_timing('batch', 0.02)
+    with app.timed_stage('deal', 'fetch'):
+        pass
+    with app.timed_stage('deal', 'write'):
+        pass
+
+    entries = app._request_timing.entries
+    assert list(entries) == ['batch', 'deal_fetch', 'deal_write']
+    header = app._server_timing_header(entries, 0.05)
+    assert header.startswith('batch;dur=20.0;desc="1 calls", deal_fetch;dur=')
+    assert header.endswith('total;dur=50.0')
+    series = app.metrics.histograms['webhook_stage_duration_seconds']
+    assert {labels: state[-1] for labels, state in series.items()} == {
+        (('handler', 'deal'), ('stage', 'fetch')): 1,
+        (('handler', 'deal'), ('stage', 'write')): 1,
+    }
+
+def test_timed_stage_records_failed_stage(monkeypatch):
+    monkeypatch.setattr(app, 'metrics', app.Metrics())
+    try:
+        with app.timed_stage('contact', 'write'):
+            raise app.Bitrix24Error('ConnectionError')
+    except app.Bitrix24Error:
+        pass
+    assert (('handler', 'contact'), ('stage', 'write')) in app.metrics.histograms['webhook_stage_duration_seconds']
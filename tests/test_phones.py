@@ -0,0 +1,34 @@
+"""
+Нормализация телефонов: коды стран RU/KZ/BY/UZ, неоднозначные и
+некорректные номера, выбор телефона контакта.
+"""
+import pytest
+
+import app
+
+def phones(*values):
+    return [{'VALUE': value, 'VALUE_TYPE': 'WORK'} for value in values]
+
+@pytest.mark.parametrize('raw, digits, country, status', [
+    ('+7 912 345-67-89', '79123456789', 'RU', app.PHONE_VALID),
+    ('8 (912) 345-67-89', '79123456789', 'RU', app.PHONE_VALID),
+    ('9123456789', '79123456789', 'RU', app.PHONE_VALID),
+    ('+7 701 555 12 34', '77015551234', 'KZ', app.PHONE_VALID),
+    ('87015551234', '77015551234', 'KZ', app.PHONE_VALID),
+    ('+375 29 123-45-67', '375291234567', 'BY', app.PHONE_VALID),
+    ('80 29 123 45 67', '375291234567', 'BY', app.PHONE_VALID),
+    ('+998 90 123 45 67', '998901234567', 'UZ', app.PHONE_VALID),
+    ('00998901234567', '998901234567', 'UZ', app.PHONE_VALID),
+    ('+49 30 1234567', '49301234567', None, app.PHONE_VALID),
+    ('4951234567', '74951234567', 'RU', app.PHONE_AMBIGUOUS),
+    ('49301234567', '49301234567', None, app.PHONE_AMBIGUOUS),
+    ('+7 512 345 67 89', None, None, app.PHONE_INVALID),
+    ('12345', None, None, app.PHONE_INVALID),
+    ('', None, None, app.PHONE_INVALID),
+])
+def test_classify_phone(raw, digits, country, status):
+    assert app.classify_phone(raw) == app.PhoneResult(raw, digits, country, status)
+
+def test_pick_contact_phone_skips_invalid_and_ambiguous():
+    contact = {'PHONE': phones('12345', '4951234567', '+375 29 123-45-67')}
+    assert app.pick_contact_phone(contact).digits == '375291234567'
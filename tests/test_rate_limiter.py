@@ -0,0 +1,110 @@
+"""
+PortalRateLimiter: очереди interactive/bulk, AIMD по QUERY_LIMIT_EXCEEDED
+и ограничение ожидания слота сроком patience в обоих клиентах.
+Корзина - во временном SQLite, часы подменены.
+"""
+import asyncio
+
+import pytest
+
+import app
+import async_app
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(app.time, 'time', lambda: now[0])
+    return now
+
+def make_limiter(tmp_path, rate=2.0, burst=4, bulk_reserve=2):
+    return app.PortalRateLimiter(str(tmp_path / 'rate_limit.sqlite3'), rate=rate, burst=burst,
+                                 bulk_reserve=bulk_reserve, min_rate=0.5, increase=0.25, decrease=0.5)
+
+def test_interactive_calls_queue_in_debt(tmp_path, clock):
+    limiter = make_limiter(tmp_path, rate=1.0, burst=2, bulk_reserve=0)
+    assert [limiter.reserve() for _ in range(4)] == [(True, 0.0), (True, 0.0), (True, 1.0), (True, 2.0)]
+    clock[0] += 3
+    assert limiter.reserve() == (True, 0.0)
+
+def test_bulk_lane_takes_only_the_surplus(tmp_path, clock):
+    limiter = make_limiter(tmp_path)
+    assert limiter.reserve(app.PRIORITY_BULK) == (True, 0.0)
+    assert limiter.reserve(app.PRIORITY_BULK) == (True, 0.0)
+    # Запас BITRIX_BULK_RESERVE остаётся вебхукам
+    assert limiter.reserve(app.PRIORITY_BULK) == (False, 0.5)
+    assert limiter.reserve(app.PRIORITY_INTERACTIVE) == (True, 0.0)
+    assert limiter.reserve(app.PRIORITY_BULK) == (False, app.BITRIX_BULK_POLL)
+    clock[0] += 1.5
+    assert limiter.reserve(app.PRIORITY_BULK) == (True, 0.0)
+
+def test_interactive_wait_is_capped_by_max_wait(tmp_path, clock):
+    limiter = make_limiter(tmp_path, rate=1.0, burst=1, bulk_reserve=0)
+    assert limiter.reserve(max_wait=0.5) == (True, 0.0)
+    assert limiter.reserve(max_wait=0.5) == (False, None)
+    # Отказ не занимает место в очереди
+    assert limiter.reserve(max_wait=2) == (True, 1.0)
+    assert limiter.acquire(app.PRIORITY_INTERACTIVE, max_wait=1.5) is None
+
+def test_rate_limited_halves_rate_once_per_burst(tmp_path, clock):
+    limiter = make_limiter(tmp_path)
+    assert limiter.on_rate_limited() == 1.0
+    # Та же волна ошибок из других воркеров скорость больше не снижает
+    assert limiter.on_rate_limited() == 1.0
+    assert limiter.stats()['tokens'] == 0
+    clock[0] += 1
+    assert limiter.on_rate_limited() == 0.5
+    clock[0] += 2
+    assert limiter.on_rate_limited() == 0.5  # Не ниже min_rate
+
+def test_success_restores_rate_up_to_the_limit(tmp_path, clock):
+    limiter = make_limiter(tmp_path)
+    limiter.on_rate_limited()
+    for _ in range(6):
+        limiter.on_success()
+    assert limiter.stats()['rate'] == 2.0
+    assert limiter.current_rate == 2.0
+
+class OkResponse:
+    status_code = 200
+    headers = {}
+
+    def json(self):
+        return {'result': True}
+
+class OkSession:
+    def __init__(self):
+        self.urls = []
+
+    def post(self, url, json=None, timeout=None):
+        self.urls.append(url)
+        return OkResponse()
+
+def test_client_fails_fast_when_slot_is_past_patience(tmp_path, clock, monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(app.time, 'sleep', sleeps.append)
+    monkeypatch.setattr(app, 'BITRIX_RATE_LIMIT_PATIENCE', 5)
+    client = app.Bitrix24Client('https://portal.example/rest/1/token/',
+                                limiter=make_limiter(tmp_path, rate=0.1, burst=1, bulk_reserve=0))
+    client.session = OkSession()
+    assert client.call('crm.deal.get') == {'result': True}
+    with pytest.raises(app.Bitrix24Error) as raised:
+        client.call('crm.deal.get')
+    assert raised.value.code == 'QUERY_LIMIT_EXCEEDED'
+    assert len(client.session.urls) == 1
+    assert sleeps == []
+
+def test_async_client_fails_fast_when_slot_is_past_patience(tmp_path, clock, monkeypatch):
+    monkeypatch.setattr(async_app, 'BITRIX_REQUEST_PATIENCE', 5)
+    limiter = make_limiter(tmp_path, rate=0.1, burst=1, bulk_reserve=0)
+    limiter.reserve()
+    client = async_app.AsyncBitrix24Client('https://portal.example/rest/1/token/', limiter=limiter)
+
+    async def call():
+        try:
+            await client.call('crm.deal.get')
+        finally:
+            await client.close()
+
+    with pytest.raises(app.Bitrix24Error, match='QUERY_LIMIT_EXCEEDED'):
+        asyncio.run(call())
+    assert client.calls == 0
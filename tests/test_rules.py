@@ -0,0 +1,101 @@
+"""
+Правила обогащения: встроенные DEAL_RULES против прежнего webhook() и проверка
+формата файла правил.
+Запуск: python -m pytest
+"""
+import json
+
+import pytest
+
+import app
+
+# ============================================================================
+# ENRICHMENT RULES - встроенный набор "deal" против прежнего webhook()
+# ============================================================================
+
+def phones(*values):
+    return [{'VALUE': value, 'VALUE_TYPE': 'WORK'} for value in values]
+
+def contact_links(phone):
+    return {
+        'UF_CRM_WHATSAPP_LINK': f'https://wa.me/{phone}',
+        'UF_CRM_TELEGRAM_LINK': f'https://t.me/+{phone}',
+    }
+
+def deal_links(phone):
+    return {
+        'UF_CRM_CALL_LINK': f'tel:+{phone}',
+        'UF_CRM_1767001460714': f'https://wa.me/{phone}',
+        'UF_CRM_1767001473947': f'https://t.me/+{phone}',
+        'UF_CRM_WHATSAPP_URL': f'https://wa.me/{phone}',
+        'UF_CRM_TELEGRAM_URL': f'https://t.me/+{phone}',
+    }
+
+# (сделка, контакт, contact_updates, deal_updates) - ожидания сняты с build_updates до правил
+DEAL_RULE_CASES = [
+    pytest.param(
+        {'ID': '1', 'TITLE': 'Курьер', 'CONTACT_ID': '2'},
+        {'ID': '2', 'NAME': 'Иван', 'LAST_NAME': 'Петров', 'PHONE': phones('8 (912) 345-67-89')},
+        contact_links('79123456789'),
+        {**deal_links('79123456789'), 'TITLE': 'Иван Петров - Курьер'},
+        id='ru-phone-and-title',
+    ),
+    pytest.param(
+        {'ID': '1', 'TITLE': 'Иван Петров - Курьер', 'UF_CRM_CITY': 'Казань', 'CONTACT_ID': '2'},
+        {'ID': '2', 'NAME': 'Иван', 'LAST_NAME': 'Петров', 'PHONE': phones('+7 701 555 12 34')},
+        contact_links('77015551234'),
+        {'UF_CRM_TIMEZONE': 'КЗН (UTC+3)', **deal_links('77015551234')},
+        id='city-field-title-already-set',
+    ),
+    pytest.param(
+        {'ID': '1', 'TITLE': 'Повар', 'COMMENTS': 'Город: Новосибирск, опыт 3 года', 'CONTACT_ID': '2'},
+        {'ID': '2', 'NAME': 'Анна', 'PHONE': phones('12345', '+375 29 123-45-67')},
+        contact_links('375291234567'),
+        {'UF_CRM_CITY': 'Новосибирск', 'UF_CRM_TIMEZONE': 'НСК (UTC+7)', **deal_links('375291234567'),
+         'TITLE': 'Анна - Повар'},
+        id='city-from-deal-comments-second-phone',
+    ),
+    pytest.param(
+        {'ID': '1', 'TITLE': 'Водитель', 'CONTACT_ID': '2'},
+        {'ID': '2', 'NAME': '', 'LAST_NAME': '', 'COMMENTS': 'Екатеринбург, ищу работу',
+         'PHONE': phones('4951234567')},
+        {},
+        {'UF_CRM_CITY': 'Екатеринбург', 'UF_CRM_TIMEZONE': 'ЕКБ (UTC+5)'},
+        id='city-from-contact-comments-ambiguous-phone',
+    ),
+    pytest.param(
+        {'ID': '1', 'TITLE': '', 'UF_CRM_694F054732342': 'Ташкент', 'CONTACT_ID': '2'},
+        {'ID': '2', 'NAME': 'Шерзод', 'PHONE': phones('+998 90 123 45 67')},
+        contact_links('998901234567'),
+        deal_links('998901234567'),
+        id='legacy-city-field-unknown-timezone',
+    ),
+    pytest.param(
+        {'ID': '1', 'TITLE': 'Продавец', 'CONTACT_ID': '2'},
+        {'ID': '2'},
+        {},
+        {},
+        id='empty-contact',
+    ),
+]
+
+@pytest.mark.parametrize('deal, contact, contact_updates, deal_updates', DEAL_RULE_CASES)
+def test_deal_rules_match_baseline(deal, contact, contact_updates, deal_updates):
+    assert app.DEAL_RULES.apply(deal, contact) == (contact_updates, deal_updates)
+
+def test_deal_rules_select_covers_read_and_written_fields():
+    assert {'ID', 'CONTACT_ID', 'TITLE', 'COMMENTS', 'UF_CRM_CITY', 'UF_CRM_694F054732342',
+            'UF_CRM_TIMEZONE', 'UF_CRM_WHATSAPP_URL'} <= set(app.DEAL_RULES.select('deal'))
+    assert {'ID', 'NAME', 'LAST_NAME', 'PHONE', 'COMMENTS',
+            'UF_CRM_WHATSAPP_LINK'} <= set(app.DEAL_RULES.select('contact'))
+
+@pytest.mark.parametrize('content, message', [
+    ({'_comment': 'x'}, "unknown rule set '_comment'"),
+    ({'deal': []}, "rule set 'deal' must be a mapping"),
+    ([], 'expected a mapping of rule sets'),
+])
+def test_load_enrichment_rules_rejects_bad_shape(tmp_path, content, message):
+    path = tmp_path / 'rules.json'
+    path.write_text(json.dumps(content), encoding='utf-8')
+    with pytest.raises(ValueError, match=message):
+        app.load_enrichment_rules(str(path))
@@ -0,0 +1,158 @@
+"""
+Фоновая проверка застрявших сделок: лидерство планировщика по flock,
+расписание и журнал запусков StaleCheckRuns (дедупликация, осиротевшие
+запуски), маршруты /check-stale-deals/start и /status в app и async_app.
+"""
+import asyncio
+import json
+from datetime import datetime, timezone
+
+import pytest
+
+import app
+import async_app
+
+@pytest.fixture
+def runs(tmp_path, monkeypatch):
+    store = app.StaleCheckRuns(str(tmp_path / 'scheduler.sqlite3'))
+    monkeypatch.setattr(app, 'stale_check_runs', store)
+    monkeypatch.setattr(async_app, 'stale_check_runs', store)
+    yield store
+    for run_id in list(store.held):
+        store._release(run_id)
+
+def make_scheduler(tmp_path, at='07:00', days='1-5'):
+    return app.Scheduler(at=at, days=days, lock_path=str(tmp_path / 'scheduler.sqlite3.lock'))
+
+def test_only_one_scheduler_holds_leadership(runs, tmp_path):
+    first, second = make_scheduler(tmp_path), make_scheduler(tmp_path)
+    assert first._acquire_leadership()
+    assert not second._acquire_leadership()
+    assert (first.is_leader, second.is_leader) == (True, False)
+    # Лидер завершился - блокировку освобождает ОС, следующий тик её забирает
+    first.lock_file.close()
+    assert second._acquire_leadership()
+
+@pytest.mark.parametrize('now, due', [
+    (datetime(2026, 10, 19, 6, 59, tzinfo=timezone.utc), False),   # Понедельник, ещё рано
+    (datetime(2026, 10, 19, 7, 0, tzinfo=timezone.utc), True),
+    (datetime(2026, 10, 19, 15, 0, tzinfo=timezone.utc), True),    # Инстанс проспал время запуска
+    (datetime(2026, 10, 18, 8, 0, tzinfo=timezone.utc), False),    # Воскресенье
+])
+def test_due_on_schedule_days_after_time(runs, tmp_path, now, due):
+    assert make_scheduler(tmp_path).due(now) is due
+
+def test_not_due_after_todays_scheduled_run(runs, tmp_path):
+    scheduler = make_scheduler(tmp_path, days='1-7')
+    now = datetime.now(timezone.utc).replace(hour=23, minute=59)
+    assert scheduler.due(now)
+    run, created = runs.create('schedule', since=app.stale_check_since('schedule'))
+    runs.finish(run['id'], 'done', {})
+    assert not scheduler.due(now)
+
+def test_create_returns_active_run_until_finished(runs):
+    run, created = runs.create('manual')
+    assert created and run['status'] == 'queued'
+    assert runs.create('schedule') == (run, False)
+    runs.finish(run['id'], 'done', {'status': 'ok'})
+    assert runs.get(run['id'])['result'] == {'status': 'ok'}
+    second, created = runs.create('manual')
+    assert created and second['id'] != run['id']
+
+def test_scheduled_run_once_per_day(runs):
+    since = app.stale_check_since('schedule')
+    run, _ = runs.create('schedule', since=since)
+    runs.finish(run['id'], 'failed', {})
+    again, created = runs.create('schedule', since=since)
+    assert not created and again['id'] == run['id']
+    assert runs.create('manual')[1]
+
+def test_run_of_a_dead_worker_is_failed_on_next_trigger(runs):
+    run, _ = runs.create('manual')
+    # Воркер умер: ОС закрыла его файлы и сняла flock
+    runs.held.pop(run['id']).close()
+    second, created = runs.create('manual')
+    assert created
+    orphaned = runs.get(run['id'])
+    assert orphaned['status'] == 'failed'
+    assert orphaned['result']['message'] == 'Worker exited before the run finished'
+
+def test_run_of_a_live_worker_is_kept(runs):
+    run, _ = runs.create('manual')
+    # Другой процесс с тем же файлом видит чужую блокировку запуска
+    other = app.StaleCheckRuns(runs.path)
+    assert other.create('manual') == (run, False)
+    other.fail_orphaned()
+    assert runs.get(run['id'])['status'] == 'queued'
+
+def test_new_leader_fails_orphaned_runs(runs, tmp_path):
+    run, _ = runs.create('schedule')
+    runs.held.pop(run['id']).close()
+    assert make_scheduler(tmp_path)._acquire_leadership()
+    assert runs.get(run['id'])['status'] == 'failed'
+
+def test_timed_out_run_does_not_block(runs, monkeypatch):
+    run, _ = runs.create('manual')
+    monkeypatch.setattr(app, 'STALE_CHECK_TIMEOUT', -1)
+    assert runs.create('manual')[1]
+    assert runs.get(run['id'])['result']['message'] == 'Run timed out'
+
+@pytest.fixture
+def submitted(monkeypatch):
+    jobs = []
+    monkeypatch.setattr(app.job_queue, 'submit', lambda kind, entity_id, handler: jobs.append(entity_id))
+    return jobs
+
+def test_start_and_status_routes(runs, submitted):
+    client = app.app.test_client()
+    response = client.post('/check-stale-deals/start')
+    assert response.status_code == 202
+    job_id = response.get_json()['job_id']
+    assert response.get_json()['status'] == 'accepted'
+    assert submitted == [job_id]
+
+    response = client.post('/check-stale-deals/start?trigger=schedule')
+    assert (response.status_code, response.get_json()['status']) == (202, 'already_running')
+    assert client.post('/check-stale-deals/start?trigger=nightly').status_code == 400
+
+    runs.finish(job_id, 'done', {'status': 'ok'})
+    body = client.get(f'/check-stale-deals/status/{job_id}').get_json()
+    assert body['run']['status'] == 'done'
+    assert client.get('/check-stale-deals/status').get_json()['run']['id'] == job_id
+    assert client.get('/check-stale-deals/status/missing').status_code == 404
+
+async def asgi_request(method, path, query_string=b''):
+    """Один HTTP-запрос к async_app.app; возвращает (status, json)"""
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b''}
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {'type': 'http', 'method': method, 'path': path, 'query_string': query_string, 'headers': []}
+    await async_app.app(scope, receive, send)
+    return messages[0]['status'], json.loads(messages[1]['body'])
+
+def test_async_start_and_status_routes(runs, monkeypatch):
+    async def fake_check():
+        return {'status': 'ok'}, 200
+
+    monkeypatch.setattr(async_app, 'check_stale_deals', fake_check)
+
+    async def scenario():
+        status, body = await asgi_request('POST', '/check-stale-deals/start')
+        assert (status, body['status']) == (202, 'accepted')
+        job_id = body['job_id']
+        await asyncio.gather(*async_app.background_tasks)
+
+        status, body = await asgi_request('GET', f'/check-stale-deals/status/{job_id}')
+        assert status == 200
+        assert (body['run']['status'], body['run']['result']) == ('done', {'status': 'ok'})
+        assert job_id not in runs.held
+
+        assert (await asgi_request('GET', '/check-stale-deals/status/missing'))[0] == 404
+        assert (await asgi_request('GET', '/check-stale-deals/start/extra'))[0] == 404
+
+    asyncio.run(scenario())
@@ -0,0 +1,151 @@
+"""
+Проверка застрявших сделок: граница выборки по рабочим дням, синхронизация
+StaleStateStore по водяному знаку и уровни напоминаний.
+"""
+from datetime import datetime, timedelta
+
+import pytest
+
+import app
+
+# ============================================================================
+# STALE CUTOFF
+# ============================================================================
+
+@pytest.fixture
+def repo_calendar(monkeypatch, production_calendar):
+    monkeypatch.setattr(app, 'business_calendar', app.BusinessCalendar(*production_calendar))
+    monkeypatch.setattr(app, 'DAYS_THRESHOLD', 2)
+
+@pytest.mark.parametrize('now, cutoff', [
+    (datetime(2026, 10, 14, 10, 0), datetime(2026, 10, 14)),   # Среда: вторник и среда
+    (datetime(2026, 10, 19, 9, 0), datetime(2026, 10, 17)),    # Понедельник: пятница и понедельник
+    (datetime(2026, 10, 18, 12, 0), datetime(2026, 10, 16)),   # Воскресенье: четверг и пятница
+    (datetime(2026, 1, 12, 9, 0), datetime(2025, 12, 31)),     # После новогодних каникул
+    (datetime(2025, 11, 5, 9, 0), datetime(2025, 11, 2)),      # Рабочая суббота 1 ноября
+])
+def test_get_stale_cutoff(repo_calendar, now, cutoff):
+    assert app.get_stale_cutoff(now) == cutoff
+
+@pytest.mark.parametrize('now', [
+    datetime(2026, 10, 14, 10, 0),
+    datetime(2026, 10, 19, 9, 0),
+    datetime(2026, 1, 12, 9, 0),
+    datetime(2025, 11, 5, 9, 0),
+])
+def test_stale_cutoff_drops_only_fresh_deals(repo_calendar, now):
+    # Фильтр <DATE_MODIFY не должен терять застрявшие: всё, что изменено с границы, ещё свежее
+    cutoff = app.get_stale_cutoff(now)
+    for modified in (cutoff, cutoff + timedelta(hours=12), now):
+        assert app.count_business_days(modified, now) < app.DAYS_THRESHOLD
+
+# ============================================================================
+# STALE STATE STORE - водяной знак синхронизации и уровни напоминаний
+# ============================================================================
+
+NOW = datetime(2026, 10, 19, 9, 0)  # Понедельник
+
+def portal_time(value):
+    return value.strftime('%Y-%m-%dT%H:%M:%S') + app.PORTAL_TZ_SUFFIX
+
+def deal(deal_id, modified, stage='NEW', manager='1', closed='N'):
+    return {'ID': str(deal_id), 'TITLE': f'Сделка {deal_id}', 'STAGE_ID': stage, 'ASSIGNED_BY_ID': manager,
+            'CLOSED': closed, 'DATE_MODIFY': portal_time(modified)}
+
+@pytest.fixture
+def store(tmp_path, monkeypatch, repo_calendar):
+    monkeypatch.setattr(app, 'STALE_ESCALATION_DAYS', [2, 5, 10])
+    monkeypatch.setattr(app, 'STALE_NOTIFY_MODE', 'escalate')
+    return app.StaleStateStore(str(tmp_path / 'stale_state.sqlite3'))
+
+class FakeDealList:
+    """Подмена iter_deals: запоминает фильтры и отдаёт заданные сделки"""
+
+    def __init__(self, *runs):
+        self.runs = list(runs)
+        self.filters = []
+
+    def __call__(self, filter=None, select=None, start_id=0):
+        self.filters.append(filter)
+        return iter(self.runs.pop(0))
+
+def test_sync_advances_watermark_with_overlap(store, monkeypatch):
+    first = [deal(i, datetime(2026, 10, 1, 10, 0) + timedelta(minutes=i)) for i in range(1, app.LIST_PAGE_SIZE + 6)]
+    second = [deal(3, datetime(2026, 10, 16, 12, 0))]
+    fake = FakeDealList(first, second, [])
+    monkeypatch.setattr(app, 'iter_deals', fake)
+
+    assert store.sync() == len(first)
+    assert fake.filters[0] == {'CLOSED': 'N'}
+    assert store.get_meta('watermark') == first[-1]['DATE_MODIFY']
+
+    assert store.sync() == 1
+    # Следующий скан начинается на STALE_SYNC_OVERLAP раньше водяного знака
+    since = datetime(2026, 10, 1, 10, 55) - app.STALE_SYNC_OVERLAP
+    assert fake.filters[1] == {'>DATE_MODIFY': portal_time(since)}
+    assert store.get_meta('watermark') == second[0]['DATE_MODIFY']
+
+    # Пустой скан водяной знак не сдвигает
+    assert store.sync() == 0
+    assert store.get_meta('watermark') == second[0]['DATE_MODIFY']
+
+def test_candidates_are_open_old_deals_outside_excluded_stages(store):
+    old = datetime(2026, 10, 1, 10, 0)
+    store.record_many([
+        deal(1, old),
+        deal(2, old, stage='WON'),
+        deal(3, old, closed='Y'),
+        deal(4, datetime(2026, 10, 19, 8, 0)),
+        deal(5, old, manager='2'),
+        {'ID': '6', 'TITLE': 'Без даты'},
+    ])
+    assert [item['ID'] for item in store.candidates(NOW)] == ['1', '5']
+
+def test_escalation_levels(store):
+    assert [app.escalation_level(days) for days in (0, 1, 2, 4, 5, 9, 10, 30)] == [0, 0, 1, 1, 2, 2, 3, 3]
+
+def test_should_notify_once_per_escalation_level(store):
+    store.record_many([deal(1, datetime(2026, 10, 1, 10, 0))])
+
+    def check(days):
+        stale = {'id': '1', 'business_days_stale': days}
+        return store.should_notify(stale), stale['level']
+
+    assert check(2) == (True, 1)
+    store.mark_notified({'1': [{'id': '1', 'level': 1}]}, {'1': {'status': 'sent'}})
+    assert check(4) == (False, 1)
+    assert check(5) == (True, 2)
+    # Неотправленное уведомление уровень не повышает
+    store.mark_notified({'1': [{'id': '1', 'level': 2}]}, {'1': {'status': 'failed'}})
+    assert check(5) == (True, 2)
+
+@pytest.mark.parametrize('mode, expected', [('all', [True, True]), ('new', [True, False])])
+def test_should_notify_modes(store, monkeypatch, mode, expected):
+    monkeypatch.setattr(app, 'STALE_NOTIFY_MODE', mode)
+    store.record_many([deal(1, datetime(2026, 10, 1, 10, 0))])
+    first = store.should_notify({'id': '1', 'business_days_stale': 2})
+    store.mark_notified({'1': [{'id': '1', 'level': 1}]}, {'1': {'status': 'sent'}})
+    assert [first, store.should_notify({'id': '1', 'business_days_stale': 5})] == expected
+
+def test_changed_date_modify_starts_over(store):
+    store.record_many([deal(1, datetime(2026, 10, 1, 10, 0))])
+    store.mark_notified({'1': [{'id': '1', 'level': 2}]}, {'1': {'status': 'sent'}})
+    store.record_many([deal(1, datetime(2026, 10, 1, 10, 0))])
+    assert store.notified_level(1) == 2
+    store.record_many([deal(1, datetime(2026, 10, 2, 10, 0))])
+    assert store.notified_level(1) == 0
+
+def test_apply_verification_drops_deleted_and_keeps_unverified(store):
+    old = datetime(2026, 10, 1, 10, 0)
+    store.record_many([deal(i, old) for i in range(1, app.LIST_PAGE_SIZE + 3)])
+    candidates = store.candidates(NOW)
+    batch = store.queue_verification(candidates, app.BitrixBatch())
+    assert [name for name, _, _ in batch.commands] == ['page_0', f'page_{app.LIST_PAGE_SIZE}']
+
+    # Первая страница перечитана без сделки 2 (удалена), вторая не перечитана
+    fresh = [deal(i, old) for i in range(1, app.LIST_PAGE_SIZE + 1) if i != 2]
+    verified = store.apply_verification(candidates, {'page_0': fresh},
+                                        {f'page_{app.LIST_PAGE_SIZE}': 'ConnectionError'})
+    assert len(verified) == app.LIST_PAGE_SIZE + 1
+    assert '2' not in {item['ID'] for item in verified}
+    assert [item['ID'] for item in store.candidates(NOW)][:3] == ['1', '3', '4']